@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+"""
+Measures how fast file digests can be computed, with the chunked read loop
+which put.calculate_checksum used to have, file_digest's reusable buffer
+and mmap, and the ChecksumEngine's thread pool, on two workloads:
+
+    slices      lots of small files, like single-slice CT or MR DICOMs
+    multiframe  a few large files, like enhanced multi-frame DICOMs
+
+    python benchmarks/bench_checksum.py --slices 2000x256 --multiframe 4x256
+
+The workloads are given as count x size in KiB. Each method is run --repeat
+times and the best is reported. The files will usually be in the page
+cache after they're written, so this measures hashing and copying rather
+than the disk: use --workdir on the storage you want to test, and drop the
+caches between runs, to include reads.
+"""
+
+import argparse
+import hashlib
+import os
+import tempfile
+import time
+from pathlib import Path
+
+from xnatuploader.checksum import (
+    file_digest,
+    ChecksumEngine,
+    HASH_CHUNK_SIZE,
+    CHECKSUM_WORKERS,
+)
+
+
+def read_loop(filename):
+    file_hash = hashlib.md5()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+def buffered(filename):
+    return file_digest(filename, mmap_threshold=2**62)
+
+
+def mapped(filename):
+    return file_digest(filename, mmap_threshold=1)
+
+
+def serial(fn):
+    def run(filenames):
+        return {filename: fn(filename) for filename in filenames}
+
+    return run
+
+
+def engine(workers):
+    def run(filenames):
+        with ChecksumEngine(workers=workers) as checksums:
+            return checksums.digests(filenames)
+
+    return run
+
+
+def parse_workload(text):
+    n, size = text.lower().split("x")
+    return int(n), int(size) * 1024
+
+
+def write_workload(directory, n, size):
+    directory.mkdir()
+    filenames = []
+    for i in range(n):
+        filename = directory / f"{i:06d}.dcm"
+        filename.write_bytes(os.urandom(size))
+        filenames.append(str(filename))
+    return filenames
+
+
+def best_time(fn, filenames, repeat):
+    best = None
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn(filenames)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+
+def main():
+    ap = argparse.ArgumentParser("Checksum benchmarks")
+    ap.add_argument("--slices", default="2000x256", help="count x KiB")
+    ap.add_argument("--multiframe", default="4x256000", help="count x KiB")
+    ap.add_argument("--workers", type=int, nargs="+", default=[CHECKSUM_WORKERS])
+    ap.add_argument("--repeat", type=int, default=3, help="Repeats (best is used)")
+    ap.add_argument("--workdir", type=Path, default=None, help="Where to write")
+    args = ap.parse_args()
+    methods = [
+        ("read loop", serial(read_loop)),
+        ("readinto", serial(buffered)),
+        ("mmap", serial(mapped)),
+    ]
+    methods += [(f"engine x{w}", engine(w)) for w in args.workers]
+    with tempfile.TemporaryDirectory(dir=args.workdir) as tempdir:
+        for name, workload in [
+            ("slices", args.slices),
+            ("multiframe", args.multiframe),
+        ]:
+            n, size = parse_workload(workload)
+            filenames = write_workload(Path(tempdir) / name, n, size)
+            mb = n * size / 2**20
+            print(f"{name}: {n} files, {mb:.1f} MB")
+            expect = None
+            for method, fn in methods:
+                elapsed, digests = best_time(fn, filenames, args.repeat)
+                if expect is None:
+                    expect = digests
+                elif digests != expect:
+                    raise ValueError(f"{method} gave different digests")
+                print(
+                    f"{method:>14} {elapsed:8.3f}s {n / elapsed:9.1f} files/s "
+                    f"{mb / elapsed:8.1f} MB/s"
+                )
+
+
+if __name__ == "__main__":
+    main()
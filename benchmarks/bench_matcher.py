@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+"""
+Measures the cost of match tracing in the Matcher's hot loop.
+
+Times Matcher.match_relpath over a set of random relative paths (about half
+of which match) with tracing off and on, against a bare search with the
+compiled regexp, which is the least that matching could cost.
+
+    python benchmarks/bench_matcher.py --paths 100000
+"""
+
+import argparse
+import os
+import random
+import string
+import time
+
+from xnatuploader.matcher import Matcher, MatchTrace
+
+RECIPES = {
+    "Nested": ["{SubjectName}-{ID}", "{YYYYMMDD}", "**", "{Dataset}", "{file}.dcm"],
+    "Flat": ["{SubjectName}-{ID}", "{Dataset}", "{file}.dcm"],
+}
+
+MAPPINGS = {"Subject": ["ID"], "Dataset": ["Dataset"]}
+
+
+def word():
+    return "".join(random.choices(string.ascii_letters, k=random.randint(4, 12)))
+
+
+def make_paths(n):
+    paths = []
+    for i in range(n):
+        parts = [f"{word()}-{random.randint(1, 99999)}"]
+        if random.random() < 0.5:
+            parts.append(f"2020{random.randint(1, 12):02d}{random.randint(1, 28):02d}")
+        else:
+            parts.append(word())
+        parts += [word() for _ in range(random.randint(0, 3))]
+        parts.append(f"{word()}.dcm" if random.random() < 0.9 else f"{word()}.txt")
+        paths.append("/".join(parts))
+    return paths
+
+
+def best_time(fn, paths, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for path in paths:
+            fn(path)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def main():
+    ap = argparse.ArgumentParser("Matcher tracing benchmark")
+    ap.add_argument("--paths", type=int, default=100000, help="Number of paths")
+    ap.add_argument("--repeat", type=int, default=5, help="Repeats (best is used)")
+    ap.add_argument("--seed", type=int, default=0, help="Random seed")
+    args = ap.parse_args()
+    random.seed(args.seed)
+    paths = make_paths(args.paths)
+    matcher = Matcher(RECIPES, MAPPINGS, [])
+    results = {}
+    results["bare regexp"] = best_time(matcher.path_re.fullmatch, paths, args.repeat)
+    results["trace off"] = best_time(matcher.match_relpath, paths, args.repeat)
+    with open(os.devnull, "w") as devnull:
+        matcher.trace = MatchTrace(devnull)
+        results["trace on"] = best_time(matcher.match_relpath, paths, args.repeat)
+    matched = sum(1 for p in paths if matcher.path_re.fullmatch(p))
+    print(f"{len(paths)} paths, {matched} matching, best of {args.repeat}")
+    for name, elapsed in results.items():
+        ns = 1e9 * elapsed / len(paths)
+        rate = len(paths) / elapsed
+        print(f"{name:12} {ns:10.0f} ns/path {rate:12.0f} paths/s")
+    # the only cost tracing adds when it's off is one attribute test per
+    # path, so time that on its own to show what it amounts to
+    matcher.trace = None
+    start = time.perf_counter()
+    for path in paths:
+        if matcher.trace is not None:
+            pass
+    check = 1e9 * (time.perf_counter() - start) / len(paths)
+    off = 1e9 * results["trace off"] / len(paths)
+    print(f"trace check  {check:10.0f} ns/path ({100 * check / off:.1f}% of trace off)")
+
+
+if __name__ == "__main__":
+    main()
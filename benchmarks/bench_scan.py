@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+"""
+Benchmarks the scan stage on synthetic DICOM trees of increasing size.
+
+For each scale a tree is generated with synthetic.py and the following are
+timed, reporting files per second and peak memory:
+
+    match_path  Matcher.match_path over every relative path
+    extractor   dicom_extractor on every DICOM
+    collate     collate_uploads on the matched files (this opens every DICOM
+                again in check_safe_dicom)
+    scan        the whole of scan(), writing to a new spreadsheet
+
+Scales are given as subjects x visits x series x slices:
+
+    python benchmarks/bench_scan.py --scales 5x2x2x10 20x2x3x20 50x3x4x25
+
+Timings are the best of --repeat runs. Peak memory is measured on a separate
+run under tracemalloc, which slows things down, so it only counts Python
+allocations and isn't included in the timings.
+"""
+
+import argparse
+import logging
+import os
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+os.environ.setdefault("TQDM_DISABLE", "1")
+
+from xnatuploader.matcher import Matcher  # noqa: E402
+from xnatuploader.dicoms import (  # noqa: E402
+    dicom_extractor,
+    XNATFileMatch,
+    SPREADSHEET_FIELDS,
+)
+from xnatuploader.workbook import new_workbook  # noqa: E402
+from xnatuploader.xnatuploader import scan, collate_uploads  # noqa: E402
+
+from synthetic import generate_tree, RECIPES, MAPPINGS  # noqa: E402
+
+DEFAULT_SCALES = ["5x2x2x10", "20x2x3x20", "50x2x4x25"]
+
+
+def parse_scale(scale):
+    subjects, visits, series, slices = [int(n) for n in scale.split("x")]
+    return {
+        "subjects": subjects,
+        "visits": visits,
+        "series": series,
+        "slices": slices,
+    }
+
+
+def make_matcher():
+    return Matcher(
+        RECIPES, MAPPINGS, SPREADSHEET_FIELDS, dicom_extractor, XNATFileMatch
+    )
+
+
+def measure(fn, repeat):
+    """
+    Returns the best time of repeat calls to fn, and the peak memory of one
+    more call under tracemalloc
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best, peak
+
+
+def bench_scale(root, workdir, repeat):
+    """
+    Runs each of the benchmarks on the tree at root and returns a list of
+    ( name, n, seconds, peak bytes )
+    """
+    filepaths = sorted(f for f in root.glob("**/*") if f.is_file())
+    relpaths = [f.relative_to(root) for f in filepaths]
+    dicoms = [f for f in filepaths if f.suffix == ".dcm"]
+    matcher = make_matcher()
+    matched = [f for f in matcher.match_many(root, filepaths) if f.success]
+
+    def match_paths():
+        for relpath in relpaths:
+            matcher.match_path(relpath)
+
+    def extract():
+        for dicom in dicoms:
+            try:
+                dicom_extractor(dicom)
+            except Exception:
+                pass
+
+    def collate():
+        collate_uploads(matched, False)
+
+    def scan_tree():
+        spreadsheet = workdir / "bench.xlsx"
+        new_workbook(spreadsheet)
+        scan(make_matcher(), root, spreadsheet)
+
+    results = []
+    for name, fn, n in [
+        ("match_path", match_paths, len(relpaths)),
+        ("extractor", extract, len(dicoms)),
+        ("collate", collate, len(matched)),
+        ("scan", scan_tree, len(filepaths)),
+    ]:
+        elapsed, peak = measure(fn, repeat)
+        results.append((name, n, elapsed, peak))
+    return results
+
+
+def main():
+    ap = argparse.ArgumentParser("Scan benchmarks on synthetic DICOM trees")
+    ap.add_argument(
+        "--scales",
+        nargs="+",
+        default=DEFAULT_SCALES,
+        help="subjects x visits x series x slices, eg 10x2x3x20",
+    )
+    ap.add_argument("--depth", type=int, default=1, help="Extra directories")
+    ap.add_argument("--size", type=int, default=4096, help="DICOM size in bytes")
+    ap.add_argument("--nondicom", type=float, default=0.1, help="Share, 0 to 1")
+    ap.add_argument("--repeat", type=int, default=3, help="Repeats (best is used)")
+    ap.add_argument("--workdir", type=Path, default=None, help="Where to generate")
+    args = ap.parse_args()
+    logging.getLogger("xnatuploader").setLevel(logging.WARNING)
+    print(f"{'scale':>14} {'stage':>10} {'files':>8} {'s':>8} {'files/s':>10} MB")
+    for scale in args.scales:
+        with tempfile.TemporaryDirectory(dir=args.workdir) as tempdir:
+            workdir = Path(tempdir)
+            root = workdir / "tree"
+            generate_tree(
+                root,
+                depth=args.depth,
+                file_size=args.size,
+                non_dicom=args.nondicom,
+                **parse_scale(scale),
+            )
+            for name, n, elapsed, peak in bench_scale(root, workdir, args.repeat):
+                rate = n / elapsed if elapsed > 0 else 0
+                mb = peak / 2**20
+                print(
+                    f"{scale:>14} {name:>10} {n:8} {elapsed:8.3f} {rate:10.0f} {mb:.2f}"
+                )
+
+
+if __name__ == "__main__":
+    main()
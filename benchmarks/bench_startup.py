@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+"""
+Measures how long the command line takes to start for the subcommands
+which don't do any real work, and which modules the CLI imports before it
+does anything:
+
+    python benchmarks/bench_startup.py --repeat 10
+
+Each command is run in a fresh interpreter, and the time reported is the
+best of --repeat runs, with the time to start a bare interpreter shown for
+comparison. If `--version` takes longer than --limit seconds more than the
+bare interpreter, the script exits with status 1, so it can be used as a
+check in CI.
+
+The slowest imports are taken from `python -X importtime`.
+"""
+
+import argparse
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+CLI = [sys.executable, "-m", "xnatuploader.xnatuploader"]
+
+
+def best_time(command, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(command, check=True, capture_output=True)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def import_times(module, top):
+    """
+    Returns the top slowest imports (cumulative microseconds, name) when
+    importing module, from python -X importtime
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+    times = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        times.append((int(cumulative), name.strip()))
+    return sorted(times, reverse=True)[:top]
+
+
+def main():
+    ap = argparse.ArgumentParser("CLI startup benchmarks")
+    ap.add_argument("--repeat", type=int, default=5, help="Repeats (best is used)")
+    ap.add_argument(
+        "--limit",
+        type=float,
+        default=0.25,
+        help="Maximum seconds --version may take over a bare interpreter",
+    )
+    ap.add_argument("--top", type=int, default=15, help="Slowest imports to show")
+    args = ap.parse_args()
+    with tempfile.TemporaryDirectory() as tempdir:
+        spreadsheet = Path(tempdir) / "startup.xlsx"
+        logdir = Path(tempdir) / "logs"
+        commands = [
+            ("python", [sys.executable, "-c", "pass"]),
+            ("import", [sys.executable, "-c", "import xnatuploader.xnatuploader"]),
+            ("--version", CLI + ["--version"]),
+            ("help", CLI + ["--logdir", str(logdir), "help"]),
+            (
+                "init",
+                CLI
+                + ["--logdir", str(logdir), "--spreadsheet", str(spreadsheet)]
+                + ["init"],
+            ),
+        ]
+        results = {}
+        for name, command in commands:
+            results[name] = best_time(command, args.repeat)
+            print(f"{name:>10} {results[name]:8.3f}s")
+    print("\nSlowest imports for xnatuploader.xnatuploader (cumulative ms)")
+    for cumulative, name in import_times("xnatuploader.xnatuploader", args.top):
+        print(f"{cumulative / 1000:8.1f} {name}")
+    overhead = results["--version"] - results["python"]
+    if overhead > args.limit:
+        print(f"\n--version took {overhead:.3f}s over python, limit {args.limit}s")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
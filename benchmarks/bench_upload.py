@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+"""
+Measures upload throughput and request counts against the mock XNAT server
+in tests/mock_xnat.py.
+
+A synthetic tree is generated and scanned once, and then uploaded with a
+fresh server for each combination of network profile and mode (with and
+without anonymisation):
+
+    lan     no added latency or bandwidth limit
+    wan     20ms per request and 10MB/s
+    flaky   like lan, but 5% of file uploads fail
+
+    python benchmarks/bench_upload.py --scale 10x2x2x20 --profiles lan wan
+
+For each run it reports files/s, MB/s of DICOM uploaded, requests per file
+and the requests by method and kind.
+"""
+
+import argparse
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+os.environ.setdefault("TQDM_DISABLE", "1")
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from xnatuploader.matcher import Matcher  # noqa: E402
+from xnatuploader.dicoms import (  # noqa: E402
+    dicom_extractor,
+    XNATFileMatch,
+    SPREADSHEET_FIELDS,
+)
+from xnatuploader.workbook import new_workbook  # noqa: E402
+from xnatuploader.xnatuploader import scan, upload  # noqa: E402
+
+from tests.mock_xnat import MockXNAT  # noqa: E402
+from synthetic import generate_tree, RECIPES, MAPPINGS  # noqa: E402
+from bench_scan import parse_scale  # noqa: E402
+
+PROFILES = {
+    "lan": {},
+    "wan": {"latency": 0.02, "bandwidth": 10 * 2**20},
+    "flaky": {"error_rate": 0.05},
+}
+
+MODES = {"plain": False, "anonymize": True}
+
+PROJECT = "Benchmark"
+
+
+def make_matcher():
+    return Matcher(
+        RECIPES, MAPPINGS, SPREADSHEET_FIELDS, dicom_extractor, XNATFileMatch
+    )
+
+
+def bench_upload(spreadsheet, profile, anonymize):
+    """
+    Uploads a scanned spreadsheet to a new mock server and returns the
+    elapsed time and the server, for its counters
+    """
+    with MockXNAT(**PROFILES[profile]) as server:
+        server.add_project(PROJECT)
+        xnat_session = server.connect()
+        server.reset_counts()
+        start = time.perf_counter()
+        upload(
+            xnat_session,
+            make_matcher(),
+            PROJECT,
+            spreadsheet,
+            anonymize_files=anonymize,
+            overwrite=True,
+        )
+        elapsed = time.perf_counter() - start
+        xnat_session.disconnect()
+    return elapsed, server
+
+
+def main():
+    ap = argparse.ArgumentParser("Upload benchmarks against a mock XNAT")
+    ap.add_argument(
+        "--scale", default="5x2x2x10", help="subjects x visits x series x slices"
+    )
+    ap.add_argument("--size", type=int, default=65536, help="DICOM size in bytes")
+    ap.add_argument(
+        "--profiles", nargs="+", default=list(PROFILES), choices=list(PROFILES)
+    )
+    ap.add_argument("--modes", nargs="+", default=list(MODES), choices=list(MODES))
+    ap.add_argument("--workdir", type=Path, default=None, help="Where to generate")
+    args = ap.parse_args()
+    logging.getLogger("xnatuploader").setLevel(logging.CRITICAL)
+    with tempfile.TemporaryDirectory(dir=args.workdir) as tempdir:
+        workdir = Path(tempdir)
+        root = workdir / "tree"
+        n_dicom, _ = generate_tree(root, file_size=args.size, **parse_scale(args.scale))
+        scanned = workdir / "scanned.xlsx"
+        new_workbook(scanned)
+        scan(make_matcher(), root, scanned)
+        mb = sum(f.stat().st_size for f in root.glob("**/*.dcm")) / 2**20
+        print(f"{n_dicom} files, {mb:.1f} MB")
+        for profile in args.profiles:
+            for mode in args.modes:
+                spreadsheet = workdir / f"{profile}-{mode}.xlsx"
+                shutil.copy(scanned, spreadsheet)
+                elapsed, server = bench_upload(spreadsheet, profile, MODES[mode])
+                total = sum(server.requests.values())
+                print(
+                    f"{profile:>6} {mode:>10} {elapsed:8.2f}s "
+                    f"{n_dicom / elapsed:8.1f} files/s {mb / elapsed:7.2f} MB/s "
+                    f"{total / n_dicom:5.1f} requests/file"
+                )
+                counts = ", ".join(
+                    f"{k} {v}" for k, v in sorted(server.requests.items())
+                )
+                print(f"{'':18}{counts}")
+
+
+if __name__ == "__main__":
+    main()
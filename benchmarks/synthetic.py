@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+"""
+Generates synthetic DICOM trees for benchmarking.
+
+The layout follows the one in the README and the test fixtures:
+
+    Surname^Given-000001/20200101/[sub1/sub2/...]/Series 1/image-00000.dcm
+
+with a configurable number of subjects, visits (dates) per subject, series
+per visit, slices per series, extra directories between the date and the
+series (depth), file size and share of non-DICOM files. Non-DICOM files are
+reports, PDFs, JPEGs and empty files, some of them with a .dcm extension so
+that they get as far as the DICOM extractor.
+
+    python benchmarks/synthetic.py ./synthetic --subjects 10 --slices 50
+
+RECIPES and MAPPINGS are a matching Matcher configuration.
+"""
+
+import argparse
+from datetime import date, timedelta
+from pathlib import Path
+
+import pydicom
+from pydicom.dataset import Dataset, FileDataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+CT_IMAGE_STORAGE = "1.2.840.10008.5.1.4.1.1.2"
+
+RECIPES = {"Synthetic": ["{SubjectName}-{ID}", "**", "{Directory}", "{filename}.dcm"]}
+
+MAPPINGS = {
+    "Subject": ["ID"],
+    "Session": ["DICOM:StudyDate"],
+    "Dataset": ["Directory"],
+}
+
+NON_DICOM = {
+    "report.txt": b"Radiology report\n" * 20,
+    "report.pdf": b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n" + b"0" * 2000,
+    "snapshot.jpg": b"\xff\xd8\xff\xe0\x00\x10JFIF\x00" + b"\x00" * 2000,
+    "notes.dcm": b"Not really a DICOM\n" * 20,
+    "empty.dcm": b"",
+}
+
+FIRST_DATE = date(2015, 1, 1)
+
+PYDICOM_MAJOR = int(pydicom.__version__.split(".")[0])
+
+
+def series_dataset(patient_id, patient_name, study_date, series_number, size):
+    """
+    Returns a FileDataset for one series, with pixel data padded so that
+    each file will be roughly size bytes
+    """
+    meta = FileMetaDataset()
+    meta.MediaStorageSOPClassUID = CT_IMAGE_STORAGE
+    meta.MediaStorageSOPInstanceUID = generate_uid()
+    meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    ds = FileDataset(None, Dataset(), file_meta=meta, preamble=b"\0" * 128)
+    if PYDICOM_MAJOR < 3:
+        ds.is_little_endian = True
+        ds.is_implicit_VR = False
+    ds.SOPClassUID = CT_IMAGE_STORAGE
+    ds.ImageType = ["ORIGINAL", "PRIMARY", "AXIAL"]
+    ds.StudyDate = study_date
+    ds.Modality = "CT"
+    ds.Manufacturer = "Synthetic"
+    ds.ManufacturerModelName = "Benchmark"
+    ds.StationName = "BENCH01"
+    ds.StudyDescription = "Synthetic study"
+    ds.SeriesDescription = f"Series {series_number}"
+    ds.PatientName = patient_name
+    ds.PatientID = patient_id
+    ds.StudyInstanceUID = generate_uid()
+    ds.SeriesInstanceUID = generate_uid()
+    ds.SeriesNumber = series_number
+    ds.InstanceNumber = 1
+    columns = max(1, (size - 1024) // 2)
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = "MONOCHROME2"
+    ds.Rows = 1
+    ds.Columns = columns
+    ds.BitsAllocated = 16
+    ds.BitsStored = 16
+    ds.HighBit = 15
+    ds.PixelRepresentation = 0
+    ds.PixelData = bytes(2 * columns)
+    return ds
+
+
+def generate_tree(
+    root,
+    subjects=10,
+    visits=2,
+    series=3,
+    slices=20,
+    depth=0,
+    file_size=4096,
+    non_dicom=0.0,
+):
+    """
+    Writes a synthetic tree under root and returns the number of files
+    written as a tuple ( DICOMs, non-DICOMs ).
+    ---
+    root: pathlib.Path
+    subjects: int
+    visits: int - dates per subject
+    series: int - series per visit
+    slices: int - DICOMs per series
+    depth: int - extra directories between the date and the series
+    file_size: int - approximate size of each DICOM in bytes
+    non_dicom: float - share of files which aren't DICOMs, from 0 to 1
+    """
+    n_dicom = 0
+    n_other = 0
+    non_dicom_names = list(NON_DICOM)
+    # non-DICOM files are spread evenly through the tree, one every time
+    # the running share owed reaches a whole file
+    per_dicom = non_dicom / (1 - non_dicom) if non_dicom < 1 else 0
+    owed = 0.0
+    for s in range(subjects):
+        patient_id = f"{s + 1:06d}"
+        patient_name = f"SUBJECT{s + 1}^SYNTHETIC"
+        subject_dir = root / f"{patient_name}-{patient_id}"
+        for v in range(visits):
+            study_date = FIRST_DATE + timedelta(days=97 * v + s % 97)
+            study_date = study_date.strftime("%Y%m%d")
+            visit_dir = subject_dir / study_date
+            for d in range(depth):
+                visit_dir = visit_dir / f"sub{d + 1}"
+            for series_number in range(1, series + 1):
+                series_dir = visit_dir / f"Series {series_number}"
+                series_dir.mkdir(parents=True, exist_ok=True)
+                ds = series_dataset(
+                    patient_id, patient_name, study_date, series_number, file_size
+                )
+                for i in range(slices):
+                    uid = generate_uid()
+                    ds.SOPInstanceUID = uid
+                    ds.file_meta.MediaStorageSOPInstanceUID = uid
+                    ds.InstanceNumber = i + 1
+                    ds.save_as(series_dir / f"image-{i:05d}.dcm")
+                    n_dicom += 1
+                    owed += per_dicom
+                    while owed >= 1:
+                        name = non_dicom_names[n_other % len(non_dicom_names)]
+                        extra = series_dir / f"extra-{n_other:05d}-{name}"
+                        extra.write_bytes(NON_DICOM[name])
+                        n_other += 1
+                        owed -= 1
+    return n_dicom, n_other
+
+
+def main():
+    ap = argparse.ArgumentParser("Synthetic DICOM tree generator")
+    ap.add_argument("root", type=Path, help="Directory to write the tree to")
+    ap.add_argument("--subjects", type=int, default=10)
+    ap.add_argument("--visits", type=int, default=2)
+    ap.add_argument("--series", type=int, default=3)
+    ap.add_argument("--slices", type=int, default=20)
+    ap.add_argument("--depth", type=int, default=0)
+    ap.add_argument("--size", type=int, default=4096, help="DICOM size in bytes")
+    ap.add_argument("--nondicom", type=float, default=0.0, help="Share, 0 to 1")
+    args = ap.parse_args()
+    n_dicom, n_other = generate_tree(
+        args.root,
+        subjects=args.subjects,
+        visits=args.visits,
+        series=args.series,
+        slices=args.slices,
+        depth=args.depth,
+        file_size=args.size,
+        non_dicom=args.nondicom,
+    )
+    print(f"Wrote {n_dicom} DICOMs and {n_other} other files to {args.root}")
+
+
+if __name__ == "__main__":
+    main()
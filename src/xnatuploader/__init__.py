@@ -1,3 +1,18 @@
-from importlib.metadata import version
+from functools import cache
 
-__version__ = version(__name__)
+
+@cache
+def get_version():
+    """
+    Returns the installed version of xnatuploader. Looking this up reads the
+    package metadata, so it's only done when the version is first asked for.
+    """
+    from importlib.metadata import version
+
+    return version(__name__)
+
+
+def __getattr__(name):
+    if name == "__version__":
+        return get_version()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
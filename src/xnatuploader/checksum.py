@@ -0,0 +1,271 @@
+import hashlib
+import logging
+import mmap
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from xnatuploader.metrics import count
+
+logger = logging.getLogger(__name__)
+
+HASH_CHUNK_SIZE = 2**20
+
+# files at least this big are hashed through mmap rather than a buffer
+
+MMAP_THRESHOLD = 2**24
+
+CHECKSUM_WORKERS = min(4, os.cpu_count() or 1)
+
+# most digests to have waiting to be collected, so that files which are
+# prefetched and then never checked don't pile up
+
+MAX_PENDING = 10000
+
+# hidden spreadsheet column for digests computed by scan --checksums
+
+CHECKSUM_FIELD = "Checksum"
+
+_buffers = threading.local()
+
+
+def file_digest(filename, algorithm="md5", mmap_threshold=MMAP_THRESHOLD):
+    """
+    Returns the hex digest of a file. Small files are read into a buffer
+    which is reused by each thread, rather than a new bytes object for each
+    chunk, and large files are mapped into memory and hashed in one call.
+    hashlib releases the GIL while it hashes, so this can be run on several
+    threads at once.
+    ---
+    filename: str or pathlib.Path
+    algorithm: str - a hashlib algorithm name
+    mmap_threshold: int - size in bytes from which mmap is used
+
+    returns: str
+    """
+    file_hash = hashlib.new(algorithm)
+    with open(filename, "rb", buffering=0) as fh:
+        size = os.fstat(fh.fileno()).st_size
+        if size >= mmap_threshold and size > 0:
+            with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                file_hash.update(mm)
+            return file_hash.hexdigest()
+        buffer = getattr(_buffers, "buffer", None)
+        if buffer is None:
+            buffer = _buffers.buffer = memoryview(bytearray(HASH_CHUNK_SIZE))
+        while True:
+            n = fh.readinto(buffer)
+            if not n:
+                break
+            file_hash.update(buffer[:n])
+    return file_hash.hexdigest()
+
+
+class ChecksumEngine:
+    """
+    Computes file digests on a pool of threads. Files can be prefetched, so
+    that their digests are being worked out while something else is going
+    on, such as uploading them, and then collected with digest or digests.
+    A prefetched digest is only used if the file's size and modification
+    time haven't changed since it was submitted.
+
+    If there's a DigestCache, files whose digests are in it aren't read at
+    all, and the digests which are computed are added to it. Cache hits and
+    misses are counted when digests are collected, not when they're
+    prefetched, so that each file is only counted once.
+    """
+
+    def __init__(self, workers=CHECKSUM_WORKERS, algorithm="md5", cache=None):
+        """
+        workers: int
+        algorithm: str - a hashlib algorithm name
+        cache: DigestCache or None
+        """
+        self.workers = max(1, workers)
+        self.algorithm = algorithm
+        self.cache = cache
+        self.executor = None
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def submit(self, filename):
+        """
+        Start working out the digest of a file, and returns a Future for it
+        """
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(
+                    max_workers=self.workers, thread_name_prefix="checksum"
+                )
+            return self.executor.submit(file_digest, filename, self.algorithm)
+
+    def prefetch(self, filenames):
+        """
+        Submit the digests of some files which will be asked for later
+        ---
+        filenames: list of str
+        """
+        for filename in filenames:
+            st = stat(filename)
+            if st is None or self.cached(filename, st) is not None:
+                continue
+            key = self.key(filename, st)
+            with self.lock:
+                if key in self.pending or len(self.pending) >= MAX_PENDING:
+                    continue
+            future = self.submit(filename)
+            with self.lock:
+                self.pending[key] = future
+
+    def digests(self, filenames, use_cache=True):
+        """
+        Returns the digests of a list of files, computed in parallel, using
+        any which were prefetched. Raises the OSError from the first file
+        which couldn't be read.
+        ---
+        filenames: list of str
+        use_cache: bool - False for temporary files, which shouldn't go in
+            the DigestCache
+
+        returns: dict of { str: str }
+        """
+        digests = {}
+        futures = {}
+        stats = {}
+        for filename in filenames:
+            st = stat(filename)
+            if st is not None and use_cache:
+                digest = self.cached(filename, st)
+                if self.cache is not None:
+                    count("digest_cache", "miss" if digest is None else "hit")
+                if digest is not None:
+                    digests[filename] = digest
+                    continue
+                stats[filename] = st
+            with self.lock:
+                future = self.pending.pop(self.key(filename, st), None)
+            if future is None:
+                future = self.submit(filename)
+            futures[filename] = future
+        for filename, future in futures.items():
+            digests[filename] = future.result()
+        if self.cache is not None and use_cache:
+            self.cache.store(
+                [(f, stats[f], digests[f]) for f in futures if f in stats],
+                self.algorithm,
+            )
+        return {filename: digests[filename] for filename in filenames}
+
+    def digest(self, filename):
+        return self.digests([filename])[filename]
+
+    def cached(self, filename, st):
+        if self.cache is None:
+            return None
+        return self.cache.lookup(filename, st, self.algorithm)
+
+    def key(self, filename, st):
+        if st is None:
+            return None
+        return (str(filename), st.st_size, st.st_mtime_ns)
+
+    def close(self):
+        with self.lock:
+            for future in self.pending.values():
+                future.cancel()
+            self.pending = {}
+            if self.executor is not None:
+                self.executor.shutdown(wait=True)
+                self.executor = None
+
+
+def stat(filename):
+    try:
+        return os.stat(filename)
+    except OSError:
+        return None
+
+
+def add_scan_checksums(files, engine=None):
+    """
+    Work out the MD5 digests of a list of files in parallel and store them
+    in the Checksum field, with each file's size and modification time, so
+    that upload can use them if the file hasn't changed. The files are
+    stat-ed before they're read, so a file which changes while it's being
+    read won't match later.
+    ---
+    files: list of FileMatch
+    engine: ChecksumEngine or None for the shared engine
+    """
+    engine = engine or get_engine()
+    stats = {file.file: stat(file.file) for file in files}
+    readable = [f for f, st in stats.items() if st is not None]
+    digests = engine.digests(readable)
+    for file in files:
+        st = stats[file.file]
+        if st is not None:
+            file[CHECKSUM_FIELD] = f"{digests[file.file]} {st.st_size} {st.st_mtime_ns}"
+
+
+def scan_digest(file):
+    """
+    Returns the digest recorded for a file by scan --checksums, or None if
+    there isn't one or the file's size or modification time have changed
+    ---
+    file: FileMatch
+
+    returns: str or None
+    """
+    value = file.get(CHECKSUM_FIELD)
+    if not value:
+        return None
+    try:
+        digest, size, mtime_ns = str(value).split()
+        size, mtime_ns = int(size), int(mtime_ns)
+    except ValueError:
+        return None
+    st = stat(file.file)
+    if st is None or st.st_size != size or st.st_mtime_ns != mtime_ns:
+        return None
+    return digest
+
+
+_engine = None
+_cache = None
+_engine_lock = threading.Lock()
+
+
+def get_engine():
+    """
+    Returns the ChecksumEngine which is shared by all of the uploads in this
+    process, creating it the first time
+    """
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = ChecksumEngine(cache=_cache)
+        return _engine
+
+
+def set_digest_cache(cache):
+    """
+    Set the DigestCache used by the shared ChecksumEngine, or None to stop
+    using one. Returns the cache which was being used.
+    """
+    global _cache
+    with _engine_lock:
+        previous = _cache
+        _cache = cache
+        if _engine is not None:
+            _engine.cache = cache
+    return previous
+
+
+def get_digest_cache():
+    return _cache
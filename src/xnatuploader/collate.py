@@ -0,0 +1,227 @@
+import logging
+
+from xnatuploader.matcher import ExtractException
+from xnatuploader.dicoms import dicom_extractor
+from xnatuploader.upload import Upload
+from xnatuploader.extsort import ExternalSorter, RUN_SIZE
+from xnatuploader.profiling import phase
+from xnatuploader.dedup import is_duplicate
+
+logger = logging.getLogger(__name__)
+
+
+def collate_uploads(files, strict_scan_ids, check=None, visits=None):
+    """
+    Takes a list of files and collates them by subject (patient), visit
+    index (starting from the earliest), scan type, and (optionally) scan_id,
+    returning a list of files which have skipped or already uploaded and a dictionary
+    of Uploads keyed by {session_label}_{scan_id}
+
+    ---
+    files: list of FileMatch
+    check: fn used to test that a file is safe to upload - defaults to
+           check_safe_dicom, can be a VerdictCache wrapping it
+    visits: dict of { str: { str: int } } - visit numbers already given to
+           each subject's study dates by earlier batches. New dates are
+           numbered after these, and added to it.
+
+    returns: tuple of ( list of FileMatch, dict of str: Upload )
+    """
+
+    subjects = {}
+    skip = []
+    for file in files:
+        if skip_upload(file, check):
+            skip.append(file)
+        else:
+            if file["Subject"] not in subjects:
+                subjects[file["Subject"]] = []
+            subjects[file["Subject"]].append(file)
+    uploads = {}
+    for subject_id, files in subjects.items():
+        known = None if visits is None else visits.setdefault(subject_id, {})
+        collate_subject(subject_id, files, strict_scan_ids, uploads, known)
+    return skip, uploads
+
+
+def collate_uploads_external(
+    files, strict_scan_ids, matcher, workdir=None, run_size=RUN_SIZE
+):
+    """
+    An out-of-core version of collate_uploads for file lists which are too
+    big to hold in memory. Files to be uploaded are spilled to sorted run
+    files on disk, keyed by subject and their original position in the list,
+    and then merged back one subject at a time. Visit numbers and dataset
+    names only depend on the files for one subject, so the Uploads are the
+    same as the ones collate_uploads would build.
+
+    This is a generator which yields a tuple ( skip, uploads ) for each
+    batch: skipped files are yielded in batches of up to run_size with no
+    uploads, followed by the uploads for each subject in turn.
+    ---
+    files: iterable of FileMatch
+    strict_scan_ids: boolean
+    matcher: the Matcher which is used to rebuild files from the runs
+    workdir: pathlib.Path or None - where to write the run files
+    run_size: int - the number of files to hold in memory while sorting
+
+    returns: generator of tuple of ( list of FileMatch, dict of str: Upload )
+    """
+    with ExternalSorter(workdir, run_size) as sorter:
+        skip = []
+        for n, file in enumerate(files):
+            if skip_upload(file):
+                skip.append(file)
+                if len(skip) >= run_size:
+                    yield skip, {}
+                    skip = []
+            else:
+                sorter.add([str(file["Subject"]), n], file.columns)
+        if skip:
+            yield skip, {}
+        subject = None
+        subject_files = []
+        for key, row in sorter.merged():
+            if key[0] != subject and subject_files:
+                yield [], collate_subject_files(subject_files, strict_scan_ids)
+                subject_files = []
+            subject = key[0]
+            subject_files.append(matcher.from_spreadsheet(row))
+        if subject_files:
+            yield [], collate_subject_files(subject_files, strict_scan_ids)
+
+
+def collate_subject_files(files, strict_scan_ids):
+    """
+    Collate a list of files which all belong to the same subject and
+    return a dict of Uploads.
+    ---
+    files: list of FileMatch
+
+    returns: dict of str: Upload
+    """
+    uploads = {}
+    collate_subject(files[0]["Subject"], files, strict_scan_ids, uploads)
+    return uploads
+
+
+def skip_upload(file, check=None):
+    """
+    Returns True if a file shouldn't be uploaded, because it hasn't been
+    selected, has already been uploaded, was found to be a duplicate of
+    another file or isn't a safe DICOM
+    ---
+    file: FileMatch
+    check: fn used to test that a file is safe to upload
+
+    returns: boolean
+    """
+    if not file.selected:
+        return True
+    if file.status == "success":
+        logger.debug(f"skipping file already uploaded {file.file}")
+        return True
+    if is_duplicate(file):
+        logger.debug(f"skipping duplicate file {file.file}")
+        return True
+    if check is None:
+        check = check_safe_dicom
+    if not check(file):
+        return True
+    return False
+
+
+def collate_subject(subject_id, files, strict_scan_ids, uploads, visits=None):
+    """
+    Assigns visit numbers and session labels to all the files for a single
+    subject, and adds them to the Uploads in the uploads dict, creating
+    new Uploads as required.
+
+    If visits is passed, dates which are already in it keep their visit
+    numbers, and new dates are numbered after them and added to it.
+    ---
+    subject_id: str
+    files: list of FileMatch
+    strict_scan_ids: boolean
+    uploads: dict of str: Upload
+    visits: dict of { str: int } or None
+    """
+    if visits is None:
+        visits = {}
+    dates = sorted(set([file.study_date for file in files]))
+    for date in dates:
+        if date not in visits:
+            if visits and date < max(visits):
+                logger.warning(
+                    f"{subject_id} {date} is earlier than visits which have "
+                    "already been numbered"
+                )
+            visits[date] = max(visits.values(), default=0) + 1
+    clean_datasets = sanitise_dataset_names(files)
+    for file in files:
+        visit = visits[file.study_date]
+        modality = file.modality
+        scan_id = file.series_number
+        if strict_scan_ids:
+            session_label = f"{subject_id}_{modality}{visit}_{scan_id}"
+        else:
+            session_label = f"{subject_id}_{modality}{visit}"
+        file.session_label = session_label
+        scan_type = clean_datasets[file.dataset]
+        session_scan = f"{session_label}:{scan_type}"
+        if session_scan not in uploads:
+            uploads[session_scan] = Upload(
+                session_label=session_label,
+                subject=subject_id,
+                date=file.study_date,
+                modality=modality,
+                series_number=scan_id,
+                scan_type=scan_type,
+                strict_scan_ids=strict_scan_ids,
+                manufacturer=file.manufacturer,
+                model=file.model,
+            )
+        uploads[session_scan].add_file(file)
+
+
+def sanitise_dataset_names(files):
+    """
+    For a list of files, sanitise the .dataset values (replace characters which
+    XNAT doesn't allow in a resource id with '_') and then make sure that the
+    datasets are all still unique by appending 1, 2, etc to them.
+
+    Returns a dict which maps the original datasets to sanitised values
+    ---
+    files: list of FileMatch
+
+    returns: dict of str: str
+    """
+    from xnatutils.base import sanitize_re
+
+    clean = {}
+    used = []
+    for file in files:
+        if file.dataset not in clean:
+            base = sanitize_re.sub("_", file.dataset)
+            sanitised = base
+            i = 1
+            while sanitised in used:
+                i += 1
+                sanitised = base + str(i)
+            clean[file.dataset] = sanitised
+            used.append(sanitised)
+    return clean
+
+
+def check_safe_dicom(file):
+    """Extra test to make sure that we don't try to upload a dicom with one
+    of the forbidden conditions, even though this is tested for at scan time"""
+    try:
+        with phase("extract"):
+            dicom_extractor(file.file)
+        return True
+    except ExtractException as e:
+        logger.warning(f"Skipping bad file {file.file}: {e}")
+    except Exception as e:
+        logger.warning(f"Can't upload {file.file}: {e}")
+    return False
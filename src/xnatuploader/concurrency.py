@@ -0,0 +1,111 @@
+import logging
+import statistics
+from collections import deque
+
+from xnatuploader.metrics import count, gauge
+
+logger = logging.getLogger(__name__)
+
+MIN_WORKERS = 1
+LATENCY_TOLERANCE = 2.0
+ERROR_THRESHOLD = 0.1
+DECREASE_FACTOR = 0.5
+BASELINE_WINDOWS = 10
+
+
+class AIMDController:
+    """
+    Decides how many files can be uploading at once, using additive
+    increase / multiplicative decrease on the latency and error rate of
+    completed uploads, like TCP's congestion control.
+
+    Uploads are looked at in rounds of as many files as the current limit.
+    At the end of a round, if the share of files which needed a retry or
+    failed is over error_threshold, or the median upload time is more than
+    tolerance times the baseline, the limit is multiplied by decrease.
+    Otherwise it goes up by one. The baseline is the lowest round median in
+    the last BASELINE_WINDOWS rounds, so it follows the server if it gets
+    slower or faster for a long time.
+
+    Only files which were started after the last change count towards a
+    round, so that uploads which were already in flight when the limit was
+    cut don't cut it again.
+    """
+
+    def __init__(
+        self,
+        min_workers=MIN_WORKERS,
+        max_workers=MIN_WORKERS,
+        tolerance=LATENCY_TOLERANCE,
+        error_threshold=ERROR_THRESHOLD,
+        decrease=DECREASE_FACTOR,
+    ):
+        """
+        min_workers: int
+        max_workers: int
+        tolerance: float - how much slower than the baseline a round can be
+        error_threshold: float - share of files from 0 to 1
+        decrease: float - factor by which the limit is cut
+        """
+        self.min_workers = max(1, min_workers)
+        self.max_workers = max(self.min_workers, max_workers)
+        self.tolerance = tolerance
+        self.error_threshold = error_threshold
+        self.decrease = decrease
+        self.limit = self.min_workers
+        self.epoch = 0
+        self.latencies = []
+        self.errors = 0
+        self.medians = deque(maxlen=BASELINE_WINDOWS)
+        gauge("upload_concurrency", self.limit)
+
+    @property
+    def baseline(self):
+        return min(self.medians) if self.medians else None
+
+    def record(self, epoch, latency, ok):
+        """
+        Record a completed upload, and adjust the limit if it completes a
+        round
+        ---
+        epoch: int - the controller's epoch when the upload was started
+        latency: float - seconds
+        ok: bool - False if the upload needed a retry or failed
+        """
+        if epoch != self.epoch:
+            return
+        self.latencies.append(latency)
+        if not ok:
+            self.errors += 1
+        if len(self.latencies) >= self.limit:
+            self.adjust()
+
+    def adjust(self):
+        median = statistics.median(self.latencies)
+        error_rate = self.errors / len(self.latencies)
+        baseline = self.baseline
+        self.medians.append(median)
+        if error_rate > self.error_threshold:
+            reason = f"error rate {error_rate:.0%}"
+            limit = int(self.limit * self.decrease)
+        elif baseline is not None and median > baseline * self.tolerance:
+            reason = f"median latency {median:.2f}s, baseline {baseline:.2f}s"
+            limit = int(self.limit * self.decrease)
+        else:
+            reason = f"median latency {median:.2f}s"
+            limit = self.limit + 1
+        self.set_limit(limit, reason)
+
+    def set_limit(self, limit, reason):
+        limit = min(self.max_workers, max(self.min_workers, limit))
+        self.latencies = []
+        self.errors = 0
+        if limit == self.limit:
+            return
+        direction = "increase" if limit > self.limit else "decrease"
+        log = logger.info if direction == "increase" else logger.warning
+        log(f"Concurrent uploads {self.limit} -> {limit}: {reason}")
+        count("concurrency_changes", direction)
+        gauge("upload_concurrency", limit)
+        self.limit = limit
+        self.epoch += 1
@@ -0,0 +1,115 @@
+import logging
+
+from xnatuploader.checksum import get_engine, scan_digest, stat
+from xnatuploader.dicoms import sop_instance_uid
+from xnatuploader.metrics import count
+
+logger = logging.getLogger(__name__)
+
+DUPLICATE_STATUS = "duplicate of "
+
+
+def is_duplicate(file):
+    """
+    Returns True if a file was marked as a copy of another one by an
+    earlier dedup
+    ---
+    file: FileMatch
+
+    returns: boolean
+    """
+    return str(file.status or "").startswith(DUPLICATE_STATUS)
+
+
+def find_duplicates(files, digests, uid=sop_instance_uid):
+    """
+    Groups files by content digest and SOPInstanceUID and returns the ones
+    which are copies of an earlier file in the list. The UID is only read
+    from files whose digest is shared with another file, and files whose UID
+    can't be read are never treated as copies.
+    ---
+    files: list of FileMatch
+    digests: dict of { str filename: str digest }
+    uid: fn which returns the SOPInstanceUID of a filename, or None
+
+    returns: dict of { str filename: FileMatch original }
+    """
+    by_digest = {}
+    for file in files:
+        by_digest.setdefault(digests[file.file], []).append(file)
+    duplicates = {}
+    for group in by_digest.values():
+        if len(group) < 2:
+            continue
+        originals = {}
+        for file in group:
+            key = uid(file.file)
+            if key is None:
+                continue
+            if key in originals:
+                duplicates[file.file] = originals[key]
+            else:
+                originals[key] = file
+    return duplicates
+
+
+def dedup_uploads(uploads, engine=None):
+    """
+    Find files which are byte-for-byte copies of the same DICOM instance
+    across all of a batch's Uploads, and take all but the first copy out of
+    them, so that only one is uploaded. The copies are given a status of
+    "duplicate of" the file which is kept, and returned so that they can be
+    written out with the skipped files. Uploads which are left with no files
+    are removed.
+
+    Digests recorded by scan --checksums are used if the files haven't
+    changed, and the rest are computed with the ChecksumEngine.
+    ---
+    uploads: dict of { str: Upload }
+    engine: ChecksumEngine or None for the shared engine
+
+    returns: list of FileMatch
+    """
+    files = [file for upload in uploads.values() for file in upload.files]
+    if len(files) < 2:
+        return []
+    digests = {}
+    unknown = []
+    for file in files:
+        digest = scan_digest(file)
+        if digest is None:
+            unknown.append(file.file)
+        else:
+            digests[file.file] = digest
+    readable = [filename for filename in unknown if stat(filename) is not None]
+    digests.update((engine or get_engine()).digests(readable))
+    for filename in unknown:
+        if filename not in digests:
+            # unreadable files are left for the upload to fail on
+            digests[filename] = f"unreadable:{filename}"
+    duplicates = find_duplicates(files, digests)
+    skipped = []
+    saved = 0
+    for key, upload in list(uploads.items()):
+        kept = []
+        for file in upload.files:
+            original = duplicates.get(file.file)
+            if original is None:
+                kept.append(file)
+                continue
+            logger.debug(f"{file.file} is a duplicate of {original.file}")
+            file.status = f"{DUPLICATE_STATUS}{original.file}"
+            st = stat(file.file)
+            saved += st.st_size if st is not None else 0
+            skipped.append(file)
+        upload.files = kept
+        if not kept:
+            del uploads[key]
+    if skipped:
+        count("duplicates_skipped", n=len(skipped))
+        count("duplicate_bytes", n=saved)
+        logger.info(
+            f"Skipping {len(skipped)} duplicate files, saving "
+            f"{saved / 2**20:.1f} MB"
+        )
+    return skipped
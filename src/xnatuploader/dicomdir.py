@@ -0,0 +1,172 @@
+import logging
+import os
+
+from xnatuploader.dicoms import dicom_extractor, dicom_values, DICOM_PARAMS
+from xnatuploader.metrics import count
+
+logger = logging.getLogger(__name__)
+
+DICOMDIR = "DICOMDIR"
+
+# values which must be in the index for a file not to be opened: the ones
+# which the files are collated by
+
+INDEX_REQUIRED = ["Modality", "SeriesNumber", "StudyDate"]
+
+# attributes which are looked up in the index as well as DICOM_PARAMS, for
+# the checks in dicom_values
+
+INDEX_CHECKS = ["ImageType"]
+
+
+def index_required(mappings):
+    """
+    Returns the attributes which have to be in a DICOMDIR for a file to be
+    extracted from it: INDEX_REQUIRED and any DICOM values in the mappings
+    ---
+    mappings: dict of { str: list of str } from the config
+
+    returns: list of str
+    """
+    required = list(INDEX_REQUIRED)
+    for fields in mappings.values():
+        for field in fields:
+            if field.startswith("DICOM:") and field[6:] not in required:
+                required.append(field[6:])
+    return required
+
+
+def read_dicomdir(path):
+    """
+    Reads a DICOMDIR and returns the values recorded for each of the image
+    files it refers to, from the image record and the series, study and
+    patient records above it. Returns an empty index if the DICOMDIR can't
+    be read.
+    ---
+    path: str - the DICOMDIR file
+
+    returns: dict of { str: dict of { str: value } } keyed by index_key
+    """
+    from pydicom import dcmread
+    from pydicom.fileset import FileSet
+
+    index = {}
+    try:
+        fileset = FileSet(dcmread(path))
+        for instance in fileset:
+            if instance.node.record_type != "IMAGE":
+                continue
+            values = {}
+            for keyword in DICOM_PARAMS + INDEX_CHECKS:
+                if keyword in instance:
+                    value = instance[keyword].value
+                    if value not in (None, ""):
+                        values[keyword] = value
+            index[index_key(instance.path)] = values
+    except Exception as e:
+        logger.warning(f"Can't read {path}, opening the files it lists: {e}")
+    logger.debug(f"{path} lists {len(index)} images")
+    return index
+
+
+def index_key(path):
+    """
+    DICOMDIR file IDs are upper case, but discs are often mounted with
+    lower case names, so paths are compared without case
+    """
+    return os.path.normpath(os.fspath(path)).lower()
+
+
+class DicomdirExtractor:
+    """
+    A file_extractor for the Matcher which gets a file's DICOM values from
+    the DICOMDIR in its directory or the closest one above it, up to the
+    scan root, if there is one, and only opens the file itself if it isn't in the index, has been
+    modified since the DICOMDIR was written, or the index doesn't have all
+    of the required values. Each directory is only checked for a DICOMDIR
+    once, and each DICOMDIR is only read once.
+
+    Values which aren't required, such as the manufacturer and station
+    name, are left blank if the index doesn't have them. The index has no
+    record of encapsulated documents, so files are checked again before
+    they're uploaded, as they always are.
+    """
+
+    def __init__(self, extractor=dicom_extractor, required=INDEX_REQUIRED, root=None):
+        """
+        extractor: fn - the file_extractor for files which aren't indexed
+        required: list of str - DICOM attributes which must be in the index
+        root: pathlib.Path or None - the directory being scanned. DICOMDIRs
+            above it aren't used.
+        """
+        self.extractor = extractor
+        self.required = required
+        self.root = None if root is None else os.path.abspath(root)
+        self.dicomdirs = {}
+        self.indexes = {}
+
+    def __call__(self, filepath):
+        values = self.lookup(filepath)
+        if values is None:
+            return self.extractor(filepath)
+        count("dicomdir", "indexed")
+        return dicom_values(values)
+
+    def lookup(self, filepath):
+        """
+        Returns the indexed values for a file, or None if it has to be opened
+        ---
+        filepath: pathlib.Path
+
+        returns: dict of { str: value } or None
+        """
+        dicomdir = self.find_dicomdir(os.path.dirname(os.path.abspath(filepath)))
+        if dicomdir is None:
+            count("dicomdir", "no_index")
+            return None
+        mtime_ns, index = self.indexes[dicomdir]
+        values = index.get(index_key(os.path.abspath(filepath)))
+        if values is None:
+            count("dicomdir", "unlisted")
+            return None
+        if any(keyword not in values for keyword in self.required):
+            count("dicomdir", "incomplete")
+            return None
+        if os.stat(filepath).st_mtime_ns > mtime_ns:
+            logger.debug(f"{filepath} is newer than {dicomdir}")
+            count("dicomdir", "stale")
+            return None
+        return values
+
+    def find_dicomdir(self, directory):
+        """
+        Returns the path of the DICOMDIR in a directory or the closest one
+        above it, stopping at the root, reading it if it hasn't been read
+        yet, or None
+        ---
+        directory: str - an absolute path
+
+        returns: str or None
+        """
+        visited = []
+        dicomdir = None
+        while True:
+            if directory in self.dicomdirs:
+                dicomdir = self.dicomdirs[directory]
+                break
+            visited.append(directory)
+            candidate = os.path.join(directory, DICOMDIR)
+            if os.path.isfile(candidate):
+                dicomdir = candidate
+                self.indexes[dicomdir] = (
+                    os.stat(candidate).st_mtime_ns,
+                    read_dicomdir(candidate),
+                )
+                break
+            parent = os.path.dirname(directory)
+            if parent == directory or directory == self.root:
+                break
+            directory = parent
+        for path in visited:
+            self.dicomdirs[path] = dicomdir
+        return dicomdir
@@ -1,6 +1,5 @@
 import logging
-from pydicom import dcmread
-from pydicom.errors import InvalidDicomError
+import struct
 from xnatuploader.matcher import ExtractException, FileMatch
 
 DICOM_PARAMS = [
@@ -24,8 +23,85 @@ SPREADSHEET_FIELDS = [
     "DICOM:StudyDescription",
 ]
 
+# a DICOM file has a 128 byte preamble followed by "DICM"
+
+DICOM_MAGIC = b"DICM"
+DICOM_MAGIC_OFFSET = 128
+DICOM_HEADER_SIZE = DICOM_MAGIC_OFFSET + len(DICOM_MAGIC)
+
+# signatures of files which are often found alongside DICOMs
+
+SIGNATURES = [
+    (b"%PDF", "a PDF document"),
+    (b"\xff\xd8\xff", "a JPEG image"),
+    (b"\x89PNG\r\n\x1a\n", "a PNG image"),
+    (b"GIF87a", "a GIF image"),
+    (b"GIF89a", "a GIF image"),
+    (b"II*\x00", "a TIFF image"),
+    (b"MM\x00*", "a TIFF image"),
+    (b"PK\x03\x04", "a zip archive"),
+    (b"\x1f\x8b", "a gzip archive"),
+    (b"7z\xbc\xaf\x27\x1c", "a 7-zip archive"),
+    (b"Rar!", "a RAR archive"),
+    (b"\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1", "a Microsoft Office document"),
+    (b"{\\rtf", "an RTF document"),
+    (b"<?xml", "an XML document"),
+    (b"<!DOCTYPE html", "an HTML document"),
+    (b"<html", "an HTML document"),
+]
+
+# legacy DICOMs with no preamble usually start with the file meta group or
+# the identifying group
+
+LEGACY_GROUPS = (0x0002, 0x0008)
+
 logger = logging.getLogger(__name__)
 
+_legacy_dicom = False
+
+
+def set_legacy_dicom(legacy):
+    """
+    Set whether files with no DICM preamble are read as DICOMs if they look
+    like they start with a DICOM element. Returns the previous setting.
+    ---
+    legacy: boolean
+    """
+    global _legacy_dicom
+    previous = _legacy_dicom
+    _legacy_dicom = legacy
+    return previous
+
+
+def sniff_dicom(header, legacy=False):
+    """
+    Checks the start of a file for the DICM marker, without calling pydicom.
+    Returns True if the file has a preamble, or False if legacy is True and
+    the file has no preamble but starts with a plausible DICOM element.
+    Raises ExtractException with the reason if it can't be a DICOM,
+    naming the file type if it has a common non-DICOM signature.
+    ---
+    header: bytes - at least the first DICOM_HEADER_SIZE bytes of the file,
+        or all of it if it's shorter
+    legacy: boolean
+
+    returns: boolean
+
+    raises: ExtractException
+    """
+    if not header:
+        raise ExtractException("File is empty", "empty")
+    if header[DICOM_MAGIC_OFFSET:DICOM_HEADER_SIZE] == DICOM_MAGIC:
+        return True
+    for signature, name in SIGNATURES:
+        if header.startswith(signature):
+            raise ExtractException(f"File is {name}, not a DICOM", "not_dicom")
+    if legacy and len(header) >= 8:
+        group, element = struct.unpack("<HH", header[:4])
+        if group in LEGACY_GROUPS:
+            return False
+    raise ExtractException("File is not a DICOM", "not_dicom")
+
 
 def dicom_extractor(file):
     """
@@ -35,7 +111,9 @@ def dicom_extractor(file):
     XNAT break on metadata extraction)
 
     Raises ExtractException if the file is not a DICOM, has an embedded
-    report or the wrong modality
+    report or the wrong modality. Files which don't have the DICM marker are
+    rejected by sniff_dicom before pydicom is imported, unless legacy DICOMs
+    have been turned on with set_legacy_dicom.
     ---
     file: pathlib.Path
 
@@ -43,26 +121,73 @@ def dicom_extractor(file):
 
     raises: ExtractException
     """
-    values = None
-    dc_meta = None
-    try:
-        dc_meta = dcmread(file)
-    except InvalidDicomError:
-        raise ExtractException("File is not a DICOM")
+    with open(file, "rb") as fh:
+        preamble = sniff_dicom(fh.read(DICOM_HEADER_SIZE), _legacy_dicom)
+        fh.seek(0)
+        from pydicom import dcmread
+        from pydicom.errors import InvalidDicomError
+
+        try:
+            dc_meta = dcmread(fh, force=not preamble)
+        except InvalidDicomError:
+            raise ExtractException("File is not a DICOM", "not_dicom")
+        except Exception as e:
+            if preamble:
+                raise
+            raise ExtractException(f"File is not a legacy DICOM: {e}", "not_dicom")
+    return dicom_values(dc_meta)
+
+
+def dicom_values(dc_meta):
+    """
+    Does the checks described in dicom_extractor on a DICOM's attributes and
+    returns the values which are recorded in the spreadsheet
+    ---
+    dc_meta: a pydicom Dataset, or anything with a get method which returns
+        the value of an attribute by keyword
+
+    returns: {str: str}
+
+    raises: ExtractException
+    """
     if dc_meta.get("EncapsulatedDocument"):
-        raise ExtractException("DICOM is an encapsulated report")
+        raise ExtractException("DICOM is an encapsulated report", "encapsulated")
     values = {f"DICOM:{p}": dc_meta.get(p) for p in DICOM_PARAMS}
     if "DICOM:Modality" not in values:
-        raise ExtractException("DICOM has no modality")
+        raise ExtractException("DICOM has no modality", "no_modality")
     if values["DICOM:Modality"] == "SR":
-        raise ExtractException("DICOM is an SR (structured report)")
+        raise ExtractException(
+            "DICOM is an SR (structured report)", "structured_report"
+        )
     image_type = dc_meta.get("ImageType")
     if image_type is not None:
         if len(image_type) > 2 and image_type[2] == "DOSE_INFO":
-            raise ExtractException("DICOM has ImageType DOSE_INFO")
+            raise ExtractException("DICOM has ImageType DOSE_INFO", "dose_info")
     return values
 
 
+def sop_instance_uid(file):
+    """
+    Returns a DICOM's SOPInstanceUID, reading only as far into the file as
+    it needs to, or None if it can't be read or doesn't have one
+    ---
+    file: str or pathlib.Path
+
+    returns: str or None
+    """
+    from pydicom import dcmread
+
+    try:
+        dc_meta = dcmread(
+            file, stop_before_pixels=True, specific_tags=["SOPInstanceUID"]
+        )
+    except Exception as e:
+        logger.debug(f"Couldn't read SOPInstanceUID from {file}: {e}")
+        return None
+    uid = dc_meta.get("SOPInstanceUID")
+    return str(uid) if uid else None
+
+
 class XNATFileMatch(FileMatch):
     """
     Sublass of FileMatch which provides getters and setters for xnat-specific
@@ -79,7 +204,7 @@ class XNATFileMatch(FileMatch):
             if dicom_values is not None:
                 for key, value in dicom_values.items():
                     self[key] = value
-        except ExtractException as e:
+        except (ExtractException, OSError) as e:
             logger.debug(f"DICOM extraction failed: {e}")
 
     # session_label gets constructed by the calling code in xnatuploader,
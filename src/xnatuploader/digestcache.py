@@ -0,0 +1,128 @@
+import logging
+import os
+import sqlite3
+import threading
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+DIGEST_CACHE_VERSION = 1
+BUSY_TIMEOUT = 60
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT NOT NULL,
+    algorithm TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    inode INTEGER NOT NULL,
+    digest TEXT NOT NULL,
+    PRIMARY KEY (path, algorithm)
+);
+"""
+
+
+class DigestCacheError(Exception):
+    pass
+
+
+def default_cache_path():
+    """
+    Returns the default location of the digest cache, in the user's cache
+    directory
+    """
+    cache_home = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+    return Path(cache_home) / "xnatuploader" / "digests.db"
+
+
+class DigestCache:
+    """
+    A local SQLite database of file digests which persists between runs, so
+    that files which haven't changed aren't read again to check them. A
+    digest is keyed by the file's path, size, modification time and inode,
+    and is only used if all of them are the same as when it was stored.
+
+    The database is opened in WAL mode, which needs a local disk, and can be
+    shared by several processes.
+    """
+
+    def __init__(self, path, timeout=BUSY_TIMEOUT):
+        """
+        path: pathlib.Path - created if it doesn't exist
+        timeout: float - seconds to wait for another process's lock
+        """
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(self.path, timeout=timeout, check_same_thread=False)
+        try:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            with self.db:
+                self.db.executescript(SCHEMA)
+                self.db.execute(
+                    "INSERT OR IGNORE INTO meta VALUES ('version', ?)",
+                    (str(DIGEST_CACHE_VERSION),),
+                )
+            row = self.db.execute(
+                "SELECT value FROM meta WHERE key = 'version'"
+            ).fetchone()
+        except sqlite3.DatabaseError as e:
+            raise DigestCacheError(f"{self.path} isn't a digest cache: {e}")
+        if row[0] != str(DIGEST_CACHE_VERSION):
+            raise DigestCacheError(f"{self.path} is from a different version")
+        logger.debug(f"Using digest cache {self.path}")
+
+    def lookup(self, filename, st, algorithm="md5"):
+        """
+        Returns the cached digest of a file, or None if there isn't one or
+        the file has changed since it was stored
+        ---
+        filename: str
+        st: os.stat_result for the file
+        algorithm: str
+
+        returns: str or None
+        """
+        with self.lock:
+            row = self.db.execute(
+                "SELECT digest FROM files WHERE path = ? AND algorithm = ? "
+                "AND size = ? AND mtime_ns = ? AND inode = ?",
+                (
+                    os.path.abspath(filename),
+                    algorithm,
+                    st.st_size,
+                    st.st_mtime_ns,
+                    st.st_ino,
+                ),
+            ).fetchone()
+        return row[0] if row else None
+
+    def store(self, entries, algorithm="md5"):
+        """
+        Store the digests of some files
+        ---
+        entries: list of ( str filename, os.stat_result, str digest )
+        algorithm: str
+        """
+        if not entries:
+            return
+        with self.lock, self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (
+                        os.path.abspath(filename),
+                        algorithm,
+                        st.st_size,
+                        st.st_mtime_ns,
+                        st.st_ino,
+                        digest,
+                    )
+                    for filename, st, digest in entries
+                ],
+            )
+
+    def close(self):
+        with self.lock:
+            self.db.close()
@@ -0,0 +1,92 @@
+import heapq
+import json
+import logging
+import tempfile
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+RUN_SIZE = 100000
+
+
+class ExternalSorter:
+    """
+    An on-disk merge sort for lists of rows which are too large to hold in
+    memory. Rows are added with a sort key, buffered until there are run_size
+    of them, and then sorted and spilled to a run file in a temporary
+    directory. merged() returns all of the rows in key order by merging the
+    runs.
+
+    Keys and rows are stored as JSON, so they should be lists of strings,
+    numbers and None. Keys are compared as lists, so every key should have
+    the same shape.
+
+    Use it as a context manager so that the run files are cleaned up:
+
+        with ExternalSorter(workdir) as sorter:
+            for key, row in rows:
+                sorter.add(key, row)
+            for key, row in sorter.merged():
+                ...
+    """
+
+    def __init__(self, workdir=None, run_size=RUN_SIZE):
+        """
+        workdir: pathlib.Path or None - where to create the temporary dir
+        run_size: int - how many rows to hold in memory before spilling
+        """
+        self.workdir = workdir
+        self.run_size = run_size
+        self.buffer = []
+        self.runs = []
+        self._tempdir = None
+
+    def __enter__(self):
+        self._tempdir = tempfile.TemporaryDirectory(dir=self.workdir)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._tempdir.cleanup()
+        self._tempdir = None
+
+    def add(self, key, row):
+        """
+        Add a row to the sorter, spilling the buffer if it's full
+        ---
+        key: list
+        row: list
+        """
+        self.buffer.append((list(key), row))
+        if len(self.buffer) >= self.run_size:
+            self.spill()
+
+    def spill(self):
+        """
+        Sort the buffered rows and write them to a new run file
+        """
+        if not self.buffer:
+            return
+        run = Path(self._tempdir.name) / f"run-{len(self.runs):06d}.jsonl"
+        logger.debug(f"Spilling {len(self.buffer)} rows to {run}")
+        self.buffer.sort(key=lambda kr: kr[0])
+        with open(run, "w") as fh:
+            for key, row in self.buffer:
+                fh.write(json.dumps([key, row], default=str) + "\n")
+        self.runs.append(run)
+        self.buffer = []
+
+    def merged(self):
+        """
+        Generator which yields every (key, row) pair which has been added,
+        in key order. Rows with equal keys come out in the order they were
+        added.
+        """
+        self.spill()
+        handles = [open(run, "r") for run in self.runs]
+        try:
+            streams = [(json.loads(line) for line in fh) for fh in handles]
+            for key, row in heapq.merge(*streams, key=lambda kr: kr[0]):
+                yield key, row
+        finally:
+            for fh in handles:
+                fh.close()
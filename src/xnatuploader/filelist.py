@@ -0,0 +1,140 @@
+import logging
+import os
+import sys
+from collections import namedtuple
+from pathlib import Path
+
+from xnatuploader.metrics import count
+from xnatuploader.shard import shard_of
+
+logger = logging.getLogger(__name__)
+
+READ_SIZE = 2**16
+
+FileListEntry = namedtuple("FileListEntry", ["path", "size"])
+
+
+class FileListError(Exception):
+    pass
+
+
+def read_records(fh, separator=b"\n"):
+    """
+    Generator which splits a binary stream into records without reading all
+    of it into memory. Empty records are skipped.
+    ---
+    fh: a binary file handle
+    separator: bytes - b"\n" or b"\0"
+
+    returns: generator of bytes
+    """
+    rest = b""
+    while True:
+        chunk = fh.read(READ_SIZE)
+        if not chunk:
+            break
+        records = (rest + chunk).split(separator)
+        rest = records.pop()
+        for record in records:
+            if separator == b"\n":
+                record = record.rstrip(b"\r")
+            if record:
+                yield record
+    if rest:
+        yield rest.rstrip(b"\r") if separator == b"\n" else rest
+
+
+def parse_entry(record):
+    """
+    Parse one record of a file list: a path, optionally followed by its size
+    in bytes, separated by a tab. The size can be followed by a modification
+    time, as in the output of find -printf with %T@, which is skipped. The
+    path comes first, and the fields are split from the right, so that paths
+    can have tabs in them.
+    ---
+    record: bytes
+
+    returns: FileListEntry
+    """
+    text = os.fsdecode(record)
+    fields = text.rsplit("\t", 2)
+    for n in (2, 1):
+        if len(fields) > n:
+            try:
+                values = [float(field) for field in fields[-n:]]
+            except ValueError:
+                continue
+            path = "\t".join(fields[:-n])
+            return FileListEntry(path, int(values[0]))
+    return FileListEntry(text, None)
+
+
+def read_file_list(
+    fh, root, null=False, shard=None, shards=None, ignore=(), positions=False
+):
+    """
+    Generator which reads a list of files, such as an inventory of an
+    archive, and yields the ones to be scanned as paths under root, without
+    looking at the filesystem. Relative paths are resolved against root,
+    and absolute paths must be under it, whether or not root is relative.
+    The paths are yielded under root as it was given, as they would be by
+    walking it. Entries whose size is given as zero are left out, because
+    they can't be DICOMs.
+
+    If shard and shards are given, only the files in that shard are yielded,
+    as they would be by shard_filepaths. If positions is true, each path is
+    yielded with its entry's position in the whole list, so that merge can
+    put the shards back in the list's order.
+    ---
+    fh: a binary file handle
+    root: pathlib.Path
+    null: boolean - records are separated by NUL characters rather than
+        newlines, as written by find -print0
+    shard: int or None
+    shards: int or None
+    ignore: list of filenames to leave out
+    positions: boolean
+
+    returns: generator of pathlib.Path, or of ( int, pathlib.Path ) if
+        positions is true
+    """
+    root = Path(root)
+    absolute_root = Path(os.path.abspath(root))
+    separator = b"\0" if null else b"\n"
+    for position, record in enumerate(read_records(fh, separator)):
+        entry = parse_entry(record)
+        path = Path(os.path.normpath(absolute_root / entry.path))
+        try:
+            parts = path.relative_to(absolute_root).parts
+        except ValueError:
+            logger.warning(f"Skipping {entry.path}: it isn't under {root}")
+            count("files_scanned", "outside_root")
+            continue
+        if not parts or path.name in ignore:
+            continue
+        path = root.joinpath(*parts)
+        if shards is not None:
+            top = shard_of(parts[0], shards) if len(parts) > 1 else 1
+            if top != shard:
+                continue
+        if entry.size == 0:
+            logger.debug(f"Skipping empty file {path}")
+            count("files_scanned", "empty")
+            continue
+        yield (position, path) if positions else path
+
+
+def open_file_list(filename):
+    """
+    Open a file list for reading in binary mode, or stdin if filename is "-"
+    ---
+    filename: str or pathlib.Path
+
+    returns: binary file handle
+    """
+    if str(filename) == "-":
+        return open(sys.stdin.fileno(), "rb", closefd=False)
+    try:
+        return open(filename, "rb")
+    except OSError as e:
+        raise FileListError(f"Can't read file list {filename}: {e}")
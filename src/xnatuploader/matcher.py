@@ -1,9 +1,21 @@
+import os
 import re
+import json
 import logging
+from pathlib import Path
+
+from xnatuploader.profiling import phase, profiling_enabled
+from xnatuploader.metrics import count
 
 
 logger = logging.getLogger(__name__)
 
+# regexps used to translate "*" and "**" in compile_recipes: SEGMENT matches
+# one directory, GLOB matches one or more, as few as possible
+
+SEGMENT = "[^/]+"
+GLOB = f"{SEGMENT}(?:/{SEGMENT})*?"
+
 # TODO- what to do about the DICOM:StudyDate v StudyDate stuff? I want to keep
 # the DICOM prefixes so that the user's spreadsheets still work - maybe handle
 # this in the subclass?
@@ -76,8 +88,79 @@ class RecipeException(Exception):
     pass
 
 
+def translate_recipe(recipe, wildcard=".*", group_name=None):
+    """
+    Translates a recipe string into a regular expression, as described in
+    Matcher.parse_recipe.
+    ---
+    recipe: str
+    wildcard: str - the regexp used for non-numeric parameters
+    group_name: fn which takes a parameter name and returns the name to
+                use for its group, or None to use the parameter names
+
+    returns: ( list of str, str )
+
+    raises: RecipeException if a parameter is repeated
+    """
+    regexp = ""
+    params = []
+    for macro in re.finditer(r"{(.*?)}([^{]*)", recipe):
+        param, delimiter = macro.group(1, 2)
+        if param in params:
+            raise RecipeException(f"Recipe has repeated parameter: {param}")
+        group = param if group_name is None else group_name(param)
+        if re.match(param[0] + "+$", param):
+            regexp += f"(?P<{group}>" + (r"\d" * len(param)) + ")"
+        else:
+            regexp += f"(?P<{group}>{wildcard})"
+        regexp += re.escape(delimiter)
+        params.append(param)
+    return params, regexp
+
+
 class ExtractException(Exception):
-    pass
+    """
+    Raised by a file_extractor when a file can't be used. reason is a short
+    category for the extract_failures metric, which shouldn't have values
+    from the file in it, as the message can.
+    """
+
+    def __init__(self, message, reason="other"):
+        super().__init__(message)
+        self.reason = reason
+
+
+class MatchTrace:
+    """
+    Records why each path did or didn't match when it's attached to a
+    Matcher as matcher.trace. Records are dicts which are written to stream
+    as JSON lines if one is given, or kept in self.records.
+
+    Nothing is recorded or formatted when a Matcher has no trace, so there's
+    no cost to having this in the matching loop.
+    """
+
+    def __init__(self, stream=None):
+        """
+        stream: a text file handle or None
+        """
+        self.stream = stream
+        self.records = []
+
+    def record(self, record):
+        if self.stream is not None:
+            self.stream.write(json.dumps(record, default=str) + "\n")
+        else:
+            self.records.append(record)
+
+    def path_matched(self, path, label, values):
+        self.record({"path": path, "label": label, "values": values})
+
+    def path_unmatched(self, path, reasons):
+        self.record({"path": path, "label": None, "reasons": reasons})
+
+    def file_failed(self, filepath, label, error):
+        self.record({"path": str(filepath), "label": label, "error": str(error)})
 
 
 class Matcher:
@@ -99,6 +182,7 @@ class Matcher:
         file_extractor=None,
         match_class=FileMatch,
         loglevel="WARNING",
+        trace=None,
     ):
         """
         patterns: OrderedDict(str: str) of path patterns
@@ -106,18 +190,28 @@ class Matcher:
         fields: list of extra fields to include in the spreadsheet
         file_extractor: fn or None
         log_level: str
+        trace: MatchTrace or None
         """
         logger.setLevel(loglevel)
-        logch = logging.StreamHandler()
-        logch.setLevel(loglevel.upper())
-        logger.addHandler(logch)
+        if not logger.handlers:
+            logger.addHandler(logging.StreamHandler())
+        for handler in logger.handlers:
+            handler.setLevel(loglevel.upper())
+        self.trace = trace
         self.mappings = mappings
         self.file_extractor = file_extractor
         self.match_class = match_class
         self.fields = fields
         self._headers = None
         self.path_values = []
+        self.hidden_fields = []
         self.parse_recipes(patterns)
+        self.compile_recipes(patterns)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["trace"] = None
+        return state
 
     @property
     def headers(self):
@@ -130,9 +224,20 @@ class Matcher:
                 "Status",
             ]
             self._headers += list(self.mappings.keys())
-            self._headers += self.fields + self.path_values
+            self._headers += self.fields + self.path_values + self.hidden_fields
         return self._headers
 
+    def add_hidden_field(self, field):
+        """
+        Add a field which goes at the end of the spreadsheet in a hidden
+        column, after the path values
+        ---
+        field: str
+        """
+        if field not in self.hidden_fields:
+            self.hidden_fields.append(field)
+            self._headers = None
+
     def make_filematch(self, file, label=None, values=None):
         """
         Map a dict of values (which will be captured from the paths or by
@@ -146,10 +251,14 @@ class Matcher:
             for field, value in self.map_values(values).items():
                 match[field] = value
             match.success = True
+            count("files_scanned", "matched")
         except ValueError as e:
             logger.warning(f"Mapping error: {e}")
+            if self.trace is not None:
+                self.trace.file_failed(file, label, f"Mapping error: {e}")
             match.success = False
             match.status = "unmatched"
+            count("files_scanned", "unmatched_mapping")
         match.selected = match.success
         return match
 
@@ -193,6 +302,7 @@ class Matcher:
         ---
         recipe_config: dict of { str: list of str  }
         """
+        self.recipe_config = recipe_config
         self.recipes = {}
         for label, patterns in recipe_config.items():
             self.recipes[label] = []
@@ -258,22 +368,63 @@ class Matcher:
         - for instance, if a parameter name has illegal characters or is repeated.
         """
 
-        regexp = ""
-        params = []
         if recipe == "*" or recipe == "**":
             return [], recipe
-        for macro in re.finditer(r"{(.*?)}([^{]*)", recipe):
-            param, delimiter = macro.group(1, 2)
-            if param in params:
-                raise RecipeException(f"Recipe has repeated parameter: {param}")
-            if re.match(param[0] + "+$", param):
-                regexp += f"(?P<{param}>" + (r"\d" * len(param)) + ")"
-            else:
-                regexp += f"(?P<{param}>.*)"
-            regexp += re.escape(delimiter)
-            params.append(param)
+        params, regexp = translate_recipe(recipe)
         return params, re.compile(regexp)
 
+    def compile_recipes(self, recipe_config):
+        """
+        Compiles all of the recipes into a single regular expression which
+        is matched against a whole relative path, with its parts joined by
+        "/". Each label's recipes become one alternative, in the same order
+        as the config, so the first label which matches wins, as it does in
+        match_recipe.
+
+        Each recipe string matches one directory from its start, as with
+        re.match, "*" matches one directory and "**" matches one or more,
+        as few as possible.
+
+        Parameter names can be repeated across labels and recipes, so the
+        regexp's groups are given generated names, and self.path_groups
+        keeps the list of ( label, label group, [ ( group, param ) ] ) used
+        to pull the values back out of a match. Labels whose recipes don't
+        capture any values are left out, because match_path never returns
+        them.
+        ---
+        recipe_config: dict of { str: list of str  }
+        """
+        alternatives = []
+        self.path_groups = []
+        for label, patterns in recipe_config.items():
+            label_group = f"_l{len(self.path_groups)}"
+            groups = []
+            parts = []
+
+            def group_name(param):
+                groups.append((f"_g{len(self.path_groups)}_{len(groups)}", param))
+                return groups[-1][0]
+
+            for pattern in patterns:
+                if pattern == "*":
+                    parts.append(SEGMENT)
+                elif pattern == "**":
+                    parts.append(GLOB)
+                else:
+                    _, regexp = translate_recipe(pattern, "[^/]*", group_name)
+                    # match the directory in a lookahead and then consume it
+                    # with a backreference: this stops the regexp engine from
+                    # trying other ways to split up a directory which has
+                    # already matched when a later part of the path fails
+                    part = f"_p{len(self.path_groups)}_{len(parts)}"
+                    parts.append(f"(?=(?P<{part}>(?:{regexp})[^/]*))(?P={part})")
+            if groups:
+                alternatives.append(f"(?P<{label_group}>" + "/".join(parts) + ")")
+                self.path_groups.append((label, label_group, groups))
+        self.path_re = None
+        if alternatives:
+            self.path_re = re.compile("|".join(alternatives))
+
     def match(self, root, filepath):
         """
         Calls match_path to get values from the filepath, and then tries to
@@ -286,18 +437,84 @@ class Matcher:
         returns: a FileMatch
         """
         label, values = self.match_path(filepath.relative_to(root))
+        return self.extract(filepath, label, values)
+
+    def match_many(self, root, filepaths):
+        """
+        Generator which matches a batch of files and yields a FileMatch for
+        each of them, in order, with the same results as match.
+
+        Relative paths are worked out once for each directory and reused for
+        all the files in it, so it's fastest when files from the same
+        directory are next to each other, as they are in a sorted list or a
+        directory walk. The extractor is only called for files whose paths
+        match a recipe.
+
+        The Matcher itself can be pickled, so a batch can be split across
+        worker processes with each one calling match_many on its share. The
+        trace isn't pickled, as it may hold an open stream.
+        ---
+        root: pathlib.Path
+        filepaths: iterable of pathlib.Path, str or os.DirEntry
+
+        returns: generator of FileMatch
+        """
+        root = Path(os.path.abspath(root))
+        last_dir = None
+        dir_parts = None
+        profiled = profiling_enabled()
+        for filepath in filepaths:
+            parent, name = os.path.split(os.fspath(filepath))
+            if parent != last_dir:
+                last_dir = parent
+                parent_path = Path(os.path.abspath(parent))
+                dir_parts = "/".join(parent_path.relative_to(root).parts)
+            relpath = f"{dir_parts}/{name}" if dir_parts else name
+            if not isinstance(filepath, Path):
+                filepath = Path(filepath)
+            if profiled:
+                with phase("match"):
+                    label, values = self.match_relpath(relpath)
+            else:
+                label, values = self.match_relpath(relpath)
+            yield self.extract(filepath, label, values)
+
+    def extract(self, filepath, label, values):
+        """
+        Given the label and values from matching a file's path, runs the
+        file_extractor if the path matched and returns a FileMatch.
+        ---
+        filepath: pathlib.Path
+        label: str or None
+        values: { str: str } or None
+
+        returns: a FileMatch
+        """
         if label:
             if self.file_extractor is not None:
                 try:
-                    file_values = self.file_extractor(filepath)
-                except ExtractException as e:
+                    with phase("extract"):
+                        file_values = self.file_extractor(filepath)
+                except (ExtractException, OSError) as e:
+                    # files from a list may have gone since it was made
+                    error = e
+                    if isinstance(e, OSError):
+                        error = ExtractException(
+                            f"Can't read file: {e.strerror}", "unreadable"
+                        )
+                    logger.debug(f"Extraction failed for {filepath}: {error}")
+                    if self.trace is not None:
+                        self.trace.file_failed(filepath, label, error)
+                    count("files_scanned", "unmatched_extract")
+                    count("extract_failures", error.reason)
                     match = self.match_class(self, filepath)
                     match.status = "unmatched"
-                    match.error = str(e)
+                    match.error = str(error)
                     return match
                 for field, value in file_values.items():
                     values[field] = value  # file metadata can overwrite path
             return self.make_filematch(filepath, label, values)
+        count("files_scanned", "unmatched_path")
         match = self.match_class(self, filepath)
         match.status = "unmatched"
         return match
@@ -305,18 +522,107 @@ class Matcher:
     def match_path(self, filepath):
         """
         Try to match a filepath against each of the recipes and return the label
-        and values for the first one which matches.
+        and values for the first one which matches. This is done with a single
+        search using the regexp built by compile_recipes.
+        ---
+        file: pathlib.Path
+
+        returns: { str: str }
+        """
+        if filepath.anchor:
+            return self.match_path_r(filepath)
+        if not filepath.parts:
+            return None, None
+        return self.match_relpath("/".join(filepath.parts))
+
+    def match_relpath(self, relpath):
+        """
+        Match a relative path, with its parts joined by "/", against the
+        compiled recipes.
+        ---
+        relpath: str
+
+        returns: { str: str }
+        """
+        if self.path_re is None:
+            m = None
+        else:
+            m = self.path_re.fullmatch(relpath)
+        if m is not None:
+            for label, label_group, groups in self.path_groups:
+                if m.group(label_group) is not None:
+                    values = {param: m.group(group) for group, param in groups}
+                    if self.trace is not None:
+                        self.trace.path_matched(relpath, label, values)
+                    return label, values
+        if self.trace is not None:
+            self.trace.path_unmatched(relpath, self.explain(relpath.split("/")))
+        return None, None
+
+    def explain(self, dirs):
+        """
+        Works out why a path didn't match each of the labels. This repeats
+        the search which match_recipe does, so it's only called when tracing.
+        ---
+        dirs: list of str - the parts of the path
+
+        returns: { str: str } of reasons by label
+        """
+        reasons = {}
+        for label, recipes in self.recipes.items():
+            failure = self.explain_recipe(self.recipe_config[label], recipes, dirs)
+            if failure is None:
+                reasons[label] = "matched but didn't capture any values"
+            else:
+                reasons[label] = failure[1]
+        return reasons
+
+    def explain_recipe(self, recipe, patterns, dirs, depth=0):
+        """
+        Follows the same rules as match_recipe_r, but returns None if the
+        match succeeds, or a tuple of ( depth, reason ) describing the failure
+        which got furthest down the path.
+        ---
+        recipe: list of str - the recipe strings
+        patterns: list of re.Pattern - the compiled recipe
+        dirs: list of str
+
+        returns: None or ( int, str )
+        """
+        if not patterns:
+            if dirs:
+                return depth, f"path continues after end of recipe at '{dirs[0]}'"
+            return None
+        if not dirs:
+            return depth, f"path ends before '{recipe[0]}'"
+        if patterns[0] == "**":
+            furthest = None
+            for i in range(1, len(dirs) + 1):
+                failure = self.explain_recipe(
+                    recipe[1:], patterns[1:], dirs[i:], depth + i
+                )
+                if failure is None:
+                    return None
+                if furthest is None or failure[0] > furthest[0]:
+                    furthest = failure
+            return furthest
+        if patterns[0] != "*" and not patterns[0].match(dirs[0]):
+            return depth, f"'{dirs[0]}' doesn't match '{recipe[0]}'"
+        return self.explain_recipe(recipe[1:], patterns[1:], dirs[1:], depth + 1)
+
+    def match_path_r(self, filepath):
+        """
+        Match a filepath by trying each label's recipes in turn with
+        match_recipe. This gives the same results as match_path, and is used
+        for absolute paths, which the compiled regexp doesn't handle.
         ---
         file: pathlib.Path
 
         returns: { str: str }
         """
-        logger.debug(f"Trying to match {filepath}")
         for label, recipes in self.recipes.items():
-            logger.debug(f"> pattern: {label}")
             values = self.match_recipe(recipes, filepath)
             if values:
-                logger.debug(f"> successful path match for {label}")
                 return label, values
         return None, None
 
@@ -366,37 +672,27 @@ class Matcher:
 
         if not patterns:
             if dirs:
-                logger.debug(">> ran out of patterns before end of path")
-                return None
+                return None  # ran out of patterns before end of path
             else:
                 return {}  # reached the end of both at the same time
         if not dirs:
-            logger.debug(">> ran out of path before end of patterns")
-            return None
+            return None  # ran out of path before end of patterns
         values = {}
         tail_values = self.match_recipe_r(patterns[1:], dirs[1:])
         if patterns[0] == "**":
-            logger.debug(f">> pattern ** / path {dirs[0]}")
             if tail_values is not None:
-                logger.debug(">> Matched remainder of path")
-                return tail_values
-            logger.debug(">> moving to next path")
+                return tail_values  # matched remainder of path
             return self.match_recipe_r(patterns, dirs[1:])
         if patterns[0] == "*":
-            logger.debug(f">> pattern * / path {dirs[0]}")
             return tail_values
-        logger.debug(f">> pattern {patterns[0]} / path {dirs[0]}")
         m = patterns[0].match(dirs[0])
         if not m:
-            logger.debug(">> No match")
             return None
         values = m.groupdict()
         if tail_values is None:
-            logger.debug(">> Match but no values")
             return None
         for k, v in tail_values.items():
             values[k] = v
-            logger.debug(f">> Matched values {values}")
         return values
 
     def match_paths(self, patterns, dirs):
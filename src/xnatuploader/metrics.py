@@ -0,0 +1,465 @@
+import json
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+from datetime import datetime, timezone
+
+logger = logging.getLogger(__name__)
+
+METRICS_INTERVAL = 60
+PREFIX = "xnatuploader"
+
+# upper bounds of the latency histogram buckets, in seconds
+
+LATENCY_BUCKETS = (
+    0.001,
+    0.002,
+    0.005,
+    0.01,
+    0.02,
+    0.05,
+    0.1,
+    0.2,
+    0.5,
+    1.0,
+    2.0,
+    5.0,
+    10.0,
+    20.0,
+    50.0,
+    100.0,
+    200.0,
+    500.0,
+)
+
+PERCENTILES = (50, 90, 95, 99)
+
+# name: ( type, help, label or None )
+
+METRICS = {
+    "files_scanned": ("counter", "Files scanned, by outcome", "outcome"),
+    "extract_failures": (
+        "counter",
+        "Files which matched a recipe but failed metadata extraction, by reason",
+        "reason",
+    ),
+    "dicomdir": (
+        "counter",
+        "Files matched by scan --dicomdir, by whether their values came from "
+        "a DICOMDIR or why the file had to be opened",
+        "result",
+    ),
+    "files_skipped": (
+        "counter",
+        "Files not uploaded because they weren't selected, were already "
+        "uploaded or weren't safe to upload",
+        None,
+    ),
+    "files_uploaded": ("counter", "Files uploaded, by outcome", "outcome"),
+    "upload_bytes": ("counter", "Bytes of files uploaded successfully", None),
+    "scan_checksums_used": (
+        "counter",
+        "Files checked against the digest recorded by scan --checksums, "
+        "without being read again",
+        None,
+    ),
+    "duplicates_skipped": (
+        "counter",
+        "Files not uploaded because they were copies of another file",
+        None,
+    ),
+    "duplicate_bytes": (
+        "counter",
+        "Bytes of duplicate files which weren't uploaded",
+        None,
+    ),
+    "digest_mismatches": (
+        "counter",
+        "Files whose digest on the server didn't match the local file",
+        None,
+    ),
+    "digest_cache": (
+        "counter",
+        "Files looked up in the digest cache, by whether their digest was there",
+        "result",
+    ),
+    "retries": ("counter", "Requests which were retried", None),
+    "circuit_breaker_opens": (
+        "counter",
+        "Times uploads were paused because of too many server errors",
+        None,
+    ),
+    "pipeline_triggers": (
+        "counter",
+        "Pipeline trigger requests, by outcome",
+        "outcome",
+    ),
+    "datasets_failed": (
+        "counter",
+        "Datasets which couldn't be created on the server",
+        None,
+    ),
+    "concurrency_changes": (
+        "counter",
+        "Changes to the number of concurrent uploads, by direction",
+        "direction",
+    ),
+    "queue_leases": (
+        "counter",
+        "Sessions leased from the work queue, by whether they were new or "
+        "retaken after another worker's lease expired, and leases lost before "
+        "the session was finished",
+        "lease",
+    ),
+    "upload_concurrency": (
+        "gauge",
+        "How many files can be uploading at once",
+        None,
+    ),
+    "upload_seconds": (
+        "histogram",
+        "Time taken to upload and check the digest of one file",
+        None,
+    ),
+}
+
+_metrics = None
+
+
+def count(name, label=None, n=1):
+    """
+    Adds n to a counter if metrics have been started with start_metrics,
+    and does nothing otherwise
+    ---
+    name: str - a key in METRICS
+    label: str or None - the value of the metric's label
+    n: int
+    """
+    if _metrics is not None:
+        _metrics.count(name, label, n)
+
+
+def observe(name, value, label=None):
+    """
+    Records a value in a histogram if metrics have been started
+    ---
+    name: str - a key in METRICS
+    value: float
+    label: str or None
+    """
+    if _metrics is not None:
+        _metrics.observe(name, value, label)
+
+
+def gauge(name, value):
+    """
+    Sets a gauge to value if metrics have been started
+    ---
+    name: str - a key in METRICS
+    value: float
+    """
+    if _metrics is not None:
+        _metrics.gauge(name, value)
+
+
+def start_metrics(operation, outdir, interval=METRICS_INTERVAL, name=None):
+    """
+    Start collecting metrics for a run, writing them to outdir every
+    interval seconds (or only at the end of the run if interval is 0)
+    ---
+    operation: str - "scan" or "upload"
+    outdir: pathlib.Path
+    interval: float
+    name: str or None - used in the filenames instead of the operation, so
+          that runs which share outdir don't overwrite one another
+
+    returns: RunMetrics
+    """
+    global _metrics
+    _metrics = RunMetrics(operation, outdir, name)
+    if interval:
+        _metrics.start_writer(interval)
+    return _metrics
+
+
+def stop_metrics():
+    """
+    Stop collecting metrics, write the final values and return the
+    RunMetrics, or None if metrics weren't started
+    """
+    global _metrics
+    metrics = _metrics
+    _metrics = None
+    if metrics is not None:
+        metrics.stop()
+    return metrics
+
+
+class Histogram:
+    """
+    Counts of values in the LATENCY_BUCKETS, so that percentiles can be
+    estimated without keeping every value
+    """
+
+    def __init__(self):
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.buckets[bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        """
+        Estimate a percentile by interpolating within the bucket it falls
+        in, as Prometheus' histogram_quantile does
+        """
+        if not self.count:
+            return None
+        rank = self.count * p / 100
+        seen = 0
+        lower = 0.0
+        for i, n in enumerate(self.buckets):
+            upper = LATENCY_BUCKETS[i] if i < len(LATENCY_BUCKETS) else self.max
+            if n and seen + n >= rank:
+                return min(lower + (upper - lower) * (rank - seen) / n, self.max)
+            seen += n
+            lower = upper
+        return self.max
+
+    def summary(self):
+        summary = {
+            "count": self.count,
+            "mean": self.sum / self.count if self.count else None,
+            "max": self.max,
+        }
+        for p in PERCENTILES:
+            summary[f"p{p}"] = self.percentile(p)
+        return summary
+
+
+class RunMetrics:
+    """
+    Counters and histograms for one run of scan or upload, which are written
+    as a JSON summary and a Prometheus textfile (for node_exporter's textfile
+    collector) to files named after the operation, so that scans and uploads
+    which share a log directory don't overwrite one another's metrics.
+    """
+
+    def __init__(self, operation, outdir, name=None):
+        """
+        operation: str
+        outdir: pathlib.Path
+        name: str or None - for the filenames, defaults to operation
+        """
+        self.operation = operation
+        self.outdir = outdir
+        self.name = name or operation
+        self.lock = threading.Lock()
+        self.counters = {name: {} for name, m in METRICS.items() if m[0] == "counter"}
+        self.histograms = {
+            name: {} for name, m in METRICS.items() if m[0] == "histogram"
+        }
+        self.gauges = {name: None for name, m in METRICS.items() if m[0] == "gauge"}
+        self.started = time.time()
+        self.finished = None
+        self.stopping = threading.Event()
+        self.writer = None
+
+    @property
+    def json_file(self):
+        return self.outdir / f"metrics_{self.name}.json"
+
+    @property
+    def prom_file(self):
+        return self.outdir / f"metrics_{self.name}.prom"
+
+    def count(self, name, label=None, n=1):
+        with self.lock:
+            counter = self.counters[name]
+            counter[label] = counter.get(label, 0) + n
+
+    def observe(self, name, value, label=None):
+        with self.lock:
+            histograms = self.histograms[name]
+            histogram = histograms.get(label)
+            if histogram is None:
+                histogram = histograms[label] = Histogram()
+            histogram.observe(value)
+
+    def gauge(self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+
+    def total(self, name, label=None):
+        """
+        Returns the value of a counter for one label, or the sum over all of
+        its labels if label is None
+        """
+        counter = self.counters[name]
+        if label is None:
+            return sum(counter.values())
+        return counter.get(label, 0)
+
+    def elapsed(self):
+        return (self.finished or time.time()) - self.started
+
+    def summary(self):
+        """
+        Returns a dict of the counters, latency percentiles and overall
+        rates, which is what gets written to the JSON file
+        """
+        with self.lock:
+            elapsed = self.elapsed()
+            counters = {}
+            for name, counter in self.counters.items():
+                label = METRICS[name][2]
+                if label is None:
+                    counters[name] = counter.get(None, 0)
+                else:
+                    counters[name] = dict(sorted(counter.items()))
+            latency = {
+                name: (
+                    histograms[None].summary()
+                    if None in histograms
+                    else Histogram().summary()
+                )
+                for name, histograms in self.histograms.items()
+            }
+            if self.operation == "scan":
+                files = self.total("files_scanned")
+                errors = self.total("extract_failures")
+            else:
+                files = self.total("files_uploaded", "success")
+                errors = self.total("files_uploaded", "failed")
+            gauges = dict(self.gauges)
+            attempted = files + errors if self.operation != "scan" else files
+            bytes_sent = self.total("upload_bytes")
+        return {
+            "operation": self.operation,
+            "started": timestamp(self.started),
+            "updated": timestamp(time.time()),
+            "finished": self.finished is not None,
+            "elapsed": elapsed,
+            "files_per_second": files / elapsed if elapsed else 0,
+            "bytes_per_second": bytes_sent / elapsed if elapsed else 0,
+            "error_rate": errors / attempted if attempted else 0,
+            "counters": counters,
+            "gauges": gauges,
+            "latency": latency,
+        }
+
+    def prometheus(self):
+        """
+        Returns the metrics in the Prometheus text exposition format
+        """
+        lines = []
+        op = f'operation="{self.operation}"'
+        with self.lock:
+            for name, counter in self.counters.items():
+                _, description, label = METRICS[name]
+                metric = f"{PREFIX}_{name}_total"
+                lines.append(f"# HELP {metric} {description}")
+                lines.append(f"# TYPE {metric} counter")
+                if not counter:
+                    counter = {} if label else {None: 0}
+                for value, n in sorted(counter.items(), key=lambda c: str(c[0])):
+                    labels = op
+                    if label is not None:
+                        labels += f',{label}="{escape_label(value)}"'
+                    lines.append(f"{metric}{{{labels}}} {n}")
+            for name, histograms in self.histograms.items():
+                _, description, _ = METRICS[name]
+                metric = f"{PREFIX}_{name}"
+                lines.append(f"# HELP {metric} {description}")
+                lines.append(f"# TYPE {metric} histogram")
+                histogram = histograms.get(None) or Histogram()
+                cumulative = 0
+                for le, n in zip(LATENCY_BUCKETS, histogram.buckets):
+                    cumulative += n
+                    lines.append(f'{metric}_bucket{{{op},le="{le}"}} {cumulative}')
+                lines.append(f'{metric}_bucket{{{op},le="+Inf"}} {histogram.count}')
+                lines.append(f"{metric}_sum{{{op}}} {histogram.sum}")
+                lines.append(f"{metric}_count{{{op}}} {histogram.count}")
+            gauges = [
+                (name, METRICS[name][1], value)
+                for name, value in self.gauges.items()
+                if value is not None
+            ]
+            gauges += [
+                ("run_start_timestamp_seconds", "When the run started", self.started),
+                ("run_duration_seconds", "How long the run has taken", self.elapsed()),
+                (
+                    "run_finished",
+                    "1 if the run has finished, 0 if it's in progress",
+                    int(self.finished is not None),
+                ),
+            ]
+        for name, description, value in gauges:
+            metric = f"{PREFIX}_{name}"
+            lines.append(f"# HELP {metric} {description}")
+            lines.append(f"# TYPE {metric} gauge")
+            lines.append(f"{metric}{{{op}}} {value}")
+        return "\n".join(lines) + "\n"
+
+    def write(self):
+        """
+        Write the JSON summary and the Prometheus textfile. Each is written
+        to a temporary file and renamed, so that anything reading them never
+        sees a partly-written file.
+        """
+        write_atomic(self.json_file, json.dumps(self.summary(), indent=2) + "\n")
+        write_atomic(self.prom_file, self.prometheus())
+
+    def start_writer(self, interval):
+        """
+        Start a daemon thread which writes the metrics every interval seconds
+        """
+        self.writer = threading.Thread(
+            target=self.write_periodically, args=(interval,), daemon=True
+        )
+        self.writer.start()
+
+    def write_periodically(self, interval):
+        while not self.stopping.wait(interval):
+            try:
+                self.write()
+            except OSError as e:
+                logger.warning(f"Couldn't write metrics: {e}")
+
+    def stop(self):
+        """
+        Stop the writer thread and write the final metrics
+        """
+        self.stopping.set()
+        if self.writer is not None:
+            self.writer.join()
+            self.writer = None
+        if self.finished is None:
+            self.finished = time.time()
+        try:
+            self.write()
+            logger.info(f"Metrics written to {self.json_file} and {self.prom_file}")
+        except OSError as e:
+            logger.warning(f"Couldn't write metrics: {e}")
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def timestamp(t):
+    return datetime.fromtimestamp(t, timezone.utc).isoformat()
+
+
+def write_atomic(path, text):
+    tmp = path.with_name(path.name + ".tmp")
+    tmp.write_text(text)
+    os.replace(tmp, path)
@@ -0,0 +1,193 @@
+import hashlib
+import json
+import logging
+import os
+from dataclasses import asdict, fields
+
+from xnatuploader.upload import Upload
+from xnatuploader.checksum import file_digest
+
+logger = logging.getLogger(__name__)
+
+PLAN_VERSION = 1
+
+
+class VerdictCache:
+    """
+    Remembers the results of a check function (like check_safe_dicom) by
+    filename, along with the size and modification time of the file when it
+    was checked, so that files which haven't changed don't need to be opened
+    again on the next run.
+
+    Instances are callable with a FileMatch and return the result of the
+    check, so they can be passed to collate_uploads in place of the check.
+    """
+
+    def __init__(self, check, verdicts=None):
+        """
+        check: fn which takes a FileMatch and returns a boolean
+        verdicts: dict of { str: [ int size, int mtime_ns, bool ] } or None
+        """
+        self.check = check
+        self.verdicts = verdicts if verdicts is not None else {}
+
+    def __call__(self, file):
+        stat = file_stat(file.file)
+        verdict = self.verdicts.get(file.file)
+        if stat is not None and verdict is not None and verdict[:2] == stat:
+            return verdict[2]
+        ok = self.check(file)
+        if stat is not None:
+            self.verdicts[file.file] = stat + [ok]
+        return ok
+
+    def fresh(self, file):
+        """
+        Returns True if there's a verdict for this file and the file hasn't
+        changed since it was made
+        """
+        verdict = self.verdicts.get(file.file)
+        return verdict is not None and verdict[:2] == file_stat(file.file)
+
+
+def file_stat(filename):
+    """
+    Returns [ size, mtime_ns ] for a file, or None if it can't be read
+    """
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return None
+    return [st.st_size, st.st_mtime_ns]
+
+
+def manifest_hash(spreadsheet):
+    """
+    Returns the SHA256 digest of the spreadsheet file
+    ---
+    spreadsheet: pathlib.Path
+
+    returns: str
+    """
+    return file_digest(spreadsheet, "sha256")
+
+
+def config_hash(matcher, strict_scan_ids):
+    """
+    Returns a digest of everything in the matcher configuration which can
+    change how the files are collated into uploads
+    ---
+    matcher: a Matcher
+    strict_scan_ids: boolean
+
+    returns: str
+    """
+    recipes = {
+        label: [r if isinstance(r, str) else r.pattern for r in recipes]
+        for label, recipes in matcher.recipes.items()
+    }
+    config = {
+        "version": PLAN_VERSION,
+        "recipes": recipes,
+        "mappings": matcher.mappings,
+        "headers": matcher.headers,
+        "strict_scan_ids": strict_scan_ids,
+    }
+    return hashlib.sha256(
+        json.dumps(config, sort_keys=True, default=str).encode("utf-8")
+    ).hexdigest()
+
+
+def file_row(file):
+    """
+    Returns the spreadsheet row for a FileMatch. This doesn't use the
+    FileMatch.columns property because that caches its value, and the status
+    of the file will change when it's uploaded.
+    """
+    row = [file.label, file.file, file.filename, "Y" if file.selected else "N"]
+    row.append(file.status)
+    row += [file.get(v) for v in file.matcher.headers[5:]]
+    return row
+
+
+def save_plan(planfile, manifest, config, skip, uploads, verdicts):
+    """
+    Write an upload plan - the results of collate_uploads and the verdicts
+    of the safety checks - to a JSON file, with the hashes of the manifest
+    and config which it was built from.
+    ---
+    planfile: pathlib.Path
+    manifest: str - as returned by manifest_hash
+    config: str - as returned by config_hash
+    skip: list of FileMatch
+    uploads: dict of str: Upload
+    verdicts: VerdictCache
+    """
+    plan = {
+        "version": PLAN_VERSION,
+        "manifest": manifest,
+        "config": config,
+        "skip": [file_row(file) for file in skip],
+        "uploads": [
+            [session_scan, asdict(upload), [file_row(f) for f in upload.files]]
+            for session_scan, upload in uploads.items()
+        ],
+        "verdicts": verdicts.verdicts,
+    }
+    tmpfile = planfile.with_name(planfile.name + ".tmp")
+    with open(tmpfile, "w") as fh:
+        json.dump(plan, fh, default=str)
+    os.replace(tmpfile, planfile)
+    logger.debug(f"Saved upload plan to {planfile}")
+
+
+def load_plan(planfile, manifest, config, matcher, check):
+    """
+    Load an upload plan if there is one and it was built from the same
+    manifest and config. The plan is also rejected if any of the files
+    to be uploaded have changed since they were checked.
+
+    The verdicts are returned as a VerdictCache whether or not the plan can
+    be used, so that unchanged files don't need to be checked again.
+    ---
+    planfile: pathlib.Path
+    manifest: str - as returned by manifest_hash
+    config: str - as returned by config_hash
+    matcher: the Matcher used to rebuild the FileMatch objects
+    check: the check function for the VerdictCache
+
+    returns: tuple of ( tuple of ( list of FileMatch, dict of str: Upload )
+        or None, VerdictCache )
+    """
+    try:
+        with open(planfile, "r") as fh:
+            plan = json.load(fh)
+    except (OSError, ValueError):
+        return None, VerdictCache(check)
+    if plan.get("version") != PLAN_VERSION:
+        return None, VerdictCache(check)
+    verdicts = VerdictCache(check, plan["verdicts"])
+    if plan["config"] != config:
+        logger.info("Configuration has changed: rebuilding upload plan")
+        return None, verdicts
+    if plan["manifest"] != manifest:
+        logger.info("Spreadsheet has changed: rebuilding upload plan")
+        return None, verdicts
+    skip = [matcher.from_spreadsheet(row) for row in plan["skip"]]
+    uploads = {}
+    upload_fields = [f.name for f in fields(Upload)]
+    for session_scan, values, rows in plan["uploads"]:
+        upload = Upload(**{f: values[f] for f in upload_fields})
+        for row in rows:
+            file = matcher.from_spreadsheet(row)
+            if not verdicts.fresh(file):
+                logger.info(f"{file.file} has changed: rebuilding upload plan")
+                return None, verdicts
+            upload.files.append(file)
+        uploads[session_scan] = upload
+    logger.info(f"Using upload plan {planfile}")
+    return (skip, uploads), verdicts
+
+
+def get_plan_filename(spreadsheet):
+    return spreadsheet.with_suffix(".plan.json")
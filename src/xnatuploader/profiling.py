@@ -0,0 +1,221 @@
+import io
+import logging
+import threading
+import time
+from contextlib import nullcontext
+
+logger = logging.getLogger(__name__)
+
+PROFILE_SAMPLE = 100
+PSTATS_FILE = "profile.pstats"
+SUMMARY_FILE = "profile.txt"
+TOP_FUNCTIONS = 40
+
+NULL_PHASE = nullcontext()
+
+_profiler = None
+
+
+def phase(name):
+    """
+    Returns a context manager which times the named phase if profiling has
+    been started with start_profiling, or one which does nothing if it
+    hasn't, so that phases can be marked in the code at little cost:
+
+        with phase("extract"):
+            values = dicom_extractor(file)
+    ---
+    name: str
+
+    returns: Phase or a nullcontext
+    """
+    if _profiler is None:
+        return NULL_PHASE
+    return Phase(_profiler, name)
+
+
+def profiling_enabled():
+    """
+    Returns True if profiling has been started with start_profiling. Loops
+    which run once per file check this before the loop rather than entering
+    a phase for every file when profiling is off.
+    """
+    return _profiler is not None
+
+
+def start_profiling(sample=PROFILE_SAMPLE):
+    """
+    Start timing phases, and profiling one in sample calls of each phase
+    with cProfile
+    ---
+    sample: int
+
+    returns: PhaseProfiler
+    """
+    global _profiler
+    _profiler = PhaseProfiler(sample)
+    return _profiler
+
+
+def stop_profiling():
+    """
+    Stop profiling and return the PhaseProfiler, or None if profiling wasn't
+    started
+    """
+    global _profiler
+    profiler = _profiler
+    _profiler = None
+    if profiler is not None:
+        profiler.stop()
+    return profiler
+
+
+class PhaseStats:
+    """
+    Call count and times for one phase. total includes the time spent in
+    phases nested inside this one, self_time doesn't.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.total = 0.0
+        self.self_time = 0.0
+        self.max = 0.0
+        self.sampled = 0
+
+
+class PhaseProfiler:
+    """
+    Keeps timers for named phases, and a cProfile.Profile which is only
+    switched on for one in every sample calls of each phase. The first call
+    of each phase is always sampled, so phases which only run once (like
+    walking the directory tree) are profiled in full, while phases which
+    run once per file only pay the cost of the profiler on a fraction of
+    the files.
+    """
+
+    def __init__(self, sample=PROFILE_SAMPLE):
+        """
+        sample: int - profile one in this many calls of each phase
+        """
+        self.sample = max(1, sample)
+        self.phases = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        import cProfile
+
+        self.cprofile = cProfile.Profile()
+        self.sampling = False
+        self.sampled = 0
+        self.started = time.perf_counter()
+        self.elapsed = None
+
+    def stop(self):
+        if self.elapsed is None:
+            self.elapsed = time.perf_counter() - self.started
+
+    def summary(self):
+        """
+        Returns a readable report of the phase timings, followed by the top
+        functions from the sampled cProfile stats
+        """
+        elapsed = self.elapsed or time.perf_counter() - self.started
+        out = io.StringIO()
+        out.write(f"Run time {elapsed:.3f}s\n")
+        out.write(f"cProfile sampled one in {self.sample} calls of each phase\n\n")
+        out.write(
+            f"{'phase':<14}{'calls':>10}{'total s':>12}{'self s':>12}"
+            f"{'mean ms':>10}{'max ms':>10}{'% run':>8}{'sampled':>9}\n"
+        )
+        accounted = 0.0
+        ordered = sorted(self.phases.items(), key=lambda p: -p[1].self_time)
+        for name, stats in ordered:
+            accounted += stats.self_time
+            mean = 1000 * stats.total / stats.calls if stats.calls else 0
+            share = 100 * stats.self_time / elapsed if elapsed else 0
+            out.write(
+                f"{name:<14}{stats.calls:>10}{stats.total:>12.3f}"
+                f"{stats.self_time:>12.3f}{mean:>10.2f}{1000 * stats.max:>10.2f}"
+                f"{share:>8.1f}{stats.sampled:>9}\n"
+            )
+        other = max(0.0, elapsed - accounted)
+        share = 100 * other / elapsed if elapsed else 0
+        out.write(f"{'(other)':<14}{'':>10}{'':>12}{other:>12.3f}")
+        out.write(f"{'':>10}{'':>10}{share:>8.1f}\n")
+        if self.sampled:
+            import pstats
+
+            out.write(f"\nTop {TOP_FUNCTIONS} functions in sampled calls\n")
+            stats = pstats.Stats(self.cprofile, stream=out)
+            stats.sort_stats("cumulative").print_stats(TOP_FUNCTIONS)
+        return out.getvalue()
+
+    def write(self, logdir):
+        """
+        Write the cProfile stats and the summary to logdir
+        ---
+        logdir: pathlib.Path
+        """
+        self.stop()
+        summary = logdir / SUMMARY_FILE
+        summary.write_text(self.summary())
+        logger.info(f"Profile summary written to {summary}")
+        if self.sampled:
+            self.cprofile.dump_stats(logdir / PSTATS_FILE)
+            logger.info(f"Profile stats written to {logdir / PSTATS_FILE}")
+
+
+class Phase:
+    """
+    Context manager which times one call of a phase. Phases can be nested,
+    in which case the time spent in the inner phase is subtracted from the
+    self time of the outer one.
+    """
+
+    __slots__ = ["profiler", "name", "stats", "child", "start", "sampling"]
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        profiler = self.profiler
+        with profiler.lock:
+            stats = profiler.phases.get(self.name)
+            if stats is None:
+                stats = profiler.phases[self.name] = PhaseStats()
+            self.sampling = not profiler.sampling and stats.calls % profiler.sample == 0
+            if self.sampling:
+                profiler.sampling = True
+                profiler.sampled += 1
+                stats.sampled += 1
+            stats.calls += 1
+        self.stats = stats
+        self.child = 0.0
+        stack = getattr(profiler.local, "stack", None)
+        if stack is None:
+            stack = profiler.local.stack = []
+        stack.append(self)
+        if self.sampling:
+            profiler.cprofile.enable()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        elapsed = time.perf_counter() - self.start
+        profiler = self.profiler
+        if self.sampling:
+            profiler.cprofile.disable()
+        stack = profiler.local.stack
+        stack.pop()
+        if stack:
+            stack[-1].child += elapsed
+        with profiler.lock:
+            stats = self.stats
+            stats.total += elapsed
+            stats.self_time += elapsed - self.child
+            if elapsed > stats.max:
+                stats.max = elapsed
+            if self.sampling:
+                profiler.sampling = False
+        return False
@@ -1,4 +1,3 @@
-import hashlib
 import urllib.parse
 from xnatutils.base import (
     sanitize_re,
@@ -13,7 +12,7 @@ from xnatutils.exceptions import (
     XnatUtilsNoMatchingSessionsException,
 )
 
-HASH_CHUNK_SIZE = 2**20
+from xnatuploader.checksum import file_digest, get_engine
 
 BAD_CHAR_MSG = "(must only contain alpha-numeric characters and underscores)"
 
@@ -203,17 +202,27 @@ def get_xnat_classes(login, modality):
 
 def calculate_checksum(fname):
     try:
-        file_hash = hashlib.md5()
-        with open(fname, "rb") as f:
-            for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
-                file_hash.update(chunk)
-        return file_hash.hexdigest()
+        return file_digest(fname)
     except OSError:
         raise XnatUtilsDigestCheckFailedError(
             "Could not check digest of '{}' ".format(fname)
         )
 
 
+def calculate_checksums(fnames, use_cache=True):
+    """
+    Returns a dict of the MD5 digests of a list of files, which are worked
+    out in parallel by the shared ChecksumEngine, and looked up in the digest
+    cache if there is one and use_cache is True
+    """
+    try:
+        return get_engine().digests(fnames, use_cache)
+    except OSError as e:
+        raise XnatUtilsDigestCheckFailedError(
+            "Could not check digest of '{}' ".format(e.filename)
+        )
+
+
 def get_digests(resource):
     """
     Downloads the MD5 digests associated with the files in a resource.
@@ -0,0 +1,242 @@
+import logging
+import random
+import re
+import threading
+import time
+from collections import deque
+
+from xnatuploader.metrics import count
+from xnatuploader.tracing import span
+
+logger = logging.getLogger(__name__)
+
+RETRY_ATTEMPTS = 5
+SESSION_RETRIES = 20
+BACKOFF_BASE = 2.0
+BACKOFF_MAX = 120.0
+
+BREAKER_WINDOW = 20
+BREAKER_THRESHOLD = 0.5
+BREAKER_PAUSE = 60.0
+
+# HTTP statuses which mean that the server or a proxy in front of it is busy
+# or briefly unavailable, rather than that the request was wrong
+
+RETRY_STATUSES = {408, 425, 429, 500, 502, 503, 504}
+
+# xnatpy only puts the status code in the exception message
+
+STATUS_RE = re.compile(r"[Ss]tatus(?: code)? (\d{3})")
+
+# re which matches errors that indicate that the project doesn't exist on
+# XNAT or permissions are wrong: if this is encountered, the whole upload
+# should be abandoned rather than repeatedly trying for each set of files
+
+CANNOT_CREATE_RE = re.compile("Cannot create session")
+
+
+class RetryableError(Exception):
+    """
+    Raised for a failure which isn't an exception, like a digest mismatch,
+    but which is worth trying again
+    """
+
+
+def retryable(e):
+    """
+    Returns True if an exception looks like a transient server or network
+    problem which is worth retrying, and False if retrying won't help, like
+    a missing project, a bad session name, a 4xx response or a file which
+    can't be read or anonymised.
+    ---
+    e: Exception
+
+    returns: bool
+    """
+    import requests
+
+    if isinstance(e, RetryableError):
+        return True
+    if CANNOT_CREATE_RE.match(str(e)):
+        return False
+    if isinstance(
+        e,
+        (
+            requests.exceptions.ConnectionError,
+            requests.exceptions.Timeout,
+            requests.exceptions.ChunkedEncodingError,
+        ),
+    ):
+        return True
+    m = STATUS_RE.search(str(e))
+    if m is not None:
+        return int(m.group(1)) in RETRY_STATUSES
+    return False
+
+
+class CircuitBreaker:
+    """
+    Keeps the outcomes of the last window requests, and opens if the share
+    of them which failed with a retryable error reaches threshold. While
+    it's open, every caller of wait() is held until pause seconds have
+    passed, so that a struggling server isn't hit by every worker's retries
+    at once. After that it's half-open: requests go through, and the first
+    success closes it while the first failure opens it again.
+    """
+
+    def __init__(
+        self, window=BREAKER_WINDOW, threshold=BREAKER_THRESHOLD, pause=BREAKER_PAUSE
+    ):
+        """
+        window: int - number of recent requests to look at
+        threshold: float - error rate from 0 to 1 which opens the breaker
+        pause: float - seconds to stay open
+        """
+        self.window = window
+        self.threshold = threshold
+        self.pause = pause
+        self.outcomes = deque(maxlen=window)
+        self.lock = threading.Lock()
+        self.open_until = None
+        self.half_open = False
+
+    def record(self, ok):
+        """
+        Record the outcome of a request
+        ---
+        ok: bool - False if it failed with a retryable error
+        """
+        with self.lock:
+            if self.half_open:
+                self.half_open = False
+                if ok:
+                    logger.info("Circuit breaker closed")
+                    self.outcomes.clear()
+                else:
+                    self.trip()
+                return
+            self.outcomes.append(ok)
+            if len(self.outcomes) == self.window and self.open_until is None:
+                errors = self.outcomes.count(False)
+                if errors / self.window >= self.threshold:
+                    self.trip()
+
+    def trip(self):
+        self.open_until = time.monotonic() + self.pause
+        self.outcomes.clear()
+        count("circuit_breaker_opens")
+        logger.warning(
+            f"Too many server errors: pausing uploads for {self.pause:.0f} seconds"
+        )
+
+    def wait(self):
+        """
+        Wait until the breaker isn't open
+        """
+        while True:
+            with self.lock:
+                if self.open_until is None:
+                    return
+                delay = self.open_until - time.monotonic()
+                if delay <= 0:
+                    self.open_until = None
+                    self.half_open = True
+                    return
+            with span("circuit breaker"):
+                time.sleep(delay)
+
+
+class RetryScheduler:
+    """
+    Calls a function and retries it on retryable errors, with exponential
+    backoff and full jitter: the nth retry waits for a random time between
+    zero and backoff * 2 ** (n - 1) seconds, up to max_backoff.
+
+    Each call gets at most attempts tries, and all the calls for one session
+    share a budget of session_retries retries, so that a session which
+    keeps failing doesn't hold up the rest of the upload for too long. All
+    calls go through a shared CircuitBreaker.
+
+    Permanent errors are raised straight away. When a call runs out of
+    retries, the last error is raised.
+    """
+
+    def __init__(
+        self,
+        attempts=RETRY_ATTEMPTS,
+        session_retries=SESSION_RETRIES,
+        backoff=BACKOFF_BASE,
+        max_backoff=BACKOFF_MAX,
+        breaker=None,
+    ):
+        """
+        attempts: int - tries per call, including the first one
+        session_retries: int - retries for all the calls for one session
+        backoff: float - seconds
+        max_backoff: float - seconds
+        breaker: CircuitBreaker or None for a default one
+        """
+        self.attempts = max(1, attempts)
+        self.session_retries = session_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.breaker = breaker if breaker is not None else CircuitBreaker()
+        self.lock = threading.Lock()
+        self.retries = {}
+
+    def delay(self, attempt):
+        """Returns a random delay before the retry after attempt"""
+        return random.uniform(
+            0, min(self.max_backoff, self.backoff * 2 ** (attempt - 1))
+        )
+
+    def can_retry(self, attempt, session):
+        """
+        Returns True, and takes a retry from the session's budget, if there's
+        another try left for this call and the session
+        """
+        if attempt >= self.attempts:
+            return False
+        with self.lock:
+            used = self.retries.get(session, 0)
+            if used >= self.session_retries:
+                return False
+            self.retries[session] = used + 1
+        return True
+
+    def call(self, fn, label, session=None):
+        """
+        Call fn with the attempt number (starting at 1) until it returns,
+        raises a permanent error or runs out of retries
+        ---
+        fn: fn ( int ) -> any
+        label: str - what's being tried, for the logs
+        session: str or None - the session whose retry budget is used
+
+        returns: what fn returns
+        """
+        attempt = 0
+        while True:
+            self.breaker.wait()
+            attempt += 1
+            try:
+                result = fn(attempt)
+            except Exception as e:
+                if not retryable(e):
+                    raise
+                self.breaker.record(False)
+                if not self.can_retry(attempt, session):
+                    if attempt > 1:
+                        logger.error(f"{label}: giving up after {attempt} attempts")
+                    raise
+                delay = self.delay(attempt)
+                logger.warning(
+                    f"{label}: {e} - retrying in {delay:.1f}s "
+                    f"(attempt {attempt} of {self.attempts})"
+                )
+                count("retries")
+                with span("backoff", label=label, attempt=attempt):
+                    time.sleep(delay)
+            else:
+                self.breaker.record(True)
+                return result
@@ -0,0 +1,159 @@
+import logging
+from itertools import islice
+
+from xnatuploader.workbook import add_filesheet
+from xnatuploader.collate import collate_uploads
+from xnatuploader.profiling import phase
+from xnatuploader.checksum import add_scan_checksums, CHECKSUM_FIELD
+from xnatuploader.watch import IGNORE_FILES
+
+DEBUG_MAX = 10
+
+logger = logging.getLogger(__name__)
+
+
+def scan(
+    matcher,
+    root,
+    spreadsheet,
+    include_unmatched=True,
+    strict_scan_ids=False,
+    debug=False,
+    checksums=False,
+    filelist=None,
+):
+    """
+    Scan the filesystem under root for files which match recipes and write
+    out the resulting values to a new worksheet in the spreadsheet.
+
+    If filelist is given, the paths in it are matched instead of walking
+    root, in the order they're listed, and aren't checked on the filesystem
+    unless they match a recipe.
+
+    If the debug flag is true, only try to match DEBUG_MAX files
+
+    If checksums is true, the MD5 digests of the matched files are worked
+    out in parallel and written to a hidden column, so that upload doesn't
+    have to read them again to check them if they haven't changed.
+    ---
+    matcher: a Matcher
+    root: pathlib.Path
+    spreadsheet: pathlib.Path
+    include_unmatched: boolean
+    debug: boolean
+    checksums: boolean
+    filelist: iterable of pathlib.Path under root, as from read_file_list,
+        or None to walk root
+    """
+    from tqdm import tqdm
+
+    if checksums:
+        matcher.add_hidden_field(CHECKSUM_FIELD)
+    if filelist is None:
+        logger.info("Preparing file list")
+        with phase("walk"):
+            filepaths = sorted(
+                [
+                    f
+                    for f in root.glob("**/*")
+                    if f.is_file() and f.name not in IGNORE_FILES
+                ]
+            )
+    else:
+        filepaths = filelist
+    filepaths, total = limit_filepaths(filepaths, debug)
+    files = []
+    unmatched = []
+    logger.info(f"Scanning directory {root}")
+    for file in tqdm(matcher.match_many(root, filepaths), total=total):
+        if file.success:
+            logger.debug(f"Matched {file.file}")
+            files.append(file)
+        else:
+            if include_unmatched:
+                file.load_dicom()
+                unmatched.append(file)
+    if checksums:
+        logger.info(f"Computing checksums of {len(files)} files")
+        with phase("checksum"):
+            add_scan_checksums(files)
+    write_scan(
+        matcher,
+        spreadsheet,
+        files,
+        unmatched,
+        include_unmatched,
+        strict_scan_ids,
+        debug,
+    )
+
+
+def limit_filepaths(filepaths, debug):
+    """
+    Returns the paths to scan, cut down to DEBUG_MAX in debug mode, and how
+    many there are, or None if they're being streamed from a file list
+    ---
+    filepaths: list or iterable of pathlib.Path
+    debug: boolean
+
+    returns: tuple of ( iterable of pathlib.Path, int or None )
+    """
+    if debug:
+        filepaths = list(islice(filepaths, DEBUG_MAX))
+    if isinstance(filepaths, list):
+        return filepaths, len(filepaths)
+    return filepaths, None
+
+
+def write_scan(
+    matcher,
+    spreadsheet,
+    files,
+    unmatched,
+    include_unmatched=True,
+    strict_scan_ids=False,
+    debug=False,
+):
+    """
+    Collate the matched files from a scan and write them, followed by the
+    unmatched files, to a new Files worksheet in the spreadsheet
+    ---
+    matcher: a Matcher
+    spreadsheet: pathlib.Path
+    files: list of FileMatch which matched, in path order
+    unmatched: list of FileMatch
+    include_unmatched: boolean
+    strict_scan_ids: boolean
+    debug: boolean - keep the old Files worksheet
+    """
+    from openpyxl import load_workbook
+    from tqdm import tqdm
+
+    logger.info(f"Loading {spreadsheet}")
+    wb = load_workbook(spreadsheet)
+    ws = add_filesheet(wb, matcher, debug)  # keeps old sheets if debug=True
+
+    with phase("collate"):
+        skips, uploads = collate_uploads(files, strict_scan_ids)
+
+    ns = len(uploads)
+    nm = len(files)
+    num = len(unmatched)
+
+    if include_unmatched:
+        logger.info(
+            f"Saving {ns} scans with {nm} matching files and {num} non-matching files to {spreadsheet}"
+        )
+    else:
+        logger.info(f"Saving {ns} scans with {nm} matching files to {spreadsheet}")
+
+    with phase("sheet write"):
+        for session_scan, upload in tqdm(uploads.items(), desc="Scans"):
+            for file in upload.files:
+                ws.append(file.columns)
+
+        if include_unmatched:
+            for file in unmatched:
+                ws.append(file.columns)
+
+        wb.save(spreadsheet)
@@ -0,0 +1,328 @@
+import json
+import logging
+import os
+import re
+import zlib
+from collections import deque
+from pathlib import Path
+
+from xnatuploader.profiling import phase
+from xnatuploader.checksum import add_scan_checksums, CHECKSUM_FIELD
+from xnatuploader.plan import config_hash
+from xnatuploader.scan import limit_filepaths, write_scan
+from xnatuploader.watch import IGNORE_FILES
+
+logger = logging.getLogger(__name__)
+
+SHARD_VERSION = 1
+
+SHARD_RE = re.compile(r"^(\d+)\s*/\s*(\d+)$")
+
+# how many matched files a shard scan hashes at once with --checksums
+
+CHECKSUM_BATCH = 256
+
+
+class ShardError(Exception):
+    pass
+
+
+def parse_shard(text):
+    """
+    Parse a shard given as "i/N", where i is from 1 to N
+    ---
+    text: str
+
+    returns: tuple of ( int, int )
+    """
+    m = SHARD_RE.match(text.strip())
+    if m is None:
+        raise ShardError(f"Shard should look like 1/4, not '{text}'")
+    shard, shards = int(m.group(1)), int(m.group(2))
+    if shards < 1 or not 1 <= shard <= shards:
+        raise ShardError(f"Shard {shard} must be between 1 and {shards}")
+    return shard, shards
+
+
+def shard_of(name, shards):
+    """
+    Returns the shard from 1 to shards which a top-level directory belongs
+    to. This is a CRC32 of the name rather than Python's hash(), so that it's
+    the same in every process and on every node.
+    ---
+    name: str
+    shards: int
+
+    returns: int
+    """
+    return zlib.crc32(name.encode("utf-8", "surrogateescape")) % shards + 1
+
+
+def shard_filepaths(root, shard, shards, ignore=()):
+    """
+    Returns a sorted list of the files in this shard. Each directory directly
+    under root belongs to one shard, with all of the files under it. Files
+    directly under root belong to the first shard.
+    ---
+    root: pathlib.Path
+    shard: int
+    shards: int
+    ignore: list of filenames to leave out
+
+    returns: list of pathlib.Path
+    """
+    filepaths = []
+    for entry in root.iterdir():
+        if entry.is_dir():
+            if shard_of(entry.name, shards) == shard:
+                filepaths += [
+                    f
+                    for f in entry.glob("**/*")
+                    if f.is_file() and f.name not in ignore
+                ]
+        elif entry.is_file() and shard == 1 and entry.name not in ignore:
+            filepaths.append(entry)
+    return sorted(filepaths)
+
+
+def shard_filename(shardsdir, shard, shards):
+    return shardsdir / f"shard-{shard:04d}-of-{shards:04d}.jsonl"
+
+
+class ShardWriter:
+    """
+    Writes one shard's partial manifest: a JSON header line with the shard
+    number, root and configuration, followed by a line for each file with
+    its spreadsheet row and whether it matched. The rows are the files as
+    they were matched, before they're collated, because visit numbers depend
+    on all of a subject's files, which may be in more than one shard. If the
+    shard was scanned from a file list, each line also has the file's
+    position in the list.
+
+    The manifest is written to a temporary file which is renamed when it's
+    closed, so a shard which didn't finish doesn't leave a partial manifest
+    which merge would take to be complete.
+    """
+
+    def __init__(self, path, shard, shards, root, config, listed=False):
+        """
+        path: pathlib.Path
+        shard: int
+        shards: int
+        root: pathlib.Path
+        config: str - config_hash of the matcher
+        listed: boolean - the files are from a file list, with positions
+        """
+        self.path = path
+        self.tmp = path.with_name(path.name + ".tmp")
+        self.fh = open(self.tmp, "w")
+        self.count = 0
+        header = {
+            "version": SHARD_VERSION,
+            "shard": shard,
+            "shards": shards,
+            "root": str(root),
+            "config": config,
+            "listed": listed,
+        }
+        self.fh.write(json.dumps(header) + "\n")
+
+    def add(self, file, matched, position=None):
+        """
+        file: FileMatch
+        matched: bool
+        position: int or None - the file's position in the file list
+        """
+        record = [matched, file.columns]
+        if position is not None:
+            record.append(position)
+        self.fh.write(json.dumps(record, default=str) + "\n")
+        self.count += 1
+
+    def close(self):
+        self.fh.close()
+        os.replace(self.tmp, self.path)
+
+
+def read_shards(shardsdir, config):
+    """
+    Read all the partial manifests in shardsdir, checking that every shard
+    is there and that they were all scanned from the same root with the
+    same configuration.
+    ---
+    shardsdir: pathlib.Path
+    config: str - config_hash of the matcher
+
+    returns: tuple of ( list of matched rows, list of unmatched rows ),
+             each sorted by file path as a single scan would be, or by
+             position if the shards were scanned from a file list
+    """
+    paths = sorted(Path(shardsdir).glob("shard-*.jsonl"))
+    if not paths:
+        raise ShardError(f"No shard manifests found in {shardsdir}")
+    headers = {}
+    matched = []
+    unmatched = []
+    for path in paths:
+        with open(path, "r") as fh:
+            header = json.loads(fh.readline())
+            if header.get("version") != SHARD_VERSION:
+                raise ShardError(f"{path} is from a different version")
+            headers[header["shard"]] = header
+            for line in fh:
+                is_match, row, *position = json.loads(line)
+                position = position[0] if position else None
+                (matched if is_match else unmatched).append((row, position))
+    first = next(iter(headers.values()))
+    for header in headers.values():
+        if header["shards"] != first["shards"]:
+            raise ShardError(f"Manifests in {shardsdir} have different shard counts")
+        if header.get("listed") != first.get("listed"):
+            raise ShardError(
+                f"Manifests in {shardsdir} weren't all scanned from a file list"
+            )
+        if header["root"] != first["root"]:
+            raise ShardError(
+                f"Manifests in {shardsdir} were scanned from different roots"
+            )
+        if header["config"] != config:
+            raise ShardError(
+                f"Shard {header['shard']} was scanned with a different configuration"
+            )
+    missing = [i for i in range(1, first["shards"] + 1) if i not in headers]
+    if missing:
+        raise ShardError(f"Missing shards in {shardsdir}: {missing}")
+
+    def key(entry):
+        row, position = entry
+        return position if first.get("listed") else Path(row[1])
+
+    return (
+        [row for row, _ in sorted(matched, key=key)],
+        [row for row, _ in sorted(unmatched, key=key)],
+    )
+
+
+def scan_shard(
+    matcher,
+    root,
+    shardsdir,
+    shard,
+    shards,
+    include_unmatched=True,
+    strict_scan_ids=False,
+    debug=False,
+    checksums=False,
+    filelist=None,
+):
+    """
+    Scan one shard of the directories under root, and write the files which
+    were found to a partial manifest in shardsdir, to be combined with the
+    others by merge. Shards can be scanned at the same time by different
+    processes or nodes which can see the same filesystem. If checksums is
+    true, merge must be run with checksums as well. If filelist is given, it
+    should only have the files in this shard, with their positions in the
+    whole list, which are written to the manifest so that merge keeps the
+    list's order.
+    ---
+    matcher: a Matcher
+    root: pathlib.Path
+    shardsdir: pathlib.Path
+    shard: int - from 1 to shards
+    shards: int
+    include_unmatched: boolean
+    strict_scan_ids: boolean - only used to check that merge uses the same
+    debug: boolean
+    checksums: boolean
+    filelist: iterable of ( int position, pathlib.Path ), as from
+        read_file_list with positions, or None to walk root
+    """
+    from tqdm import tqdm
+
+    if checksums:
+        matcher.add_hidden_field(CHECKSUM_FIELD)
+    positions = deque()
+    if filelist is None:
+        logger.info(f"Preparing file list for shard {shard} of {shards}")
+        with phase("walk"):
+            filepaths = shard_filepaths(root, shard, shards, IGNORE_FILES)
+    else:
+
+        def listed():
+            for position, path in filelist:
+                positions.append(position)
+                yield path
+
+        filepaths = listed()
+    filepaths, total = limit_filepaths(filepaths, debug)
+    shardsdir.mkdir(parents=True, exist_ok=True)
+    manifest = shard_filename(shardsdir, shard, shards)
+    writer = ShardWriter(
+        manifest,
+        shard,
+        shards,
+        root,
+        config_hash(matcher, strict_scan_ids),
+        listed=filelist is not None,
+    )
+    logger.info(f"Scanning shard {shard} of {shards} in {root}")
+    batch = []
+    for file in tqdm(matcher.match_many(root, filepaths), total=total):
+        position = positions.popleft() if positions else None
+        if file.success:
+            batch.append((file, position))
+            if len(batch) >= CHECKSUM_BATCH or not checksums:
+                write_shard_batch(writer, batch, checksums)
+                batch = []
+        elif include_unmatched:
+            file.load_dicom()
+            writer.add(file, False, position)
+    write_shard_batch(writer, batch, checksums)
+    writer.close()
+    logger.info(f"Wrote {writer.count} files to {manifest}")
+
+
+def write_shard_batch(writer, files, checksums):
+    """
+    Write a batch of matched files to a shard's manifest, working out their
+    checksums first if checksums is true
+    ---
+    writer: ShardWriter
+    files: list of ( FileMatch, int position or None )
+    checksums: boolean
+    """
+    if checksums and files:
+        with phase("checksum"):
+            add_scan_checksums([file for file, _ in files])
+    for file, position in files:
+        writer.add(file, True, position)
+
+
+def merge(matcher, shardsdir, spreadsheet, strict_scan_ids=False, checksums=False):
+    """
+    Combine the partial manifests written by scan_shard into the Files
+    worksheet of the spreadsheet. The files are sorted and collated as they
+    would have been by a single scan of the whole directory, or of the whole
+    file list if the shards were scanned from one, so the worksheet is the
+    same.
+    ---
+    matcher: a Matcher
+    shardsdir: pathlib.Path
+    spreadsheet: pathlib.Path
+    strict_scan_ids: boolean
+    checksums: boolean - must be the same as it was for scan_shard
+    """
+    if checksums:
+        matcher.add_hidden_field(CHECKSUM_FIELD)
+    logger.info(f"Merging shards from {shardsdir}")
+    with phase("sheet read"):
+        matched, unmatched = read_shards(
+            shardsdir, config_hash(matcher, strict_scan_ids)
+        )
+    files = [matcher.from_spreadsheet(row) for row in matched]
+    unmatched = [matcher.from_spreadsheet(row) for row in unmatched]
+    write_scan(matcher, spreadsheet, files, unmatched, True, strict_scan_ids)
+
+
+def get_shards_dirname(spreadsheet):
+    return spreadsheet.with_suffix(".shards")
@@ -0,0 +1,306 @@
+import io
+import logging
+import re
+import threading
+import time
+from datetime import datetime, timedelta
+
+from xnatuploader.tracing import span
+
+logger = logging.getLogger(__name__)
+
+UNLIMITED = None
+PAUSED = 0
+
+# how often the schedule is checked while a file is being sent, in seconds
+
+RECHECK_INTERVAL = 1.0
+
+# longest single sleep while paused, so that KeyboardInterrupts get through
+
+PAUSE_SLEEP = 5.0
+
+MIN_BURST = 2**16
+
+UNITS = {
+    "b": 1,
+    "kb": 1000,
+    "mb": 1000**2,
+    "gb": 1000**3,
+    "kib": 2**10,
+    "mib": 2**20,
+    "gib": 2**30,
+    "kbit": 1000 / 8,
+    "mbit": 1000**2 / 8,
+    "gbit": 1000**3 / 8,
+}
+
+RATE_RE = re.compile(r"^([\d.]+)\s*([a-z]+)(?:/s)?$")
+WINDOW_RE = re.compile(r"^(\d{1,2}):(\d{2})\s*[-–]\s*(\d{1,2}):(\d{2})\s+(.+)$")
+
+
+class ScheduleError(ValueError):
+    pass
+
+
+def parse_rate(text):
+    """
+    Parse a bandwidth like "20 MB/s", "500KiB/s", "100 Mbit/s", "unlimited"
+    or "paused". KB, MB and GB are powers of 1000 and KiB, MiB and GiB are
+    powers of 1024.
+    ---
+    text: str
+
+    returns: float bytes per second, UNLIMITED or PAUSED
+    """
+    value = text.strip().lower()
+    if value in ("unlimited", "full", "full speed", "none"):
+        return UNLIMITED
+    if value in ("paused", "pause", "off", "0"):
+        return PAUSED
+    m = RATE_RE.match(value)
+    if m is None or m.group(2) not in UNITS:
+        raise ScheduleError(f"Can't parse bandwidth '{text}'")
+    return float(m.group(1)) * UNITS[m.group(2)]
+
+
+def format_rate(rate):
+    if rate is UNLIMITED:
+        return "unlimited"
+    if rate == PAUSED:
+        return "paused"
+    return f"{rate / 1000**2:.1f} MB/s"
+
+
+class Schedule:
+    """
+    A bandwidth limit which depends on the time of day, written as a comma
+    separated list of time windows with their rates and a default rate for
+    the rest of the day:
+
+        20:00-06:00 unlimited, 08:00-18:00 20MB/s, 50MB/s
+
+    Windows can run over midnight, and the first one which matches wins.
+    A rate of "paused" stops new files from being started in that window.
+    """
+
+    def __init__(self, windows, default=UNLIMITED):
+        """
+        windows: list of ( int start minute, int end minute, rate )
+        default: rate outside the windows
+        """
+        self.windows = windows
+        self.default = default
+
+    @classmethod
+    def parse(cls, text):
+        """
+        Parse a schedule from the config or command line. A number on its
+        own is a bandwidth in MB/s.
+        ---
+        text: str or a number
+
+        returns: Schedule
+        """
+        if isinstance(text, (int, float)):
+            return cls([], float(text) * UNITS["mb"] or PAUSED)
+        windows = []
+        default = UNLIMITED
+        for part in str(text).split(","):
+            part = part.strip()
+            if not part:
+                continue
+            m = WINDOW_RE.match(part)
+            if m is None:
+                default = parse_rate(part)
+                continue
+            h1, m1, h2, m2 = (int(g) for g in m.groups()[:4])
+            if h1 > 23 or h2 > 24 or m1 > 59 or m2 > 59:
+                raise ScheduleError(f"Bad time window '{part}'")
+            windows.append((h1 * 60 + m1, h2 * 60 + m2, parse_rate(m.group(5))))
+        return cls(windows, default)
+
+    def rate_at(self, when):
+        """
+        Returns the rate at a datetime
+        """
+        minute = when.hour * 60 + when.minute
+        for start, end, rate in self.windows:
+            if start <= end:
+                if start <= minute < end:
+                    return rate
+            elif minute >= start or minute < end:
+                return rate
+        return self.default
+
+    def next_change(self, when):
+        """
+        Returns the datetime of the next minute after when at which the rate
+        changes, or None if it never does
+        """
+        rate = self.rate_at(when)
+        t = when.replace(second=0, microsecond=0)
+        for _ in range(24 * 60):
+            t += timedelta(minutes=1)
+            if self.rate_at(t) != rate:
+                return t
+        return None
+
+    def __str__(self):
+        windows = [
+            f"{s // 60:02d}:{s % 60:02d}-{e // 60:02d}:{e % 60:02d} {format_rate(r)}"
+            for s, e, r in self.windows
+        ]
+        return ", ".join(windows + [format_rate(self.default)])
+
+
+class Throttle:
+    """
+    Limits the rate at which file bodies are sent with a token bucket which
+    is shared by every upload thread, and holds back new files while the
+    schedule says uploads are paused.
+
+    The bucket holds up to a second's worth of bytes. Each read from a file
+    being uploaded takes that many bytes from the bucket, and if it's run
+    out the reader sleeps until it would have refilled, so a burst can't
+    go over the rate for long. The rate follows the schedule, and is checked
+    every RECHECK_INTERVAL seconds while files are being sent. A file which
+    is being sent when a pause starts is finished at the default rate.
+    """
+
+    def __init__(self, schedule, now=datetime.now):
+        """
+        schedule: Schedule
+        now: fn () -> datetime, for testing
+        """
+        self.schedule = schedule
+        self.now = now
+        self.lock = threading.Lock()
+        self.rate = UNLIMITED
+        self.paused = False
+        self.tokens = 0.0
+        self.last = time.monotonic()
+        self.checked = None
+        self.local = threading.local()
+        self.update()
+
+    def update(self):
+        """
+        Set the rate from the schedule, and log it if it's changed
+        """
+        rate = self.schedule.rate_at(self.now())
+        paused = rate == PAUSED
+        if paused:
+            rate = self.schedule.default if self.schedule.default != PAUSED else None
+        with self.lock:
+            if rate != self.rate:
+                logger.info(f"Upload bandwidth: {format_rate(rate)}")
+                self.rate = rate
+                self.tokens = min(self.tokens, self.burst)
+            self.paused = paused
+            self.checked = time.monotonic()
+
+    @property
+    def burst(self):
+        return max(self.rate or 0, MIN_BURST)
+
+    def take(self, n):
+        """
+        Take n bytes from the bucket, sleeping if there aren't enough
+        """
+        if time.monotonic() - self.checked > RECHECK_INTERVAL:
+            self.update()
+        with self.lock:
+            rate = self.rate
+            if rate is UNLIMITED:
+                return
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * rate)
+            self.last = now
+            self.tokens -= n
+            wait = -self.tokens / rate if self.tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+            self.local.waited = self.waited() + wait
+
+    def waited(self):
+        """
+        Returns the total number of seconds which the calling thread has
+        slept in take, so that the time spent throttled can be taken out of
+        an upload's latency
+        """
+        return getattr(self.local, "waited", 0.0)
+
+    def is_paused(self):
+        """
+        Returns True if the schedule says that uploads are paused now
+        """
+        self.update()
+        return self.paused
+
+    def wait_for_window(self):
+        """
+        Called before starting a file: returns straight away unless the
+        schedule says that uploads are paused, in which case it sleeps
+        until the pause is over
+        """
+        if not self.is_paused():
+            return
+        resume = self.schedule.next_change(self.now())
+        until = f"until {resume:%H:%M}" if resume else "indefinitely"
+        logger.warning(f"Uploads paused by the bandwidth schedule {until}")
+        with span("paused"):
+            while self.paused:
+                time.sleep(PAUSE_SLEEP)
+                self.update()
+        logger.warning("Uploads resumed")
+
+    def open(self, filename):
+        """
+        Open a file for reading through the throttle
+        """
+        return ThrottledReader(open(filename, "rb"), self)
+
+
+class ThrottledReader(io.RawIOBase):
+    """
+    A read-only binary file which takes each read's bytes from a Throttle.
+    fileno, seek and tell are passed through so that requests can work out
+    the Content-Length, and it has the name and mode of a file so that
+    urllib3 sends it as bytes.
+    """
+
+    mode = "rb"
+
+    def __init__(self, fh, throttle):
+        self.fh = fh
+        self.throttle = throttle
+
+    @property
+    def name(self):
+        return self.fh.name
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, b):
+        n = self.fh.readinto(b)
+        if n:
+            self.throttle.take(n)
+        return n
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        return self.fh.seek(offset, whence)
+
+    def tell(self):
+        return self.fh.tell()
+
+    def fileno(self):
+        return self.fh.fileno()
+
+    def close(self):
+        self.fh.close()
+        super().close()
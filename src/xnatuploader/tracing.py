@@ -0,0 +1,170 @@
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import nullcontext
+
+logger = logging.getLogger(__name__)
+
+TRACE_FILE = "trace.jsonl"
+CHROME_TRACE_FILE = "trace.json"
+
+NULL_SPAN = nullcontext()
+
+_tracer = None
+
+
+def span(name, **labels):
+    """
+    Returns a context manager which records a span with the given name and
+    labels if tracing has been started with start_tracing, or one which does
+    nothing if it hasn't:
+
+        with span("send", session=session_label, file=filename):
+            resource.upload(filename)
+    ---
+    name: str
+    labels: str values which are attached to the span
+
+    returns: Span or a nullcontext
+    """
+    if _tracer is None:
+        return NULL_SPAN
+    return Span(_tracer, name, labels)
+
+
+def start_tracing(tracefile):
+    """
+    Start writing spans to tracefile
+    ---
+    tracefile: pathlib.Path
+
+    returns: Tracer
+    """
+    global _tracer
+    _tracer = Tracer(open(tracefile, "w"))
+    _tracer.tracefile = tracefile
+    return _tracer
+
+
+def stop_tracing():
+    """
+    Stop tracing and close the trace file, and convert it to CHROME_TRACE_FILE
+    in the same directory, returning the Tracer, or None if tracing wasn't
+    started
+    """
+    global _tracer
+    tracer = _tracer
+    _tracer = None
+    if tracer is not None:
+        tracer.close()
+        convert_trace(tracer.tracefile, tracer.tracefile.parent / CHROME_TRACE_FILE)
+    return tracer
+
+
+def convert_trace(tracefile, chromefile):
+    """
+    Convert a trace written by a Tracer, one event per line, to the JSON
+    array format which chrome://tracing and Perfetto load. Lines which can't
+    be parsed, such as a last line cut off when a run was killed, are skipped.
+    ---
+    tracefile: pathlib.Path
+    chromefile: pathlib.Path
+    """
+    events = []
+    with open(tracefile) as fh:
+        for line in fh:
+            try:
+                events.append(json.loads(line))
+            except ValueError:
+                logger.warning(f"Skipping bad line in {tracefile}: {line!r}")
+    with open(chromefile, "w") as fh:
+        json.dump(events, fh)
+
+
+class Tracer:
+    """
+    Writes spans as Chrome trace "complete" events, one JSON object per
+    line, so that the trace of an interrupted upload can still be read.
+    stop_tracing converts it to the array format for chrome://tracing and
+    Perfetto.
+
+    Each thread which records a span gets its own track in the viewer, so
+    concurrent uploads show up side by side.
+    """
+
+    def __init__(self, stream):
+        """
+        stream: a text file handle
+        """
+        self.stream = stream
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+        self.threads = set()
+        self.origin = time.perf_counter()
+        self.tracefile = None
+
+    def timestamp(self):
+        """Microseconds since the tracer was started"""
+        return (time.perf_counter() - self.origin) * 1e6
+
+    def event(self, event):
+        line = json.dumps(event, default=str) + "\n"
+        with self.lock:
+            self.stream.write(line)
+
+    def add_span(self, name, start, end, labels):
+        tid = threading.get_ident()
+        if tid not in self.threads:
+            self.threads.add(tid)
+            self.event(
+                {
+                    "name": "thread_name",
+                    "ph": "M",
+                    "pid": self.pid,
+                    "tid": tid,
+                    "args": {"name": threading.current_thread().name},
+                }
+            )
+        self.event(
+            {
+                "name": name,
+                "cat": "xnatuploader",
+                "ph": "X",
+                "ts": round(start, 1),
+                "dur": round(end - start, 1),
+                "pid": self.pid,
+                "tid": tid,
+                "args": labels,
+            }
+        )
+
+    def close(self):
+        with self.lock:
+            self.stream.close()
+
+
+class Span:
+    """
+    Context manager which records the start and end of one span. If an
+    exception is raised inside the span its type is added as an error label.
+    """
+
+    __slots__ = ["tracer", "name", "labels", "start"]
+
+    def __init__(self, tracer, name, labels):
+        self.tracer = tracer
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = self.tracer.timestamp()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        end = self.tracer.timestamp()
+        if exc_type is not None:
+            self.labels["error"] = exc_type.__name__
+        self.tracer.add_span(self.name, self.start, end, self.labels)
+        return False
@@ -1,15 +1,42 @@
-import xnatuploader.put
+import csv
 import os.path
 import logging
 from pathlib import Path
 import tempfile
-from pydicom.tag import Tag
-from dicomanonymizer import anonymize, keep
+import threading
+import time
+from collections import deque
+from contextlib import nullcontext
 from dataclasses import dataclass
 
+from xnatuploader.profiling import phase
+from xnatuploader.metrics import count, observe
+from xnatuploader.tracing import span
+from xnatuploader.checksum import get_engine, scan_digest
+from xnatuploader.retry import RetryScheduler, RetryableError, CANNOT_CREATE_RE
+from xnatuploader.dedup import dedup_uploads
+from xnatuploader.workbook import (
+    read_filesheet,
+    copy_csv_to_spreadsheet,
+    get_csv_filename,
+)
+
+KEYBOARD_QUIT_STATUS = "Upload interrupted by user"
+CONFIRM_KEYBOARD_QUIT_MSG = "Are you sure that you want to quit uploading?"
+
 logger = logging.getLogger(__name__)
 
-ANONRULES = {(0x0008, 0x0020): keep}
+
+def __getattr__(name):
+    """
+    ANONRULES needs dicomanonymizer, so it's built when it's first used
+    rather than when the module is imported
+    """
+    if name == "ANONRULES":
+        from dicomanonymizer import keep
+
+        return {(0x0008, 0x0020): keep}
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 @dataclass
@@ -63,21 +90,42 @@ class Upload:
 
     def start_upload(self, xnat_session, project):
         """Create a resource in the session for this scan"""
+        from xnatuploader import put
+
         self.xnat_session = xnat_session
-        self.resource = xnatuploader.put.resource(
-            self.session_label,
-            self.scan_type,
-            resource_name="DICOM",
-            project_id=project,
-            subject_id=self.subject,
-            scan_id=self.series_number,
-            #            date=self.date,
-            modality=self.modality,
-            create_session=self.new_session,
-            connection=xnat_session,
-        )
+        with phase("session"), span(
+            "session", session=self.session_label, scan=self.scan_type
+        ):
+            self.resource = put.resource(
+                self.session_label,
+                self.scan_type,
+                resource_name="DICOM",
+                project_id=project,
+                subject_id=self.subject,
+                scan_id=self.series_number,
+                #            date=self.date,
+                modality=self.modality,
+                create_session=self.new_session,
+                connection=xnat_session,
+            )
 
-    def upload(self, files, anonymize_files=True, overwrite=False, anon_rules=None):
+    def prefetch_digests(self):
+        """
+        Start working out the digests of all of this scan's files, so that
+        they're ready to check against the server's by the time each file
+        has been sent. Files with a digest recorded by scan --checksums are
+        left out.
+        """
+        get_engine().prefetch([f.file for f in self.files if scan_digest(f) is None])
+
+    def upload(
+        self,
+        files,
+        anonymize_files=True,
+        overwrite=False,
+        anon_rules=None,
+        throttle=None,
+    ):
         """
         Uploads files, checks the digests and returns a dict of success / error
         by the original filename. If anonymize_files is true, anonymises the
@@ -88,22 +136,38 @@ class Upload:
             anonymize: anonymise the file before uploading
             overwrite: boolean
             anon_rules: None or dict of anonymisation rules
+            throttle: None or a Throttle to limit the upload bandwidth
         Returns:
             dict of { str: str } with a status message, "success" or an error
         ---
         """
         if anonymize_files:
-            return self.anonymize_and_upload(files, overwrite, anon_rules)
+            return self.anonymize_and_upload(files, overwrite, anon_rules, throttle)
         else:
             for file in files:
-                fname = os.path.basename(file.file)
-                if fname in self.resource.files:
-                    if overwrite:
-                        self.resource.files[fname].delete()
-                self.resource.upload(file.file, fname)
-            return self.check_digests(files)
+                self.send(file.file, overwrite, throttle)
+            with phase("digest"), self.span("verify", files):
+                return self.check_digests(files)
 
-    def anonymize_and_upload(self, files, overwrite=False, anon_rules=None):
+    def send(self, filename, overwrite=False, throttle=None):
+        """
+        Upload one file to the resource, with the same name, reading it
+        through the throttle if there is one
+        """
+        fname = os.path.basename(filename)
+        with phase("upload"), self.span("send", fname):
+            if fname in self.resource.files:
+                if overwrite:
+                    self.resource.files[fname].delete()
+            if throttle is None:
+                self.resource.upload(filename, fname)
+            else:
+                with throttle.open(filename) as fh:
+                    self.resource.upload(fh, fname)
+
+    def anonymize_and_upload(
+        self, files, overwrite=False, anon_rules=None, throttle=None
+    ):
         """
         Makes anonymised copies of a batch of files, uploads the anonymised
         versions, checks the digests against the anonymised versions and then
@@ -114,10 +178,13 @@ class Upload:
             anonymize: anonymise the file before uploading
             overwrite: boolean
             anon_rules: None or dict of anonymisation rules
+            throttle: None or a Throttle
         Returns:
             dict of { str: str } with a status message, "success" or an error
         ---
         """
+        from dicomanonymizer import anonymize
+
         logger.warning(f"anonymize_and_upload anon rules {anon_rules}")
         with tempfile.TemporaryDirectory() as tempdir:
             for file in files:
@@ -129,21 +196,22 @@ class Upload:
                     rules = anon_rules
                 try:
                     logger.debug(f"Anonymizing {file.file} -> {upload_file}")
-                    anonymize(file.file, upload_file, rules, True)
+                    with phase("anonymize"), self.span("anonymize", fname):
+                        anonymize(file.file, upload_file, rules, True)
                 except Exception as e:
                     logger.error(f"Error while anonymizing {file.file}")
                     logger.error(str(e))
                     return
-                if fname in self.resource.files:
-                    if overwrite:
-                        self.resource.files[fname].delete()
-                self.resource.upload(upload_file, fname)
-            return self.check_digests(files, tempdir)
+                self.send(upload_file, overwrite, throttle)
+            with phase("digest"), self.span("verify", files):
+                return self.check_digests(files, tempdir)
 
     def check_digests(self, files, tempdir=None):
         """Check the digests of a batch of files, and returns a hash-by-filename
         of success or failure
         """
+        from xnatuploader import put
+
         result = self.xnat_session.get(self.resource.uri + "/files")
         if result.status_code != 200:
             logger.error(
@@ -154,12 +222,34 @@ class Upload:
             digests = {
                 f["Name"]: f["digest"] for f in result.json()["ResultSet"]["Result"]
             }
+        uploaded_files = {}
+        scanned = {}
+        for file in files:
+            uploaded_files[file.file] = file.file
+            if tempdir:
+                xnat_filename = os.path.basename(file.file)
+                uploaded_files[file.file] = str(Path(tempdir) / xnat_filename)
+            else:
+                digest = scan_digest(file)
+                if digest is not None:
+                    scanned[file.file] = digest
+        if scanned:
+            count("scan_checksums_used", n=len(scanned))
+        with self.span("read", files):
+            local_digests = put.calculate_checksums(
+                [
+                    uploaded_files[file.file]
+                    for file in files
+                    if os.path.basename(file.file) in digests
+                    and file.file not in scanned
+                ],
+                use_cache=not tempdir,
+            )
+        local_digests.update(scanned)
         status = {}
         for file in files:
-            uploaded_file = file.file
+            uploaded_file = uploaded_files[file.file]
             xnat_filename = os.path.basename(file.file)
-            if tempdir:
-                uploaded_file = str(Path(tempdir) / xnat_filename)
             if xnat_filename not in digests:
                 status[file.file] = (
                     f"File {file.file} {xnat_filename} not found in digests"
@@ -168,8 +258,9 @@ class Upload:
                 logger.error(digests)
             else:
                 remote_digest = digests[xnat_filename]
-                local_digest = xnatuploader.put.calculate_checksum(uploaded_file)
+                local_digest = local_digests[uploaded_file]
                 if local_digest != remote_digest:
+                    count("digest_mismatches")
                     status[file.file] = (
                         f"Digest mismatch {local_digest} {remote_digest}"
                     )
@@ -178,6 +269,18 @@ class Upload:
                     status[file.file] = "success"
         return status
 
+    def span(self, name, files):
+        """
+        Returns a tracing span for a stage of uploading one or more files,
+        labelled with this upload's session and scan
+        ---
+        name: str
+        files: a filename, or a list of FileMatch
+        """
+        if not isinstance(files, str):
+            files = ",".join(os.path.basename(f.file) for f in files)
+        return span(name, session=self.session_label, scan=self.scan_type, file=files)
+
     def log(self, logger):
         """
         Write an upload batch to logger for debugging
@@ -192,26 +295,141 @@ class Upload:
             logger.info(f"        File: {file.file}")
 
 
-def trigger_pipelines(xnat_session, project, uploads):
+TRIGGER_WORKERS = 4
+TRIGGER_COMMANDS = ["pullDataFromHeaders", "fixScanTypes", "triggerPipelines"]
+
+
+def trigger_pipelines(xnat_session, project, uploads, workers=TRIGGER_WORKERS):
     """
     Call the put API endpoints to trigger DICOM metadata extraction and
-    snapshotting on the server
+    snapshotting on the server for every session in a dict of Uploads, after
+    they've all been uploaded. upload triggers each session as soon as its
+    files are done with a TriggerStage instead.
+    ---
+    uploads: dict of str: Upload
+    workers: int - how many sessions to trigger at once
     """
     sessions = {upload.session_label: upload.subject for upload in uploads.values()}
-    for session, subject in sessions.items():
-        uri = f"/data/projects/{project}/subjects/{subject}/experiments/{session}"
-        for cmd in ["pullDataFromHeaders", "fixScanTypes", "triggerPipelines"]:
-            try:
+    with TriggerStage(xnat_session, project, workers) as triggers:
+        for session, subject in sessions.items():
+            triggers.submit(session, subject)
+
+
+def trigger_session(xnat_session, project, session, subject):
+    """
+    Send the trigger commands for one session, in order. Errors are logged
+    rather than raised.
+    """
+    uri = f"/data/projects/{project}/subjects/{subject}/experiments/{session}"
+    for cmd in TRIGGER_COMMANDS:
+        try:
+            with phase("trigger"), span("trigger", session=session, cmd=cmd):
                 xnat_session.put(f"{uri}?{cmd}=true")
-            except Exception as e:
-                logger.error(f"Error on trigger {cmd} for {subject} {session}")
-                logger.error(str(e))
+            count("pipeline_triggers", "success")
+        except Exception as e:
+            count("pipeline_triggers", "failed")
+            logger.error(f"Error on trigger {cmd} for {subject} {session}")
+            logger.error(str(e))
+
+
+class TriggerStage:
+    """
+    Triggers the pipelines for sessions in a pool of threads, so that they
+    can be sent while the upload carries on, and more than one session's
+    triggers can be in flight at once. Each session's commands are still
+    sent in order. Closing the stage waits for all the triggers to be sent,
+    unless it's closed by an exception, when any which haven't started are
+    dropped.
+
+        with TriggerStage(xnat_session, project) as triggers:
+            triggers.submit(session_label, subject)
+    """
+
+    def __init__(self, xnat_session, project, workers=TRIGGER_WORKERS):
+        """
+        xnat_session: an XnatPy session
+        project: the XNAT project id
+        workers: int
+        """
+        from concurrent.futures import ThreadPoolExecutor
+
+        self.xnat_session = xnat_session
+        self.project = project
+        self.pool = ThreadPoolExecutor(max(1, workers), "trigger")
+        self.submitted = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(cancel=exc_type is not None)
+
+    def submit(self, session, subject):
+        logger.debug(f"Triggering pipelines for {session}")
+        self.submitted += 1
+        self.pool.submit(
+            trigger_session, self.xnat_session, self.project, session, subject
+        )
+
+    def close(self, cancel=False):
+        self.pool.shutdown(wait=not cancel, cancel_futures=cancel)
+        if self.submitted and not cancel:
+            logger.info(f"Triggered pipelines for {self.submitted} sessions")
+
+
+class SessionProgress:
+    """
+    Keeps track of how many of each session's files are still to be dealt
+    with in a batch of uploads, and submits a session to a TriggerStage as
+    soon as its last file is done, as long as at least one of its files was
+    uploaded. Sessions where every file failed aren't triggered.
+    """
+
+    def __init__(self, uploads, triggers=None):
+        """
+        uploads: dict of str: Upload
+        triggers: TriggerStage or None, in which case nothing is triggered
+        """
+        self.triggers = triggers
+        self.remaining = {}
+        self.subjects = {}
+        self.uploaded = set()
+        for upload in uploads.values():
+            label = upload.session_label
+            self.remaining[label] = self.remaining.get(label, 0) + len(upload.files)
+            self.subjects[label] = upload.subject
+
+    def done(self, upload, file):
+        """
+        Called when a file's status has been written
+        """
+        label = upload.session_label
+        if file.status == "success":
+            self.uploaded.add(label)
+        self.remaining[label] -= 1
+        if self.remaining[label] == 0:
+            self.trigger(label)
+
+    def trigger(self, label):
+        if label in self.uploaded and self.triggers is not None:
+            self.uploaded.discard(label)
+            self.triggers.submit(label, self.subjects[label])
+
+    def finish(self):
+        """
+        Trigger any sessions with uploaded files which weren't finished,
+        because the upload was interrupted
+        """
+        for label in list(self.uploaded):
+            self.trigger(label)
 
 
 def parse_allow_fields(allow_fields):
     """Takes a list of fields which we don't want stripped from the DICOMs
     and tries to convert them to a custom ruleset for dicom-anonymiser. Raises
     a ValueError on any tags which aren't in the DICOM spec."""
+    from pydicom.tag import Tag
+    from dicomanonymizer import keep
 
     rules = {}
 
@@ -225,3 +443,613 @@ def parse_allow_fields(allow_fields):
                     f"Unknown DICOM keyword {keyword} in AllowFields configuration"
                 )
     return rules
+
+
+def upload(
+    xnat_session,
+    matcher,
+    project,
+    spreadsheet,
+    anon_rules=None,
+    anonymize_files=False,
+    strict_scan_ids=False,
+    test=False,
+    overwrite=False,
+    no_pipeline=False,
+    extsort=False,
+    plan=False,
+    retry=None,
+    concurrency=None,
+    throttle=None,
+    trigger_workers=TRIGGER_WORKERS,
+    dedup=False,
+):
+    """
+    Load an Excel spreadsheet created with scan and upload the files which the user
+    has marked for upload, and which haven't been uploaded yet. Keeps track of
+    successful uploads in the "status" column.
+
+    Progress is written out to a temporary csv file. Files which are not being
+    uploaded on this pass (because they were already uploaded, or because they
+    weren't selected for upload) are still written out to the csv file.
+
+    Exceptions during uploading are trapped and logged as failures in the
+    spreadsheet, unless they're a KeyboardInterrupt. If one of these is
+    recieved, the user is prompted to confirm that they want to stop, and then
+    the files which haven't yet been uploaded are written out to the csv with
+    a status message about the interrupt.
+
+    If extsort is True, the spreadsheet is streamed and collated with an
+    on-disk sort, the uploads are done one subject at a time, and the results
+    are streamed back into a new copy of the spreadsheet, so that memory use
+    doesn't grow with the size of the file list.
+
+    If plan is True, the collated uploads and the results of the DICOM
+    safety checks are saved to a plan file alongside the spreadsheet, and
+    reused on the next run if the spreadsheet and config haven't changed.
+
+    If dedup is True, files which are copies of the same DICOM instance are
+    only uploaded once, and the other copies are marked as duplicates of it.
+    With extsort, this is done one subject at a time.
+    ---
+    xnat_session: an XnatPy session, as returned by xnatutils.base.connect
+    matcher: a Matcher
+    project: the XNAT project id to which we're uploading
+    spreadsheet: pathlib.Path to the Excel spreadsheet listing files
+    overwrite: Boolean, used to set the overwrite flag on xnatutils for testing
+    extsort: Boolean, collate out-of-core with collate_uploads_external
+    plan: Boolean, save and reuse an upload plan
+    retry: RetryScheduler or None for the default
+    concurrency: AIMDController or None to upload one file at a time
+    throttle: Throttle or None to upload at full speed
+    trigger_workers: int - how many sessions to trigger pipelines for at once
+    dedup: Boolean, skip copies of files which are being uploaded
+    """
+    # collate and plan build Uploads, so they can't be imported at the top
+    from xnatuploader.collate import (
+        collate_uploads,
+        collate_uploads_external,
+        check_safe_dicom,
+    )
+    from xnatuploader.plan import (
+        load_plan,
+        save_plan,
+        manifest_hash,
+        config_hash,
+        get_plan_filename,
+    )
+
+    if extsort and plan:
+        logger.warning("Upload plans can't be used with --extsort: ignoring")
+        plan = False
+    check = check_safe_dicom
+    if plan:
+        planfile = get_plan_filename(spreadsheet)
+        plan_config = config_hash(matcher, strict_scan_ids)
+        collated, check = load_plan(
+            planfile,
+            manifest_hash(spreadsheet),
+            plan_config,
+            matcher,
+            check_safe_dicom,
+        )
+    if extsort:
+        files = read_filesheet(spreadsheet, matcher, read_only=True)
+        batches = collate_uploads_external(
+            files, strict_scan_ids, matcher, workdir=spreadsheet.parent
+        )
+    elif plan and collated is not None:
+        batches = [collated]
+    else:
+        with phase("sheet read"):
+            files = list(read_filesheet(spreadsheet, matcher))
+        with phase("collate"):
+            batches = [collate_uploads(files, strict_scan_ids, check)]
+        if plan:
+            skip, uploads = batches[0]
+            save_plan(
+                planfile,
+                manifest_hash(spreadsheet),
+                plan_config,
+                skip,
+                uploads,
+                check,
+            )
+    csvout = get_csv_filename(spreadsheet)
+    if test:
+        for _, uploads in batches:
+            if dedup:
+                dedup_uploads(uploads)
+            dry_run(uploads)
+        return
+    abandoned = False
+    keyboard_quit = False
+    if no_pipeline:
+        stage = nullcontext()
+    else:
+        stage = TriggerStage(xnat_session, project, trigger_workers)
+    with open(csvout, "w", newline="") as cfh, stage as triggers:
+        csvw = csv.writer(cfh)
+        for skip, uploads in batches:
+            if dedup:
+                with phase("dedup"):
+                    skip = skip + dedup_uploads(uploads)
+            count("files_skipped", n=len(skip))
+            for file in skip:
+                csvw.writerow(file.columns)
+            if keyboard_quit:
+                write_interrupted(csvw, uploads, {})
+                continue
+            keyboard_quit, abandoned = upload_batch(
+                xnat_session,
+                project,
+                uploads,
+                csvw,
+                anonymize_files=anonymize_files,
+                overwrite=overwrite,
+                anon_rules=anon_rules,
+                retry=retry,
+                concurrency=concurrency,
+                throttle=throttle,
+                triggers=triggers,
+            )
+            if abandoned:
+                break
+    if not abandoned:
+        with phase("sheet write"):
+            copied = copy_csv_to_spreadsheet(
+                matcher, csvout, spreadsheet, stream=extsort
+            )
+        if copied and plan:
+            update_plan(matcher, csvout, spreadsheet, strict_scan_ids, check)
+
+
+def update_plan(matcher, csvout, spreadsheet, strict_scan_ids, check):
+    """
+    After the upload results have been copied back to the spreadsheet,
+    collate the updated file list and save it as the plan for the next run.
+    The rows are read from the csv, with empty cells converted to None as
+    they will be when the spreadsheet is loaded.
+    ---
+    matcher: a Matcher
+    csvout: pathlib.Path - the csv written by upload
+    spreadsheet: pathlib.Path
+    strict_scan_ids: boolean
+    check: VerdictCache
+    """
+    from xnatuploader.collate import collate_uploads
+    from xnatuploader.plan import (
+        save_plan,
+        manifest_hash,
+        config_hash,
+        get_plan_filename,
+    )
+
+    with open(csvout, "r", newline="") as cfh:
+        files = [
+            matcher.from_spreadsheet([None if v == "" else v for v in row])
+            for row in csv.reader(cfh)
+        ]
+    skip, uploads = collate_uploads(files, strict_scan_ids, check)
+    save_plan(
+        get_plan_filename(spreadsheet),
+        manifest_hash(spreadsheet),
+        config_hash(matcher, strict_scan_ids),
+        skip,
+        uploads,
+        check,
+    )
+
+
+def upload_batch(
+    xnat_session,
+    project,
+    uploads,
+    csvw,
+    anonymize_files=False,
+    overwrite=False,
+    anon_rules=None,
+    retry=None,
+    concurrency=None,
+    throttle=None,
+    triggers=None,
+):
+    """
+    Upload a dict of Uploads as returned by collate_uploads, writing each
+    file's status to the csv as it goes.
+
+    Creating datasets and uploading files are retried on transient errors
+    by the RetryScheduler. If an AIMDController is passed as concurrency,
+    the files are uploaded by a pool of threads with upload_concurrent.
+
+    Unless the files are being anonymised, the digests of each scan's
+    files are prefetched once its dataset has been created, so that they're
+    computed while the files are being sent.
+
+    If there's a Throttle, file bodies are sent through it, and each file
+    waits for it if the bandwidth schedule has paused uploads, so a pause
+    always starts and ends between files.
+
+    If there's a TriggerStage, each session's pipelines are triggered as
+    soon as all of its files have been dealt with, if any were uploaded.
+
+    If the user confirms a KeyboardInterrupt, the files in this batch which
+    haven't been uploaded are written out with the interrupted status. If
+    the project can't be written to, the upload is abandoned.
+    ---
+    xnat_session: an XnatPy session
+    project: the XNAT project id
+    uploads: dict of str: Upload
+    csvw: a csv.writer
+    retry: RetryScheduler or None for the default
+    concurrency: AIMDController or None to upload one file at a time
+    throttle: Throttle or None
+    triggers: TriggerStage or None
+
+    returns: tuple of ( bool keyboard_quit, bool abandoned )
+    """
+    from tqdm import tqdm
+
+    if retry is None:
+        retry = RetryScheduler()
+    progress = SessionProgress(uploads, triggers)
+    if concurrency is not None and concurrency.max_workers > 1:
+        return upload_concurrent(
+            xnat_session,
+            project,
+            uploads,
+            csvw,
+            concurrency,
+            retry,
+            anonymize_files=anonymize_files,
+            overwrite=overwrite,
+            anon_rules=anon_rules,
+            throttle=throttle,
+            progress=progress,
+        )
+    written = {}
+    keyboard_quit = False
+    for session_scan, upload in tqdm(uploads.items(), desc="Sessions"):
+        logger.debug(f"Uploading {session_scan}")
+        try:
+            retry.call(
+                lambda attempt: upload.start_upload(xnat_session, project),
+                f"Dataset {upload.label}",
+                upload.session_label,
+            )
+            if not anonymize_files:
+                upload.prefetch_digests()
+            for file in tqdm(upload.files, desc=session_scan):
+                logger.debug(f"Uploading {file.file}")
+                try:
+                    if throttle is not None:
+                        throttle.wait_for_window()
+                    file.status = retry.call(
+                        lambda attempt: upload_file(
+                            upload,
+                            file,
+                            anonymize_files=anonymize_files,
+                            overwrite=overwrite or attempt > 1,
+                            anon_rules=anon_rules,
+                            throttle=throttle,
+                        ),
+                        f"File {file.file}",
+                        upload.session_label,
+                    )
+                    count("files_uploaded", "success")
+                    count("upload_bytes", n=os.path.getsize(file.file))
+                except KeyboardInterrupt:
+                    import click
+
+                    if click.confirm(CONFIRM_KEYBOARD_QUIT_MSG):
+                        keyboard_quit = True
+                        logger.warning(f"KeyboardInterrupt in file loop {file.file}")
+                        break
+                except Exception as e:
+                    file.status = log_failure(f"File {file.file}", e)
+                    count("files_uploaded", "failed")
+                csvw.writerow(file.columns)
+                written[file.file] = True
+                progress.done(upload, file)
+        except KeyboardInterrupt:
+            import click
+
+            if click.confirm(CONFIRM_KEYBOARD_QUIT_MSG):
+                keyboard_quit = True
+                logger.warning("KeyboardInterrupt in dataset loop")
+                break
+        except Exception as e:
+            if CANNOT_CREATE_RE.match(str(e)):
+                log_failure(f"Dataset {upload.label}", e)
+                logger.error(
+                    f"Check that project {project} exists and "
+                    "you have upload permissions"
+                )
+                return False, True
+            status = log_failure(f"Dataset {upload.label}", e)
+            count("datasets_failed")
+            count("files_uploaded", "failed", len(upload.files))
+            for file in upload.files:
+                file.status = status
+                csvw.writerow(file.columns)
+                written[file.file] = True
+                progress.done(upload, file)
+        if keyboard_quit:
+            break
+    if keyboard_quit:
+        write_interrupted(csvw, uploads, written)
+        progress.finish()
+    return keyboard_quit, False
+
+
+def upload_concurrent(
+    xnat_session,
+    project,
+    uploads,
+    csvw,
+    controller,
+    retry,
+    anonymize_files=False,
+    overwrite=False,
+    anon_rules=None,
+    throttle=None,
+    progress=None,
+):
+    """
+    Upload a dict of Uploads with a pool of threads, keeping as many files
+    in flight as the controller allows, and feeding it the time each file
+    took and whether it needed retrying. The time is that of the last
+    attempt, without any time spent sleeping in the throttle, so that the
+    controller doesn't take a bandwidth limit or retry backoff for a slow
+    server.
+
+    Each Upload's dataset is created by the first thread to get one of its
+    files, and datasets in the same session are created one at a time. The
+    workers only upload: statuses and counts are dealt with by this thread
+    as the uploads complete, and the rows are held back until the files
+    before them have finished, so the csv is in the same order as it would
+    be with one worker.
+
+    KeyboardInterrupts and failures are handled as in upload_batch. When
+    uploading is stopped, or the throttle's schedule pauses it, the files
+    which are in flight are allowed to finish.
+    ---
+    xnat_session: an XnatPy session
+    project: the XNAT project id
+    uploads: dict of str: Upload
+    csvw: a csv.writer
+    controller: AIMDController
+    retry: RetryScheduler
+    throttle: Throttle or None
+    progress: SessionProgress or None
+
+    returns: tuple of ( bool keyboard_quit, bool abandoned )
+    """
+    from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+    from tqdm import tqdm
+
+    session_locks = {u.session_label: threading.Lock() for u in uploads.values()}
+    datasets = {}
+
+    def start_dataset(upload):
+        with session_locks[upload.session_label]:
+            if upload.label not in datasets:
+                try:
+                    retry.call(
+                        lambda attempt: upload.start_upload(xnat_session, project),
+                        f"Dataset {upload.label}",
+                        upload.session_label,
+                    )
+                    datasets[upload.label] = None
+                    if not anonymize_files:
+                        upload.prefetch_digests()
+                except Exception as e:
+                    datasets[upload.label] = e
+            return datasets[upload.label]
+
+    def task(upload, file):
+        error = start_dataset(upload)
+        if error is not None:
+            return "dataset", error, None, 0
+        attempts = []
+        latency = 0.0
+
+        def attempt_upload(attempt):
+            nonlocal latency
+            attempts.append(attempt)
+            start = time.perf_counter()
+            throttled = throttle.waited() if throttle is not None else 0.0
+            try:
+                return upload_file(
+                    upload,
+                    file,
+                    anonymize_files=anonymize_files,
+                    overwrite=overwrite or attempt > 1,
+                    anon_rules=anon_rules,
+                    throttle=throttle,
+                )
+            finally:
+                latency = time.perf_counter() - start
+                if throttle is not None:
+                    latency -= throttle.waited() - throttled
+
+        try:
+            retry.call(attempt_upload, f"File {file.file}", upload.session_label)
+            error = None
+        except Exception as e:
+            error = e
+        return "file", error, latency, len(attempts)
+
+    order = [(upload, file) for upload in uploads.values() for file in upload.files]
+    queue = deque(range(len(order)))
+    pending = {}
+    finished = {}
+    next_row = 0
+
+    def write_finished():
+        nonlocal next_row
+        while next_row in finished:
+            csvw.writerow(finished.pop(next_row).columns)
+            next_row += 1
+
+    failed_datasets = set()
+    keyboard_quit = False
+    abandoned = False
+    bar = tqdm(total=len(queue), desc="Files")
+    with ThreadPoolExecutor(controller.max_workers, "upload") as pool:
+        while pending or (queue and not (keyboard_quit or abandoned)):
+            try:
+                while queue and len(pending) < controller.limit:
+                    if keyboard_quit or abandoned:
+                        break
+                    if throttle is not None:
+                        if not pending:
+                            throttle.wait_for_window()
+                        elif throttle.is_paused():
+                            break
+                    position = queue.popleft()
+                    future = pool.submit(task, *order[position])
+                    pending[future] = (position, controller.epoch)
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    position, epoch = pending.pop(future)
+                    upload, file = order[position]
+                    stage, error, latency, attempts = future.result()
+                    bar.update()
+                    if stage == "dataset":
+                        if CANNOT_CREATE_RE.match(str(error)):
+                            if not abandoned:
+                                log_failure(f"Dataset {upload.label}", error)
+                                logger.error(
+                                    f"Check that project {project} exists and "
+                                    "you have upload permissions"
+                                )
+                            abandoned = True
+                            continue
+                        if upload.label in failed_datasets:
+                            file.status = str(error)
+                        else:
+                            failed_datasets.add(upload.label)
+                            file.status = log_failure(f"Dataset {upload.label}", error)
+                            count("datasets_failed")
+                    elif error is None:
+                        file.status = "success"
+                        count("upload_bytes", n=os.path.getsize(file.file))
+                        controller.record(epoch, latency, attempts == 1)
+                    else:
+                        file.status = log_failure(f"File {file.file}", error)
+                        controller.record(epoch, latency, False)
+                    outcome = "success" if file.status == "success" else "failed"
+                    count("files_uploaded", outcome)
+                    finished[position] = file
+                    if progress is not None:
+                        progress.done(upload, file)
+                write_finished()
+            except KeyboardInterrupt:
+                import click
+
+                if click.confirm(CONFIRM_KEYBOARD_QUIT_MSG):
+                    keyboard_quit = True
+                    logger.warning(
+                        f"KeyboardInterrupt: waiting for {len(pending)} uploads"
+                    )
+    bar.close()
+    if abandoned:
+        for position in sorted(finished):
+            csvw.writerow(finished[position].columns)
+        return False, True
+    if keyboard_quit:
+        for position in range(next_row, len(order)):
+            if position in finished:
+                continue
+            upload, file = order[position]
+            file.status = KEYBOARD_QUIT_STATUS
+            count("files_uploaded", "interrupted")
+            finished[position] = file
+        write_finished()
+        if progress is not None:
+            progress.finish()
+    return keyboard_quit, False
+
+
+def upload_file(
+    upload,
+    file,
+    anonymize_files=False,
+    overwrite=False,
+    anon_rules=None,
+    throttle=None,
+):
+    """
+    Make one attempt at uploading a file and checking its digest. Returns
+    "success", or raises a RetryableError if the upload went through but the
+    digest was missing or didn't match.
+
+    Retries are made with overwrite set, because the last attempt may have
+    got as far as writing the file on the server.
+    ---
+    upload: Upload
+    file: FileMatch
+
+    returns: str
+    """
+    start = time.perf_counter()
+    with span(
+        "file",
+        session=upload.session_label,
+        scan=upload.scan_type,
+        file=os.path.basename(file.file),
+    ):
+        status = upload.upload(
+            [file],
+            anonymize_files=anonymize_files,
+            overwrite=overwrite,
+            anon_rules=anon_rules,
+            throttle=throttle,
+        )
+    observe("upload_seconds", time.perf_counter() - start)
+    if status is None:
+        raise ValueError(f"Couldn't anonymize {file.file}")
+    if status[file.file] != "success":
+        raise RetryableError(status[file.file])
+    return status[file.file]
+
+
+def write_interrupted(csvw, uploads, written):
+    """
+    Write out all the files in uploads which aren't in written with a status
+    indicating that the upload was interrupted by the user
+    ---
+    csvw: a csv.writer
+    uploads: dict of str: Upload
+    written: dict of str: bool
+    """
+    from tqdm import tqdm
+
+    for _, upload in tqdm(uploads.items(), desc="Updating spreadsheet"):
+        for file in upload.files:
+            if file.file not in written:
+                file.status = KEYBOARD_QUIT_STATUS
+                count("files_uploaded", "interrupted")
+                csvw.writerow(file.columns)
+
+
+def log_failure(label, e):
+    """Write a message about a file or dataset upload failure to the logs,
+    and return a value to be recorded in the spreadsheet. It's in its own
+    function to make the loop in upload a bit easier to read.
+    """
+    error = str(e)
+    logger.error(f"{label} exception: {error}")
+    return error
+
+
+def dry_run(uploads):
+    """Just logs what would be uploaded - broken out of the main upload
+    loop because it doesn't need to do anything else
+    ---
+    uploads: list of Upload
+    """
+    for session_label, upload in uploads.items():
+        logger.debug(f"Uploading {session_label}")
+        upload.log(logger)
@@ -0,0 +1,477 @@
+import csv
+import json
+import logging
+import os
+import time
+from contextlib import nullcontext
+from pathlib import Path
+
+from xnatuploader.collate import collate_uploads
+from xnatuploader.upload import TriggerStage, upload_batch, TRIGGER_WORKERS
+from xnatuploader.retry import RetryScheduler
+
+logger = logging.getLogger(__name__)
+
+WATCH_STATE_VERSION = 1
+QUIET_PERIOD = 60
+POLL_INTERVAL = 5
+
+IGNORE_FILES = [".DS_Store"]
+
+
+class WatchState:
+    """
+    What watch has already dealt with, saved as JSON so that it can carry on
+    where it left off after a restart. For each directory under the root
+    this keeps its modification time when it was last dealt with and the
+    [ size, mtime_ns ] of each file in it which was uploaded, skipped or
+    didn't match. For each subject it keeps the visit number given to each
+    study date, so that a visit keeps its session label from one batch to
+    the next.
+
+    Files which failed to upload aren't recorded, and nor is the
+    modification time of their directory, so they'll be tried again when
+    the directory next changes or watch is restarted.
+    """
+
+    def __init__(self, statefile):
+        """
+        statefile: pathlib.Path
+        """
+        self.statefile = statefile
+        self.dirs = {}
+        self.visits = {}
+        try:
+            with open(statefile, "r") as fh:
+                state = json.load(fh)
+        except (OSError, ValueError):
+            return
+        if state.get("version") != WATCH_STATE_VERSION:
+            logger.warning(f"Ignoring {statefile}: it's from a different version")
+            return
+        self.dirs = state["dirs"]
+        self.visits = state["visits"]
+
+    def mtimes(self):
+        """
+        Returns a dict of { str: int } of the directories which have been
+        dealt with and their modification times
+        """
+        return {d: s["mtime"] for d, s in self.dirs.items() if s["mtime"] is not None}
+
+    def new_files(self, reldir, snapshot):
+        """
+        Returns the names of files in a directory snapshot which haven't been
+        dealt with, or have changed since they were
+        ---
+        reldir: str - the directory relative to the root
+        snapshot: dict of { str: [ int, int ] } as returned by snapshot()
+
+        returns: list of str
+        """
+        done = self.dirs.get(reldir, {}).get("files", {})
+        return [name for name, stat in snapshot.items() if done.get(name) != stat]
+
+    def record(self, reldir, mtime, done):
+        """
+        Record the files in a directory which have been dealt with. If mtime
+        is None, the directory's modification time isn't updated.
+        ---
+        reldir: str
+        mtime: int or None
+        done: dict of { str: [ int, int ] }
+        """
+        entry = self.dirs.setdefault(reldir, {"mtime": None, "files": {}})
+        entry["files"].update(done)
+        if mtime is not None:
+            entry["mtime"] = mtime
+
+    def save(self):
+        state = {
+            "version": WATCH_STATE_VERSION,
+            "dirs": self.dirs,
+            "visits": self.visits,
+        }
+        tmpfile = self.statefile.with_name(self.statefile.name + ".tmp")
+        with open(tmpfile, "w") as fh:
+            json.dump(state, fh, default=str)
+        os.replace(tmpfile, self.statefile)
+
+
+def walk_dirs(root):
+    """
+    Returns a dict of the modification times of root and every directory
+    under it, keyed by their paths relative to root ("." for root)
+    ---
+    root: pathlib.Path
+
+    returns: dict of { str: int }
+    """
+    mtimes = {}
+    stack = [(str(root), ".")]
+    while stack:
+        path, reldir = stack.pop()
+        try:
+            mtimes[reldir] = os.stat(path).st_mtime_ns
+            with os.scandir(path) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        child = (
+                            entry.name if reldir == "." else f"{reldir}/{entry.name}"
+                        )
+                        stack.append((entry.path, child))
+        except OSError as e:
+            logger.warning(f"Can't read directory {path}: {e}")
+    return mtimes
+
+
+def snapshot(directory):
+    """
+    Returns the [ size, mtime_ns ] of each file in a directory, by name
+    ---
+    directory: pathlib.Path
+
+    returns: dict of { str: [ int, int ] }
+    """
+    files = {}
+    try:
+        with os.scandir(directory) as it:
+            for entry in it:
+                if entry.name in IGNORE_FILES:
+                    continue
+                if entry.is_file(follow_symlinks=False):
+                    st = entry.stat(follow_symlinks=False)
+                    files[entry.name] = [st.st_size, st.st_mtime_ns]
+    except FileNotFoundError:
+        pass
+    return files
+
+
+class PollingWatcher:
+    """
+    Finds directories which have changed by walking the tree every poll
+    seconds and comparing their modification times with the last walk.
+
+    A directory's modification time changes when files are added, removed
+    or renamed in it, so this doesn't notice a file being overwritten in
+    place once its directory has settled.
+    """
+
+    def __init__(self, root, poll=POLL_INTERVAL, mtimes=None):
+        """
+        root: pathlib.Path
+        poll: float - seconds between walks
+        mtimes: dict of { str: int } - the directories as they were last seen
+        """
+        self.root = root
+        self.poll = poll
+        self.mtimes = mtimes if mtimes is not None else {}
+
+    def changes(self):
+        """
+        Walk the tree and return the directories which have changed since
+        the last walk
+        """
+        mtimes = walk_dirs(self.root)
+        changed = [d for d, m in mtimes.items() if self.mtimes.get(d) != m]
+        self.mtimes = mtimes
+        return changed
+
+    def wait(self):
+        """
+        Wait for poll seconds and return the directories which have changed
+        """
+        time.sleep(self.poll)
+        return self.changes()
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher(PollingWatcher):
+    """
+    Finds directories which have changed from inotify events, with a watch on
+    every directory under the root. New directories are watched as they're
+    created. The tree is only walked at startup, and if the kernel's event
+    queue overflows.
+    """
+
+    def __init__(self, root, poll=POLL_INTERVAL, mtimes=None):
+        from inotify_simple import INotify, flags
+
+        super().__init__(root, poll, mtimes)
+        self.flags = flags
+        self.mask = (
+            flags.CREATE
+            | flags.CLOSE_WRITE
+            | flags.MODIFY
+            | flags.MOVED_TO
+            | flags.DELETE
+        )
+        self.inotify = INotify()
+        self.watches = {}
+
+    def add_watch(self, reldir):
+        path = self.root / reldir
+        try:
+            wd = self.inotify.add_watch(path, self.mask)
+        except FileNotFoundError:
+            return
+        except OSError as e:
+            logger.warning(
+                f"Can't watch {path} ({e}): fs.inotify.max_user_watches may "
+                "need to be increased"
+            )
+            return
+        self.watches[wd] = reldir
+
+    def changes(self):
+        """
+        Walk the tree, adding a watch to every directory, and return the
+        directories which have changed since the last walk
+        """
+        changed = super().changes()
+        watched = set(self.watches.values())
+        for reldir in self.mtimes:
+            if reldir not in watched:
+                self.add_watch(reldir)
+        # walk again to catch anything which changed before it was watched
+        return list(set(changed + super().changes()))
+
+    def wait(self):
+        """
+        Wait for up to poll seconds for events and return the directories
+        they happened in
+        """
+        changed = set()
+        for event in self.inotify.read(timeout=int(self.poll * 1000)):
+            if event.mask & self.flags.Q_OVERFLOW:
+                logger.warning("inotify queue overflowed: rescanning")
+                return self.changes()
+            reldir = self.watches.get(event.wd)
+            if reldir is None:
+                continue
+            changed.add(reldir)
+            if event.mask & self.flags.ISDIR and event.mask & (
+                self.flags.CREATE | self.flags.MOVED_TO
+            ):
+                # files may have been written before the watch was added,
+                # so the new subtree is walked as well as watched
+                child = event.name if reldir == "." else f"{reldir}/{event.name}"
+                for subdir in walk_dirs(self.root / child):
+                    new = child if subdir == "." else f"{child}/{subdir}"
+                    self.add_watch(new)
+                    changed.add(new)
+        return list(changed)
+
+    def close(self):
+        self.inotify.close()
+
+
+def make_watcher(root, poll=POLL_INTERVAL, mtimes=None, inotify=True):
+    """
+    Returns an InotifyWatcher if inotify is True and inotify_simple can be
+    imported, or a PollingWatcher if not
+    """
+    if inotify:
+        try:
+            return InotifyWatcher(root, poll, mtimes)
+        except ImportError:
+            logger.info("inotify_simple isn't installed: polling for changes")
+        except OSError as e:
+            logger.warning(f"Can't use inotify ({e}): polling for changes")
+    return PollingWatcher(root, poll, mtimes)
+
+
+def watch_tree(root, state, process, quiet=QUIET_PERIOD, watcher=None, stop=None):
+    """
+    Watch the tree under root and call process with the new files in each
+    directory once it has had no changes for quiet seconds. Directories which
+    have changed since they were recorded in the state are picked up when
+    watching starts.
+
+    process is called with a list of pathlib.Path and should return the ones
+    which have been dealt with, which are recorded in the state. It can
+    return None to stop watching.
+    ---
+    root: pathlib.Path
+    state: WatchState
+    process: fn ( list of pathlib.Path ) -> list of pathlib.Path or None
+    quiet: float - seconds
+    watcher: PollingWatcher or InotifyWatcher
+    stop: threading.Event or None - watching stops when this is set
+    """
+    if watcher is None:
+        watcher = make_watcher(root, mtimes=state.mtimes())
+    pending = {}
+    changed = watcher.changes()
+    logger.info(f"Watching {root}: {len(changed)} directories to check")
+    try:
+        while stop is None or not stop.is_set():
+            now = time.monotonic()
+            for reldir in changed:
+                pending.setdefault(reldir, [None, now])
+            for reldir, entry in pending.items():
+                files = snapshot(root / reldir)
+                if files != entry[0]:
+                    entry[0] = files
+                    entry[1] = now
+            settled = [d for d, e in pending.items() if now - e[1] >= quiet]
+            for reldir in settled:
+                del pending[reldir]
+            if settled and not settle(root, settled, state, process):
+                return
+            changed = watcher.wait()
+    finally:
+        watcher.close()
+        state.save()
+
+
+def settle(root, reldirs, state, process):
+    """
+    Process the new files in directories which have settled as one batch,
+    and record the ones which were dealt with. Returns False if watching
+    should stop.
+    ---
+    root: pathlib.Path
+    reldirs: list of str
+    state: WatchState
+    process: fn as passed to watch_tree
+    """
+    settled = {}
+    filepaths = []
+    for reldir in reldirs:
+        directory = root / reldir
+        try:
+            mtime = os.stat(directory).st_mtime_ns
+        except FileNotFoundError:
+            continue
+        files = snapshot(directory)
+        new = state.new_files(reldir, files)
+        settled[reldir] = (mtime, files, new)
+        filepaths += [directory / name for name in sorted(new)]
+    done = set()
+    if filepaths:
+        logger.info(
+            f"{len(settled)} directories have settled: {len(filepaths)} new files"
+        )
+        processed = process(filepaths)
+        if processed is None:
+            return False
+        done = {Path(f) for f in processed}
+    for reldir, (mtime, files, new) in settled.items():
+        directory = root / reldir
+        names = [name for name in new if directory / name in done]
+        state.record(
+            reldir,
+            mtime if len(names) == len(new) else None,
+            {name: files[name] for name in names},
+        )
+    state.save()
+    return True
+
+
+def watch(
+    xnat_session,
+    matcher,
+    project,
+    root,
+    spreadsheet,
+    anon_rules=None,
+    anonymize_files=False,
+    strict_scan_ids=False,
+    overwrite=False,
+    no_pipeline=False,
+    quiet=QUIET_PERIOD,
+    poll=POLL_INTERVAL,
+    inotify=True,
+    stop=None,
+    retry=None,
+    concurrency=None,
+    throttle=None,
+    trigger_workers=TRIGGER_WORKERS,
+):
+    """
+    Watch the directory tree under root for new files, and upload them
+    when the directory they're in hasn't changed for quiet seconds. Each
+    batch of new files is matched, collated and uploaded in the same way as
+    scan and upload would, and the results are appended to a csv file next
+    to the spreadsheet, which is only used for the configuration.
+
+    The files which have been dealt with are kept in a state file next to
+    the spreadsheet, so that when watch is restarted, only directories which
+    have changed since then are looked at again.
+
+    Runs until the user interrupts it, the project can't be uploaded to, or
+    stop is set.
+    ---
+    xnat_session: an XnatPy session
+    matcher: a Matcher
+    project: the XNAT project id
+    root: pathlib.Path
+    spreadsheet: pathlib.Path
+    quiet: float - seconds a directory must be unchanged before uploading
+    poll: float - seconds between checks for changes
+    inotify: boolean - use inotify if it's available
+    stop: threading.Event or None
+    retry: RetryScheduler or None for the default
+    concurrency: AIMDController or None to upload one file at a time
+    throttle: Throttle or None to upload at full speed
+    trigger_workers: int - how many sessions to trigger pipelines for at once
+    """
+    if retry is None:
+        retry = RetryScheduler()
+    state = WatchState(get_watch_state_filename(spreadsheet))
+    csvout = get_watch_csv_filename(spreadsheet)
+
+    def process(filepaths):
+        files = list(matcher.match_many(root, filepaths))
+        matched = [file for file in files if file.success]
+        skip, uploads = collate_uploads(matched, strict_scan_ids, visits=state.visits)
+        with open(csvout, "a", newline="") as cfh:
+            csvw = csv.writer(cfh)
+            for file in files:
+                if not file.success:
+                    csvw.writerow(file.columns)
+            for file in skip:
+                csvw.writerow(file.columns)
+            keyboard_quit, abandoned = upload_batch(
+                xnat_session,
+                project,
+                uploads,
+                csvw,
+                anonymize_files=anonymize_files,
+                overwrite=overwrite,
+                anon_rules=anon_rules,
+                retry=retry,
+                concurrency=concurrency,
+                throttle=throttle,
+                triggers=triggers,
+            )
+        if keyboard_quit or abandoned:
+            return None
+        done = [file.file for file in files if not file.success]
+        done += [file.file for file in skip]
+        for upload in uploads.values():
+            done += [file.file for file in upload.files if file.status == "success"]
+        return done
+
+    watcher = make_watcher(root, poll, state.mtimes(), inotify)
+    if no_pipeline:
+        stage = nullcontext()
+    else:
+        stage = TriggerStage(xnat_session, project, trigger_workers)
+    with stage as triggers:
+        try:
+            watch_tree(root, state, process, quiet, watcher, stop)
+        except KeyboardInterrupt:
+            logger.warning("Watch interrupted by user")
+    logger.info(f"Upload results written to {csvout}")
+
+
+def get_watch_state_filename(spreadsheet):
+    return spreadsheet.with_suffix(".watch.json")
+
+
+def get_watch_csv_filename(spreadsheet):
+    return spreadsheet.with_suffix(".watch.csv")
@@ -1,11 +1,17 @@
+import csv
+import logging
+import os
+import tempfile
 from collections import OrderedDict
-from openpyxl import Workbook, load_workbook
-from openpyxl.styles.alignment import Alignment
+from copy import copy
+from pathlib import Path
 
 FILE_COLUMN_WIDTH = 50
 HELP_COLUMN_WIDTH = 25
 HELP_ROW_HEIGHT = 90
 
+logger = logging.getLogger(__name__)
+
 HELP_TEXT = """
 Paths are a set of patterns to be matched against file paths in the source directory.
 
@@ -34,6 +40,9 @@ def new_workbook(file):
     --
     file: filepath.Path
     """
+    from openpyxl import Workbook
+    from openpyxl.styles.alignment import Alignment
+
     wb = Workbook()
     ws = wb.active
     for col in "ABCDE":
@@ -93,33 +102,139 @@ def add_filesheet(wb, matcher, debug):
             old_files.title = "Files-prev"
         else:
             wb.remove(wb["Files"])
+    from openpyxl.utils import get_column_letter
+
     ws = wb.create_sheet("Files")
     ws.column_dimensions["B"].width = FILE_COLUMN_WIDTH
     ws.append(matcher.headers)
+    for field in matcher.hidden_fields:
+        column = get_column_letter(matcher.headers.index(field) + 1)
+        ws.column_dimensions[column].hidden = True
     return ws
 
 
+def replace_filesheet(spreadsheet, matcher, rows):
+    """
+    Replaces the Files worksheet of a spreadsheet with rows, without loading
+    either the old or the new worksheet into memory, for file lists which
+    are too big for openpyxl's normal mode. The spreadsheet is read in
+    read-only mode and a write-only workbook is saved to a temporary file
+    next to it, which then replaces it.
+
+    The other worksheets are copied with their values and cell styles.
+    Read-only mode can't see column widths or merged cells, so the
+    Configuration worksheet is given the layout from new_workbook.
+    ---
+    spreadsheet: pathlib.Path
+    matcher: a Matcher
+    rows: iterable of list of values, without the header row
+    """
+    from openpyxl import Workbook, load_workbook
+
+    source = load_workbook(spreadsheet, read_only=True)
+    fd, tmp = tempfile.mkstemp(suffix=".xlsx", dir=Path(spreadsheet).parent)
+    os.close(fd)
+    try:
+        wb = Workbook(write_only=True)
+        for ws in source.worksheets:
+            if ws.title == "Files":
+                continue
+            target = wb.create_sheet(ws.title)
+            if ws.title == "Configuration":
+                configuration_layout(target)
+            for row in ws.iter_rows():
+                target.append([copy_cell(target, cell) for cell in row])
+        ws = add_filesheet(wb, matcher, False)
+        for row in rows:
+            ws.append(row)
+        wb.save(tmp)
+        source.close()
+        os.replace(tmp, spreadsheet)
+    finally:
+        source.close()
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+
+
+def configuration_layout(ws):
+    """
+    Sets the column widths, merged cells and row heights which new_workbook
+    gives the Configuration worksheet, on a write-only worksheet
+    """
+    from openpyxl.worksheet.cell_range import CellRange
+
+    for col in "ABCDE":
+        ws.column_dimensions[col].width = HELP_COLUMN_WIDTH
+    ws.merged_cells.add(CellRange("A2:F2"))
+    ws.row_dimensions[2].height = HELP_ROW_HEIGHT
+
+
+def copy_cell(ws, cell):
+    """
+    Returns a copy of a cell from a read-only worksheet, with its style, for
+    a write-only worksheet, or None if it's empty
+    """
+    from openpyxl.cell import WriteOnlyCell
+
+    if not getattr(cell, "has_style", False):
+        return cell.value
+    target = WriteOnlyCell(ws, cell.value)
+    target.font = copy(cell.font)
+    target.fill = copy(cell.fill)
+    target.border = copy(cell.border)
+    target.alignment = copy(cell.alignment)
+    target.number_format = cell.number_format
+    target.protection = copy(cell.protection)
+    return target
+
+
+def load_hidden_fields(spreadsheet, matcher, fields):
+    """
+    Add any of fields which are in the header row of the Files worksheet,
+    after the matcher's own headers, to the matcher's hidden fields, so that
+    they're read from and written back to the spreadsheet
+    ---
+    spreadsheet: pathlib.Path
+    matcher: a Matcher
+    fields: list of str
+    """
+    from openpyxl import load_workbook
+
+    wb = load_workbook(spreadsheet, read_only=True)
+    if "Files" in wb:
+        header = next(wb["Files"].values, ())
+        for field in header[len(matcher.headers) :]:
+            if field in fields:
+                matcher.add_hidden_field(field)
+    wb.close()
+
+
 def load_config(excelfile):
     """
     Load config from the Configuration worksheet of the spreadsheet.
     Each section is loaded into an OrderedDict - this is because order is
     significant for building the columns in the spreadsheet.
     """
-    wb = load_workbook(excelfile)
+    from openpyxl import load_workbook
+
+    # read-only, so that a large Files worksheet isn't loaded as well
+    wb = load_workbook(excelfile, read_only=True)
     if "Configuration" not in wb:
+        wb.close()
         raise WorkbookError(f"No worksheet named 'Configuration' in {excelfile}")
     ws = wb["Configuration"]
     config = {}
     section = None
     sections = ["paths", "mappings", "xnat"]
-    for row in ws:
-        if row[0].value is not None:
-            section = row[0].value.lower()
-        var = row[1].value
+    for row in ws.values:
+        # rows with no cells can be empty in read-only mode
+        first, var, *rest = row + (None, None)
+        if first is not None:
+            section = first.lower()
         if var is not None and section is not None:
             if section not in config:
                 config[section] = OrderedDict()
-            cells = [cell.value for cell in row[2:] if cell.value is not None]
+            cells = [value for value in rest if value is not None]
             if section == "xnat":
                 try:
                     config[section][var] = cells[0]
@@ -127,7 +242,85 @@ def load_config(excelfile):
                     config[section][var] = None
             else:
                 config[section][var] = cells
+    wb.close()
     missing = [s for s in sections if s not in config]
     if len(missing) > 0:
         raise WorkbookError(f"Missing config sections: {missing}")
     return config
+
+
+def read_filesheet(spreadsheet, matcher, read_only=False):
+    """
+    Generator which yields a FileMatch for each row of the Files worksheet
+    of a spreadsheet. If read_only is True, the workbook is opened in
+    openpyxl's streaming mode, which doesn't load the whole worksheet into
+    memory.
+    ---
+    spreadsheet: pathlib.Path
+    matcher: a Matcher
+    read_only: bool
+
+    returns: generator of FileMatch
+    """
+    from openpyxl import load_workbook
+
+    wb = load_workbook(spreadsheet, read_only=read_only)
+    ws = wb["Files"]
+    header = True
+    for row in ws.values:
+        if header:
+            header = False
+        else:
+            yield matcher.from_spreadsheet(row)
+    if read_only:
+        wb.close()
+
+
+def copy_csv_to_spreadsheet(matcher, csvout, spreadsheet, stream=False):
+    """Copies the csv of uploaded files to the Files worksheet of the
+    spreadsheet. If it can't, tells the user that the results are in the csv
+    file.
+    This function always clobbers the Files worksheet with its updated value,
+    unlike scan, which can save old versions of Files when running in debug
+    mode.
+
+    If stream is True, the rows are streamed into a new copy of the
+    spreadsheet with replace_filesheet, so that the worksheet is never held
+    in memory.
+
+    Returns True if the spreadsheet was saved.
+    """
+    from openpyxl import load_workbook
+
+    logger.debug(f"Copying upload results from {csvout} to {spreadsheet}")
+    try:
+        if stream:
+            with open(csvout, "r", newline="") as cfh:
+                replace_filesheet(spreadsheet, matcher, csv.reader(cfh))
+            return True
+        wb = load_workbook(spreadsheet)
+        ws = add_filesheet(wb, matcher, False)
+        with open(csvout, "r") as cfh:
+            for row in csv.reader(cfh):
+                ws.append(row)
+        wb.save(spreadsheet)
+        return True
+    except PermissionError:
+        logger.error(
+            f"""
+A permissions error prevented the script from writing the upload results back
+to {spreadsheet}.  If you are on Windows, this may be because you still have
+the spreadsheet open in Excel.
+
+The results are available as a CSV file: {csvout}
+"""
+        )
+
+
+def get_csv_filename(spreadsheet):
+    csv = spreadsheet.with_suffix(".csv")
+    n = 0
+    while csv.is_file():
+        n += 1
+        csv = spreadsheet.parent / Path(f"{spreadsheet.stem}.{n}.csv")
+    return csv
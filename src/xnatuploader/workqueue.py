@@ -0,0 +1,552 @@
+import csv
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+from contextlib import nullcontext
+from dataclasses import asdict, fields
+
+from xnatuploader.upload import Upload, TriggerStage, upload_batch, TRIGGER_WORKERS
+from xnatuploader.plan import file_row, config_hash
+from xnatuploader.collate import collate_uploads, check_safe_dicom
+from xnatuploader.dedup import dedup_uploads
+from xnatuploader.workbook import (
+    read_filesheet,
+    copy_csv_to_spreadsheet,
+    get_csv_filename,
+)
+from xnatuploader.profiling import phase
+from xnatuploader.metrics import count
+
+logger = logging.getLogger(__name__)
+
+QUEUE_VERSION = 1
+LEASE_TIME = 600
+BUSY_TIMEOUT = 60
+QUEUE_POLL = 10
+
+SCHEMA = """
+CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE sessions (
+    label TEXT PRIMARY KEY,
+    state TEXT NOT NULL DEFAULT 'pending',
+    owner TEXT,
+    expires REAL,
+    attempts INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE uploads (
+    session_scan TEXT PRIMARY KEY,
+    session TEXT NOT NULL,
+    upload TEXT NOT NULL
+);
+CREATE TABLE files (
+    file TEXT PRIMARY KEY,
+    position INTEGER NOT NULL,
+    session_scan TEXT,
+    row TEXT NOT NULL
+);
+CREATE INDEX files_session_scan ON files (session_scan);
+"""
+
+
+class QueueError(Exception):
+    pass
+
+
+def worker_name():
+    """A name for this worker which is unique across hosts"""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class WorkQueue:
+    """
+    A queue of sessions to be uploaded, in an SQLite database, which any
+    number of worker processes can take work from. SQLite's file locking
+    keeps the workers from taking the same session, so the database needs
+    to be on a local disk or a shared filesystem where locking works.
+
+    Workers lease a session at a time. The lease runs out after a while
+    unless the worker renews it, which a LeaseKeeper does for as long as the
+    session is being uploaded, so a session whose worker has died is given
+    to another worker once the lease expires. A worker's reports are only
+    accepted while it holds the lease.
+
+    The rows for files which aren't being uploaded are kept as well, with
+    each file's position in the spreadsheet, so that the results can be
+    written back in the original order.
+    """
+
+    def __init__(self, path, timeout=BUSY_TIMEOUT):
+        """
+        path: pathlib.Path of an existing queue
+        timeout: float - seconds to wait for another process's lock
+        """
+        if not path.is_file():
+            raise QueueError(f"No upload queue at {path}")
+        self.path = path
+        self.db = sqlite3.connect(path, timeout=timeout, isolation_level=None)
+        version = self.meta("version")
+        if version != str(QUEUE_VERSION):
+            raise QueueError(f"{path} is from a different version")
+
+    @classmethod
+    def create(cls, path, config, skip, uploads, positions):
+        """
+        Create a new queue from the results of collate_uploads. It's built in
+        a temporary file which is renamed, so workers never see a queue which
+        is partly written.
+        ---
+        path: pathlib.Path
+        config: str - config_hash of the matcher
+        skip: list of FileMatch
+        uploads: dict of str: Upload
+        positions: dict of { str: int } - each file's row in the spreadsheet
+
+        returns: WorkQueue
+        """
+        if path.exists():
+            raise QueueError(
+                f"There's already an upload queue at {path}: collect its "
+                "results or delete it first"
+            )
+        tmp = path.with_name(path.name + ".tmp")
+        if tmp.exists():
+            tmp.unlink()
+        db = sqlite3.connect(tmp)
+        with db:
+            db.executescript(SCHEMA)
+            db.executemany(
+                "INSERT INTO meta VALUES (?, ?)",
+                [("version", str(QUEUE_VERSION)), ("config", config)],
+            )
+            db.executemany(
+                "INSERT INTO files VALUES (?, ?, NULL, ?)",
+                [
+                    (f.file, positions[f.file], json.dumps(file_row(f), default=str))
+                    for f in skip
+                ],
+            )
+            sessions = []
+            for session_scan, upload in uploads.items():
+                if upload.session_label not in sessions:
+                    sessions.append(upload.session_label)
+                db.execute(
+                    "INSERT INTO uploads VALUES (?, ?, ?)",
+                    (
+                        session_scan,
+                        upload.session_label,
+                        json.dumps(asdict(upload), default=str),
+                    ),
+                )
+                db.executemany(
+                    "INSERT INTO files VALUES (?, ?, ?, ?)",
+                    [
+                        (
+                            f.file,
+                            positions[f.file],
+                            session_scan,
+                            json.dumps(file_row(f), default=str),
+                        )
+                        for f in upload.files
+                    ],
+                )
+            db.executemany(
+                "INSERT INTO sessions (label) VALUES (?)", [(s,) for s in sessions]
+            )
+        db.close()
+        os.replace(tmp, path)
+        logger.info(f"Queued {len(sessions)} sessions in {path}")
+        return cls(path)
+
+    def meta(self, key):
+        try:
+            row = self.db.execute(
+                "SELECT value FROM meta WHERE key = ?", (key,)
+            ).fetchone()
+        except sqlite3.DatabaseError as e:
+            raise QueueError(f"{self.path} isn't an upload queue: {e}")
+        return row[0] if row else None
+
+    def close(self):
+        self.db.close()
+
+    def lease(self, owner, lease_time=LEASE_TIME):
+        """
+        Take the next session which is waiting, or whose lease has expired
+        ---
+        owner: str - the worker's name
+        lease_time: float - seconds
+
+        returns: tuple of ( str session label, int attempts ), or None if
+            there's nothing to do at the moment
+        """
+        now = time.time()
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            row = self.db.execute(
+                "SELECT label, state, owner, attempts FROM sessions "
+                "WHERE state = 'pending' OR (state = 'leased' AND expires < ?) "
+                "ORDER BY rowid LIMIT 1",
+                (now,),
+            ).fetchone()
+            if row is None:
+                self.db.execute("COMMIT")
+                return None
+            label, state, previous, attempts = row
+            self.db.execute(
+                "UPDATE sessions SET state = 'leased', owner = ?, expires = ?, "
+                "attempts = attempts + 1 WHERE label = ?",
+                (owner, now + lease_time, label),
+            )
+            self.db.execute("COMMIT")
+        except BaseException:
+            self.db.execute("ROLLBACK")
+            raise
+        if state == "leased":
+            logger.warning(f"Lease on {label} held by {previous} expired: reclaiming")
+        return label, attempts + 1
+
+    def renew(self, label, owner, lease_time=LEASE_TIME):
+        """
+        Extend a lease. Returns False if the worker no longer holds it.
+        """
+        cursor = self.db.execute(
+            "UPDATE sessions SET expires = ? "
+            "WHERE label = ? AND owner = ? AND state = 'leased'",
+            (time.time() + lease_time, label, owner),
+        )
+        return cursor.rowcount == 1
+
+    def report(self, label, owner, row):
+        """
+        Record the spreadsheet row for a file in a leased session. Returns
+        False, and doesn't record it, if the worker no longer holds the lease.
+        """
+        cursor = self.db.execute(
+            "UPDATE files SET row = ? WHERE file = ? AND EXISTS ("
+            "SELECT 1 FROM sessions WHERE label = ? AND owner = ? "
+            "AND state = 'leased')",
+            (json.dumps(row, default=str), row[1], label, owner),
+        )
+        return cursor.rowcount == 1
+
+    def finish(self, label, owner):
+        """
+        Mark a leased session as done. Returns False, and leaves it for
+        another worker, if the worker no longer holds the lease or it has
+        expired.
+        """
+        cursor = self.db.execute(
+            "UPDATE sessions SET state = 'done', expires = NULL "
+            "WHERE label = ? AND owner = ? AND state = 'leased' AND expires >= ?",
+            (label, owner, time.time()),
+        )
+        return cursor.rowcount == 1
+
+    def release(self, label, owner):
+        """
+        Give a session back so that another worker can take it straight away
+        """
+        self.db.execute(
+            "UPDATE sessions SET state = 'pending', owner = NULL, expires = NULL "
+            "WHERE label = ? AND owner = ? AND state = 'leased'",
+            (label, owner),
+        )
+
+    def load(self, label, matcher):
+        """
+        Returns a dict of the Uploads for a session, with the files which
+        haven't been uploaded yet
+        ---
+        label: str
+        matcher: the Matcher used to rebuild the FileMatch objects
+
+        returns: dict of str: Upload
+        """
+        upload_fields = [f.name for f in fields(Upload)]
+        uploads = {}
+        for session_scan, values in self.db.execute(
+            "SELECT session_scan, upload FROM uploads WHERE session = ? "
+            "ORDER BY rowid",
+            (label,),
+        ).fetchall():
+            values = json.loads(values)
+            upload = Upload(**{f: values[f] for f in upload_fields})
+            for (row,) in self.db.execute(
+                "SELECT row FROM files WHERE session_scan = ? ORDER BY position",
+                (session_scan,),
+            ):
+                file = matcher.from_spreadsheet(json.loads(row))
+                if file.status != "success":
+                    upload.files.append(file)
+            uploads[session_scan] = upload
+        return uploads
+
+    def states(self):
+        """
+        Returns a dict of the number of sessions in each state
+        """
+        return dict(
+            self.db.execute("SELECT state, COUNT(*) FROM sessions GROUP BY state")
+        )
+
+    def next_expiry(self):
+        """
+        Returns the time at which the next lease expires, or None
+        """
+        row = self.db.execute(
+            "SELECT MIN(expires) FROM sessions WHERE state = 'leased'"
+        ).fetchone()
+        return row[0]
+
+    def rows(self):
+        """
+        Generator which yields every file's row in spreadsheet order
+        """
+        for (row,) in self.db.execute("SELECT row FROM files ORDER BY position"):
+            yield json.loads(row)
+
+
+class LeaseKeeper:
+    """
+    Renews the lease on a session from a background thread every quarter of
+    the lease time for as long as it's open, so that a slow file, a long
+    retry backoff or a pause in the bandwidth schedule doesn't let the lease
+    run out while the session is still being uploaded. The thread has its
+    own connection to the queue, because SQLite connections can't be shared
+    between threads.
+
+        with LeaseKeeper(queue, label, owner, lease_time):
+            upload_batch(...)
+    """
+
+    def __init__(self, queue, label, owner, lease_time=LEASE_TIME):
+        """
+        queue: WorkQueue
+        label: str - the leased session
+        owner: str - the worker's name
+        lease_time: float - seconds
+        """
+        self.path = queue.path
+        self.label = label
+        self.owner = owner
+        self.lease_time = lease_time
+        self.lost = False
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="lease", daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stopped.set()
+        self.thread.join()
+
+    def run(self):
+        queue = WorkQueue(self.path)
+        try:
+            while not self.stopped.wait(self.lease_time / 4):
+                try:
+                    renewed = queue.renew(self.label, self.owner, self.lease_time)
+                except sqlite3.Error as e:
+                    logger.warning(f"Couldn't renew the lease on {self.label}: {e}")
+                    continue
+                if not renewed:
+                    self.lost = True
+                    logger.error(
+                        f"Lost the lease on {self.label}: another worker has "
+                        "taken it over"
+                    )
+                    break
+        finally:
+            queue.close()
+
+
+class QueueWriter:
+    """
+    Stands in for the csv.writer which upload_batch writes each file's row
+    to, and reports the rows to the queue instead
+    """
+
+    def __init__(self, queue, label, owner):
+        self.queue = queue
+        self.label = label
+        self.owner = owner
+        self.lost = False
+
+    def writerow(self, row):
+        if self.lost:
+            return
+        if not self.queue.report(self.label, self.owner, row):
+            self.lost = True
+            logger.error(
+                f"Lost the lease on {self.label}: another worker has taken it over"
+            )
+
+
+def enqueue(matcher, spreadsheet, strict_scan_ids=False, dedup=False):
+    """
+    Collate the files selected for upload in the spreadsheet and put them in
+    a work queue next to it, from which any number of worker processes can
+    upload them with work. The results are written back to the spreadsheet
+    by collect.
+    ---
+    matcher: a Matcher
+    spreadsheet: pathlib.Path
+    strict_scan_ids: boolean
+    dedup: boolean - only queue one copy of files which are duplicates
+    """
+    with phase("sheet read"):
+        files = list(read_filesheet(spreadsheet, matcher))
+    positions = {file.file: i for i, file in enumerate(files)}
+    with phase("collate"):
+        skip, uploads = collate_uploads(files, strict_scan_ids, check_safe_dicom)
+    if dedup:
+        with phase("dedup"):
+            skip += dedup_uploads(uploads)
+    count("files_skipped", n=len(skip))
+    queue = WorkQueue.create(
+        get_queue_filename(spreadsheet),
+        config_hash(matcher, strict_scan_ids),
+        skip,
+        uploads,
+        positions,
+    )
+    queue.close()
+
+
+def work(
+    xnat_session,
+    matcher,
+    project,
+    spreadsheet,
+    anon_rules=None,
+    anonymize_files=False,
+    strict_scan_ids=False,
+    overwrite=False,
+    no_pipeline=False,
+    retry=None,
+    concurrency=None,
+    throttle=None,
+    trigger_workers=TRIGGER_WORKERS,
+    lease_time=LEASE_TIME,
+    poll=QUEUE_POLL,
+    name=None,
+):
+    """
+    Take sessions from the work queue made by enqueue one at a time and
+    upload them, reporting the status of each file back to the queue, until
+    every session in the queue has been done.
+
+    When there's nothing left to take but other workers still hold leases,
+    waits for them so that it can take over any sessions whose worker has
+    died. A session which was taken over is uploaded with overwrite on, as
+    some of its files may have been uploaded without being reported.
+
+    If the user confirms a KeyboardInterrupt, or the project can't be
+    written to, the current session is handed back to the queue and the
+    worker stops.
+    ---
+    xnat_session: an XnatPy session
+    matcher: a Matcher
+    project: the XNAT project id
+    spreadsheet: pathlib.Path
+    retry: RetryScheduler or None for the default
+    concurrency: AIMDController or None to upload one file at a time
+    throttle: Throttle or None to upload at full speed
+    trigger_workers: int - how many sessions to trigger pipelines for at once
+    lease_time: float - seconds a session is held for without being renewed
+    poll: float - longest wait for other workers' leases, in seconds
+    name: str - the worker's name in the queue, defaults to host:pid
+    """
+    queue = WorkQueue(get_queue_filename(spreadsheet))
+    if queue.meta("config") != config_hash(matcher, strict_scan_ids):
+        raise QueueError(
+            "The queue was made with a different configuration or --strict setting"
+        )
+    name = name or worker_name()
+    if no_pipeline:
+        stage = nullcontext()
+    else:
+        stage = TriggerStage(xnat_session, project, trigger_workers)
+    sessions = 0
+    with stage as triggers:
+        while True:
+            leased = queue.lease(name, lease_time)
+            if leased is None:
+                expires = queue.next_expiry()
+                if expires is None:
+                    break
+                time.sleep(min(poll, max(expires - time.time(), 0) + 0.1))
+                continue
+            label, attempts = leased
+            logger.info(f"Uploading session {label}")
+            count("queue_leases", "retaken" if attempts > 1 else "new")
+            uploads = queue.load(label, matcher)
+            writer = QueueWriter(queue, label, name)
+            with LeaseKeeper(queue, label, name, lease_time):
+                keyboard_quit, abandoned = upload_batch(
+                    xnat_session,
+                    project,
+                    uploads,
+                    writer,
+                    anonymize_files=anonymize_files,
+                    overwrite=overwrite or attempts > 1,
+                    anon_rules=anon_rules,
+                    retry=retry,
+                    concurrency=concurrency,
+                    throttle=throttle,
+                    triggers=triggers,
+                )
+            if keyboard_quit or abandoned:
+                queue.release(label, name)
+                break
+            if not queue.finish(label, name):
+                logger.error(
+                    f"Lost the lease on {label} before it was finished: leaving "
+                    "it to the worker which took it over"
+                )
+                count("queue_leases", "lost")
+                continue
+            sessions += 1
+    logger.info(f"Worker {name} uploaded {sessions} sessions")
+    queue.close()
+
+
+def collect(matcher, spreadsheet):
+    """
+    Write the results from the work queue back to the spreadsheet, with the
+    files in their original order. If every session has been done, the
+    queue is removed once the spreadsheet has been saved.
+    ---
+    matcher: a Matcher
+    spreadsheet: pathlib.Path
+    """
+    queuefile = get_queue_filename(spreadsheet)
+    queue = WorkQueue(queuefile)
+    states = queue.states()
+    unfinished = sum(n for state, n in states.items() if state != "done")
+    if unfinished:
+        logger.warning(
+            f"{unfinished} sessions haven't been uploaded yet: their files "
+            "will be left as they were"
+        )
+    csvout = get_csv_filename(spreadsheet)
+    with open(csvout, "w", newline="") as cfh:
+        csvw = csv.writer(cfh)
+        for row in queue.rows():
+            csvw.writerow(row)
+    queue.close()
+    with phase("sheet write"):
+        copied = copy_csv_to_spreadsheet(matcher, csvout, spreadsheet)
+    if copied and not unfinished:
+        queuefile.unlink()
+        logger.info(f"All sessions done: removed {queuefile}")
+
+
+def get_queue_filename(spreadsheet):
+    return spreadsheet.with_suffix(".queue.db")
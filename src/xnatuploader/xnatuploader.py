@@ -1,386 +1,80 @@
 #!/usr/bin/env python
 
 import argparse
-import csv
 import logging
-from tqdm import tqdm
 from pathlib import Path
-import xnatutils
-import click
-import re
 
-from importlib.metadata import version
-
-__version__ = version("xnatuploader")
-
-from openpyxl import load_workbook
-
-from xnatuploader.matcher import Matcher, ExtractException
-from xnatuploader.dicoms import dicom_extractor, XNATFileMatch, SPREADSHEET_FIELDS
-from xnatuploader.workbook import new_workbook, add_filesheet, load_config
-from xnatuploader.upload import Upload, trigger_pipelines, parse_allow_fields
-
-from xnatutils.base import sanitize_re
-
-FILE_COLUMN_WIDTH = 50
-
-DEBUG_MAX = 10
-
-IGNORE_FILES = [".DS_Store"]
-
-KEYBOARD_QUIT_STATUS = "Upload interrupted by user"
-CONFIRM_KEYBOARD_QUIT_MSG = "Are you sure that you want to quit uploading?"
-
-# re which matches errors that indicate that the project doesn't exist on
-# XNAT or permissions are wrong: if this is encountered, the whole upload
-# should be abandoned rather than repeatedly trying for each set of files
-
-CANNOT_CREATE_RE = re.compile("Cannot create session")
+from xnatuploader import get_version
+from xnatuploader.matcher import Matcher, MatchTrace
+from xnatuploader.dicoms import (
+    dicom_extractor,
+    set_legacy_dicom,
+    XNATFileMatch,
+    SPREADSHEET_FIELDS,
+)
+from xnatuploader.workbook import (
+    new_workbook,
+    load_config,
+    load_hidden_fields,
+)
+from xnatuploader.scan import scan, DEBUG_MAX
+from xnatuploader.upload import upload, parse_allow_fields, TRIGGER_WORKERS
+from xnatuploader.profiling import (
+    phase,
+    start_profiling,
+    stop_profiling,
+    PROFILE_SAMPLE,
+)
+from xnatuploader.metrics import start_metrics, stop_metrics, METRICS_INTERVAL
+from xnatuploader.watch import watch, IGNORE_FILES, QUIET_PERIOD, POLL_INTERVAL
+from xnatuploader.retry import RetryScheduler, RETRY_ATTEMPTS
+from xnatuploader.concurrency import AIMDController, MIN_WORKERS
+from xnatuploader.throttle import Throttle, Schedule
+from xnatuploader.tracing import (
+    start_tracing,
+    stop_tracing,
+    TRACE_FILE,
+    CHROME_TRACE_FILE,
+)
+from xnatuploader.shard import scan_shard, merge, parse_shard, get_shards_dirname
+from xnatuploader.workqueue import enqueue, work, collect, worker_name, LEASE_TIME
+from xnatuploader.checksum import set_digest_cache, CHECKSUM_FIELD
+from xnatuploader.digestcache import DigestCache, default_cache_path
+from xnatuploader.filelist import read_file_list, open_file_list
+from xnatuploader.dicomdir import DicomdirExtractor, index_required
+
+# these were defined here before the operations had their own modules
+
+from xnatuploader.collate import (  # noqa: F401
+    collate_uploads,
+    sanitise_dataset_names,
+    check_safe_dicom,
+)
+from xnatuploader.upload import log_failure, dry_run  # noqa: F401
+from xnatuploader.workbook import (  # noqa: F401
+    copy_csv_to_spreadsheet,
+    get_csv_filename,
+)
+
+MATCH_TRACE_FILE = "match_trace.jsonl"
+
+# the operations are run by these modules, which log to the same places as
+# this one
+
+OPERATION_LOGGERS = [
+    "xnatuploader.scan",
+    "xnatuploader.collate",
+    "xnatuploader.upload",
+    "xnatuploader.workbook",
+    "xnatuploader.shard",
+    "xnatuploader.watch",
+    "xnatuploader.workqueue",
+    "xnatuploader.plan",
+]
 
 logger = logging.getLogger(__name__)
 
 
-def scan(
-    matcher,
-    root,
-    spreadsheet,
-    include_unmatched=True,
-    strict_scan_ids=False,
-    debug=False,
-):
-    """
-    Scan the filesystem under root for files which match recipes and write
-    out the resulting values to a new worksheet in the spreadsheet.
-
-    If the debug flag is true, only try to match DEBUG_MAX files
-    ---
-    matcher: a Matcher
-    root: pathlib.Path
-    spreadsheet: pathlib.Path
-    include_unmatched: boolean
-    debug: boolean
-    """
-    logger.info(f"Loading {spreadsheet}")
-    wb = load_workbook(spreadsheet)
-    ws = add_filesheet(wb, matcher, debug)  # keeps old sheets if debug=True
-    logger.info("Preparing file list")
-    filepaths = sorted(
-        [f for f in root.glob("**/*") if f.is_file() and f.name not in IGNORE_FILES]
-    )
-    files = []
-    unmatched = []
-    if debug:
-        filepaths = filepaths[:DEBUG_MAX]
-    logger.info(f"Scanning directory {root}")
-    for filepath in tqdm(filepaths):
-        if filepath.is_file():
-            logger.debug(f"Scanning {filepath}")
-            file = matcher.match(root, filepath)
-            if file.success:
-                logger.debug(f"Matched {file.file}")
-                files.append(file)
-            else:
-                if include_unmatched:
-                    file.load_dicom()
-                    unmatched.append(file)
-
-    skips, uploads = collate_uploads(files, strict_scan_ids)
-
-    ns = len(uploads)
-    nm = len(files)
-    num = len(unmatched)
-
-    if include_unmatched:
-        logger.info(
-            f"Saving {ns} scans with {nm} matching files and {num} non-matching files to {spreadsheet}"
-        )
-    else:
-        logger.info(f"Saving {ns} scans with {nm} matching files to {spreadsheet}")
-
-    for session_scan, upload in tqdm(uploads.items(), desc="Scans"):
-        for file in upload.files:
-            ws.append(file.columns)
-
-    if include_unmatched:
-        for file in unmatched:
-            ws.append(file.columns)
-
-    wb.save(spreadsheet)
-
-
-def upload(
-    xnat_session,
-    matcher,
-    project,
-    spreadsheet,
-    anon_rules=None,
-    anonymize_files=False,
-    strict_scan_ids=False,
-    test=False,
-    overwrite=False,
-    no_pipeline=False,
-):
-    """
-    Load an Excel spreadsheet created with scan and upload the files which the user
-    has marked for upload, and which haven't been uploaded yet. Keeps track of
-    successful uploads in the "status" column.
-
-    Progress is written out to a temporary csv file. Files which are not being
-    uploaded on this pass (because they were already uploaded, or because they
-    weren't selected for upload) are still written out to the csv file.
-
-    Exceptions during uploading are trapped and logged as failures in the
-    spreadsheet, unless they're a KeyboardInterrupt. If one of these is
-    recieved, the user is prompted to confirm that they want to stop, and then
-    the files which haven't yet been uploaded are written out to the csv with
-    a status message about the interrupt.
-    ---
-    xnat_session: an XnatPy session, as returned by xnatutils.base.connect
-    matcher: a Matcher
-    project: the XNAT project id to which we're uploading
-    spreadsheet: pathlib.Path to the Excel spreadsheet listing files
-    overwrite: Boolean, used to set the overwrite flag on xnatutils for testing
-    """
-    wb = load_workbook(spreadsheet)
-    ws = wb["Files"]
-    header = True
-    files = []
-    for row in ws.values:
-        if header:
-            header = False
-        else:
-            matchfile = matcher.from_spreadsheet(row)
-            files.append(matchfile)
-    skip, uploads = collate_uploads(files, strict_scan_ids)
-    csvout = get_csv_filename(spreadsheet)
-    if test:
-        dry_run(uploads)
-        return
-    written = {}
-    abandoned = False
-    with open(csvout, "w", newline="") as cfh:
-        csvw = csv.writer(cfh)
-        for file in skip:
-            csvw.writerow(file.columns)
-        keyboard_quit = False
-        for session_scan, upload in tqdm(uploads.items(), desc="Sessions"):
-            logger.debug(f"Uploading {session_scan}")
-            try:
-                upload.start_upload(xnat_session, project)
-                for file in tqdm(upload.files, desc=session_scan):
-                    logger.debug(f"Uploading {file.file}")
-                    try:
-                        status = upload.upload(
-                            [file],
-                            anonymize_files=anonymize_files,
-                            overwrite=overwrite,
-                            anon_rules=anon_rules,
-                        )
-                        file.status = status[file.file]
-                    except KeyboardInterrupt:
-                        if click.confirm(CONFIRM_KEYBOARD_QUIT_MSG):
-                            keyboard_quit = True
-                            logger.warning(
-                                f"KeyboardInterrupt in file loop {file.file}"
-                            )
-                            break
-                    except Exception as e:
-                        file.status = log_failure(f"File {file.file}", e)
-                    csvw.writerow(file.columns)
-                    written[file.file] = True
-            except KeyboardInterrupt:
-                if click.confirm(CONFIRM_KEYBOARD_QUIT_MSG):
-                    keyboard_quit = True
-                    logger.warning("KeyboardInterrupt in dataset loop")
-                    break
-            except Exception as e:
-                if CANNOT_CREATE_RE.match(str(e)):
-                    log_failure(f"Dataset {upload.label}", e)
-                    logger.error(
-                        f"Check that project {project} exists and "
-                        "you have upload permissions"
-                    )
-                    abandoned = True
-                    break
-                status = log_failure(f"Dataset {upload.label}", e)
-                for file in upload.files:
-                    file.status = status
-                    csvw.writerow(file.columns)
-                    written[file.file] = True
-            if keyboard_quit:
-                break
-        if not no_pipeline:
-            trigger_pipelines(xnat_session, project, uploads)
-
-        if keyboard_quit:
-            for _, upload in tqdm(uploads.items(), desc="Updating spreadsheet"):
-                for file in upload.files:
-                    if file.file not in written:
-                        file.status = KEYBOARD_QUIT_STATUS
-                        csvw.writerow(file.columns)
-    if not abandoned:
-        copy_csv_to_spreadsheet(matcher, csvout, spreadsheet)
-
-
-def log_failure(label, e):
-    """Write a message about a file or dataset upload failure to the logs,
-    and return a value to be recorded in the spreadsheet. It's in its own
-    function to make the loop in upload a bit easier to read.
-    """
-    error = str(e)
-    logger.error(f"{label} exception: {error}")
-    return error
-
-
-def dry_run(uploads):
-    """Just logs what would be uploaded - broken out of the main upload
-    loop because it doesn't need to do anything else
-    ---
-    uploads: list of Upload
-    """
-    for session_label, upload in uploads.items():
-        logger.debug(f"Uploading {session_label}")
-        upload.log(logger)
-
-
-def copy_csv_to_spreadsheet(matcher, csvout, spreadsheet):
-    """Copies the csv of uploaded files to the Files worksheet of the
-    spreadsheet. If it can't, tells the user that the results are in the csv
-    file.
-    This function always clobbers the Files worksheet with its updated value,
-    unlike scan, which can save old versions of Files when running in debug
-    mode.
-    """
-    wb = load_workbook(spreadsheet)
-    ws = add_filesheet(wb, matcher, False)
-    logger.debug(f"Copying upload results from {csvout} to {spreadsheet}")
-    with open(csvout, "r") as cfh:
-        for row in csv.reader(cfh):
-            ws.append(row)
-    try:
-        wb.save(spreadsheet)
-    except PermissionError:
-        logger.error(
-            f"""
-A permissions error prevented the script from writing the upload results back
-to {spreadsheet}.  If you are on Windows, this may be because you still have
-the spreadsheet open in Excel.
-
-The results are available as a CSV file: {csvout}
-"""
-        )
-
-
-def collate_uploads(files, strict_scan_ids):
-    """
-    Takes a list of files and collates them by subject (patient), visit
-    index (starting from the earliest), scan type, and (optionally) scan_id,
-    returning a list of files which have skipped or already uploaded and a dictionary
-    of Uploads keyed by {session_label}_{scan_id}
-
-    ---
-    files: list of FileMatch
-
-    returns: tuple of ( list of FileMatch, dict of str: Upload )
-    """
-
-    subjects = {}
-    skip = []
-    for file in files:
-        if not file.selected:
-            skip.append(file)
-        else:
-            if file.status == "success":
-                logger.debug(f"skipping file already uploaded {file.file}")
-                skip.append(file)
-            else:
-                if not check_safe_dicom(file):
-                    skip.append(file)
-                else:
-                    if file["Subject"] not in subjects:
-                        subjects[file["Subject"]] = []
-                    subjects[file["Subject"]].append(file)
-    uploads = {}
-    for subject_id, files in subjects.items():
-        dates = sorted(set([file.study_date for file in files]))
-        visits = {dates[i]: i + 1 for i in range(len(dates))}
-        clean_datasets = sanitise_dataset_names(files)
-        for file in files:
-            visit = visits[file.study_date]
-            modality = file.modality
-            scan_id = file.series_number
-            if strict_scan_ids:
-                session_label = f"{subject_id}_{modality}{visit}_{scan_id}"
-            else:
-                session_label = f"{subject_id}_{modality}{visit}"
-            file.session_label = session_label
-            scan_type = clean_datasets[file.dataset]
-            session_scan = f"{session_label}:{scan_type}"
-            if session_scan not in uploads:
-                uploads[session_scan] = Upload(
-                    session_label=session_label,
-                    subject=subject_id,
-                    date=file.study_date,
-                    modality=modality,
-                    series_number=scan_id,
-                    scan_type=scan_type,
-                    strict_scan_ids=strict_scan_ids,
-                    manufacturer=file.manufacturer,
-                    model=file.model,
-                )
-            uploads[session_scan].add_file(file)
-    return skip, uploads
-
-
-def sanitise_dataset_names(files):
-    """
-    For a list of files, sanitise the .dataset values (replace characters which
-    XNAT doesn't allow in a resource id with '_') and then make sure that the
-    datasets are all still unique by appending 1, 2, etc to them.
-
-    Returns a dict which maps the original datasets to sanitised values
-    ---
-    files: list of FileMatch
-
-    returns: dict of str: str
-    """
-    clean = {}
-    used = []
-    for file in files:
-        if file.dataset not in clean:
-            base = sanitize_re.sub("_", file.dataset)
-            sanitised = base
-            i = 1
-            while sanitised in used:
-                i += 1
-                sanitised = base + str(i)
-            clean[file.dataset] = sanitised
-            used.append(sanitised)
-    return clean
-
-
-def check_safe_dicom(file):
-    """Extra test to make sure that we don't try to upload a dicom with one
-    of the forbidden conditions, even though this is tested for at scan time"""
-    try:
-        dicom_extractor(file.file)
-        return True
-    except ExtractException as e:
-        logger.warning(f"Skipping bad file {file.file}: {e}")
-    except Exception as e:
-        logger.warning(f"Can't upload {file.file}: {e}")
-    return False
-
-
-def get_csv_filename(spreadsheet):
-    csv = spreadsheet.with_suffix(".csv")
-    n = 0
-    while csv.is_file():
-        n += 1
-        csv = spreadsheet.parent / Path(f"{spreadsheet.stem}.{n}.csv")
-    return csv
-
-
 def show_help():
     print(
         """
@@ -399,11 +93,30 @@ configuration page.
 Scans the directory provided with the --dir flag and builds a file list in
 the spreadsheet
 
+    xnatuploader --spreadsheet sheet.xlsx --dir ./source/ --shard 2/8 scan
+    xnatuploader --spreadsheet sheet.xlsx merge
+
+Scans one of eight shards of the directory, so that the scan can be split
+between processes or nodes, and then merges the shards into the file list
+
+    xnatuploader --spreadsheet sheet.xlsx queue
+    xnatuploader --spreadsheet sheet.xlsx work
+    xnatuploader --spreadsheet sheet.xlsx collect
+
+Puts the files selected for upload into a work queue next to the
+spreadsheet, uploads them with as many workers as are started on the queue,
+and then writes the results back to the spreadsheet
+
     xnatuploader --spreadsheet sheet.xlsx --dir ./source upload
 
 Uploads the files recorded in the spreadsheet, to the server and project
 specified in the config worksheet.
 
+    xnatuploader --spreadsheet sheet.xlsx --dir ./incoming watch
+
+Watches the directory for new files and uploads them once the directory
+they're in hasn't changed for --quietperiod seconds.
+
 For more detailed instructions on how to configure xnatuploader to capture
 parameters from filepaths, refer to the "Configuration" worksheet in the
 spreadsheet, or visit the online documentation at:
@@ -436,6 +149,23 @@ def opt_or_config(args, config, param):
     return value
 
 
+class VersionAction(argparse.Action):
+    """
+    Like argparse's "version" action, but the version is only looked up if
+    the flag is used
+    """
+
+    def __init__(self, option_strings, dest=argparse.SUPPRESS, **kwargs):
+        kwargs.setdefault("help", "show program's version number and exit")
+        super().__init__(
+            option_strings, dest, nargs=0, default=argparse.SUPPRESS, **kwargs
+        )
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        print(f"{parser.prog} {get_version()}")
+        parser.exit()
+
+
 def main():
     ap = argparse.ArgumentParser("XNAT batch uploader")
     ap.add_argument(
@@ -453,7 +183,7 @@ def main():
         default=False,
         help=f"""
 Debug mode: only attempt to match {DEBUG_MAX} patterns and generates a lot of
-debug messages
+debug messages, and a trace of why each path did or didn't match
 """,
     )
     ap.add_argument(
@@ -495,11 +225,191 @@ debug messages
         default=False,
         help="Don't trigger the metadata extraction and pipeline",
     )
-    ap.add_argument("--version", action="version", version="%(prog)s " + __version__)
+    ap.add_argument(
+        "--triggerworkers",
+        type=int,
+        default=TRIGGER_WORKERS,
+        help="Number of sessions to trigger the pipelines for at once",
+    )
+    ap.add_argument(
+        "--retries",
+        type=int,
+        default=RETRY_ATTEMPTS,
+        help="Number of times to try each upload before giving up on server errors",
+    )
+    ap.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Maximum number of files to upload at once: with more than one, "
+        "the number is adjusted to the server's response times",
+    )
+    ap.add_argument(
+        "--minworkers",
+        type=int,
+        default=MIN_WORKERS,
+        help="Minimum number of files to upload at once with --workers",
+    )
+    ap.add_argument(
+        "--bandwidth",
+        type=str,
+        help="Upload bandwidth limit or schedule, overriding the Bandwidth "
+        'setting in the config, for example "20:00-06:00 unlimited, 20MB/s"',
+    )
+    ap.add_argument(
+        "--quietperiod",
+        type=float,
+        default=QUIET_PERIOD,
+        help="watch: seconds a directory must be unchanged before its new "
+        "files are uploaded",
+    )
+    ap.add_argument(
+        "--pollinterval",
+        type=float,
+        default=POLL_INTERVAL,
+        help="watch: seconds between checks for changes",
+    )
+    ap.add_argument(
+        "--noinotify",
+        action="store_true",
+        default=False,
+        help="watch: poll for changes even if inotify is available",
+    )
+    ap.add_argument(
+        "--shard",
+        type=str,
+        help="scan: only scan shard i of N, given as i/N, and write a partial "
+        "manifest to be combined with merge",
+    )
+    ap.add_argument(
+        "--shardsdir",
+        type=Path,
+        default=None,
+        help="Directory for the partial manifests written by scan --shard "
+        "and read by merge (default: next to the spreadsheet)",
+    )
+    ap.add_argument(
+        "--filelist",
+        type=Path,
+        default=None,
+        help="scan: read the paths to scan from this file, or - for stdin, "
+        "instead of walking --dir. Each line is a path, relative to --dir or "
+        "under it, optionally followed by its size, separated by a tab",
+    )
+    ap.add_argument(
+        "--null",
+        action="store_true",
+        default=False,
+        help="scan: the entries in --filelist are separated by NUL characters, "
+        "as written by find -print0, rather than newlines",
+    )
+    ap.add_argument(
+        "--dicomdir",
+        action="store_true",
+        default=False,
+        help="scan: take the DICOM values for files listed in a DICOMDIR from "
+        "it, and only open the files which it doesn't have everything for",
+    )
+    ap.add_argument(
+        "--legacydicom",
+        action="store_true",
+        default=False,
+        help="Read files with no DICM marker as DICOMs if they start with a "
+        "DICOM element, for old files written without a preamble",
+    )
+    ap.add_argument(
+        "--leasetime",
+        type=float,
+        default=LEASE_TIME,
+        help="work: seconds before a session whose worker has stopped "
+        "renewing its lease is given to another worker",
+    )
+    ap.add_argument(
+        "--checksums",
+        action="store_true",
+        default=False,
+        help="scan, merge: record the MD5 digest of each matched file in a "
+        "hidden column, so that upload doesn't need to read unchanged files "
+        "again to check them",
+    )
+    ap.add_argument(
+        "--digestcache",
+        type=Path,
+        nargs="?",
+        const=default_cache_path(),
+        default=None,
+        help="Keep file digests in a database which persists between runs, so "
+        "that unchanged files aren't read again to check them (default "
+        f"location: {default_cache_path()})",
+    )
+    ap.add_argument(
+        "--dedup",
+        action="store_true",
+        default=False,
+        help="upload, queue: only upload one copy of files with the same "
+        "contents and SOPInstanceUID, and mark the others as duplicates",
+    )
+    ap.add_argument(
+        "--extsort",
+        action="store_true",
+        default=False,
+        help="Collate uploads with an on-disk sort and stream the spreadsheet, "
+        "to limit memory use",
+    )
+    ap.add_argument(
+        "--plan",
+        action="store_true",
+        default=False,
+        help="Save the upload plan and reuse it if the spreadsheet hasn't changed",
+    )
+    ap.add_argument(
+        "--profile",
+        action="store_true",
+        default=False,
+        help="Time each phase of the run and write a profile to the log directory",
+    )
+    ap.add_argument(
+        "--profilesample",
+        type=int,
+        default=PROFILE_SAMPLE,
+        help="With --profile, run cProfile on one in this many calls of each phase",
+    )
+    ap.add_argument(
+        "--trace",
+        action="store_true",
+        default=False,
+        help=f"Write a trace of each upload stage to {TRACE_FILE} in the log "
+        f"directory, and convert it to {CHROME_TRACE_FILE}, which can be "
+        "loaded in chrome://tracing or Perfetto",
+    )
+    ap.add_argument(
+        "--metricsinterval",
+        type=float,
+        default=METRICS_INTERVAL,
+        help="Seconds between writes of the run metrics, or 0 to only write "
+        "them at the end",
+    )
+    ap.add_argument(
+        "--metricsdir",
+        type=Path,
+        default=None,
+        help="Directory to write run metrics to (defaults to the log directory)",
+    )
+    ap.add_argument("--version", action=VersionAction)
     ap.add_argument(
         "operation",
         default="scan",
-        choices=["init", "scan", "upload", "help"],
+        choices=[
+            "init",
+            "scan",
+            "merge",
+            "upload",
+            "watch",
+            "queue",
+            "work",
+            "collect",
+            "help",
+        ],
         help="Operation",
     )
     args = ap.parse_args()
@@ -511,13 +421,15 @@ debug messages
     if args.debug:
         loglevel = "DEBUG"
 
-    logger.setLevel(logging.DEBUG)
     logfh = logging.FileHandler(args.logdir / "xnatuploader.log")
     logfh.setLevel(args.loglevel.upper())
-    logger.addHandler(logfh)
     logch = logging.StreamHandler()
     logch.setLevel(args.loglevel.upper())
-    logger.addHandler(logch)
+    for name in [__name__] + OPERATION_LOGGERS:
+        log = logging.getLogger(name)
+        log.setLevel(logging.DEBUG)
+        log.addHandler(logfh)
+        log.addHandler(logch)
 
     if args.operation == "help":
         show_help()
@@ -528,50 +440,200 @@ debug messages
         logger.info(f"Initialised spreadsheet at {args.spreadsheet}")
         exit()
 
-    config = load_config(args.spreadsheet)
-
-    matcher = Matcher(
-        patterns=config["paths"],
-        mappings=config["mappings"],
-        fields=SPREADSHEET_FIELDS,
-        file_extractor=dicom_extractor,
-        match_class=XNATFileMatch,
-        loglevel=loglevel,
-    )
-
-    if args.operation == "scan":
-        scan(
-            matcher,
-            args.dir,
-            args.spreadsheet,
-            include_unmatched=args.unmatched,
-            strict_scan_ids=args.strict,
-            debug=args.debug,
-        )
-    else:
-        server = opt_or_config(args, config["xnat"], "Server")
-        project = opt_or_config(args, config["xnat"], "Project")
-        anon_rules = opt_or_config(args, config["xnat"], "AllowFields")
-        # not using opt_or_config for AllowFields as it's config only
-        anon_rules = {}
-        if "AllowFields" in config["xnat"]:
-            anon_rules = parse_allow_fields(config["xnat"]["AllowFields"])
-        logger.debug(f"Server = {server}")
-        logger.debug(f"Project = {project}")
-        xnat_session = xnatutils.base.connect(server)
-        logger.debug(f"main anon rules {anon_rules}")
-        upload(
-            xnat_session,
-            matcher,
-            project,
-            args.spreadsheet,
-            strict_scan_ids=args.strict,
-            anonymize_files=args.anonymize,
-            anon_rules=anon_rules,
-            test=args.test,
-            overwrite=args.overwrite,
-            no_pipeline=args.nopipeline,
+    if args.profile:
+        start_profiling(args.profilesample)
+    metricsdir = args.metricsdir or args.logdir
+    if not metricsdir.is_dir():
+        metricsdir.mkdir(parents=True)
+    shard = None
+    shards = None
+    metrics_name = None
+    if args.shard is not None:
+        shard, shards = parse_shard(args.shard)
+        metrics_name = f"scan_shard{shard}of{shards}"
+    if args.operation == "work":
+        metrics_name = "work_" + worker_name().replace(":", "_")
+    shardsdir = args.shardsdir or get_shards_dirname(args.spreadsheet)
+    start_metrics(args.operation, metricsdir, args.metricsinterval, metrics_name)
+    if args.trace:
+        start_tracing(args.logdir / TRACE_FILE)
+    if args.digestcache is not None:
+        set_digest_cache(DigestCache(args.digestcache))
+    set_legacy_dicom(args.legacydicom)
+
+    try:
+        with phase("config"):
+            config = load_config(args.spreadsheet)
+
+        extractor = dicom_extractor
+        if args.dicomdir:
+            extractor = DicomdirExtractor(
+                dicom_extractor, index_required(config["mappings"]), root=args.dir
+            )
+        matcher = Matcher(
+            patterns=config["paths"],
+            mappings=config["mappings"],
+            fields=SPREADSHEET_FIELDS,
+            file_extractor=extractor,
+            match_class=XNATFileMatch,
+            loglevel=loglevel,
         )
+        if args.operation in ["upload", "queue", "work", "collect"]:
+            load_hidden_fields(args.spreadsheet, matcher, [CHECKSUM_FIELD])
+
+        if args.operation == "scan":
+            trace_fh = None
+            if args.debug:
+                trace_fh = open(args.logdir / MATCH_TRACE_FILE, "w")
+                matcher.trace = MatchTrace(trace_fh)
+            filelist_fh = None
+            filelist = None
+            if args.filelist is not None:
+                filelist_fh = open_file_list(args.filelist)
+                filelist = read_file_list(
+                    filelist_fh,
+                    args.dir,
+                    null=args.null,
+                    shard=shard,
+                    shards=shards,
+                    ignore=IGNORE_FILES,
+                    positions=shard is not None,
+                )
+            if shard is not None:
+                scan_shard(
+                    matcher,
+                    args.dir,
+                    shardsdir,
+                    shard,
+                    shards,
+                    include_unmatched=args.unmatched,
+                    strict_scan_ids=args.strict,
+                    debug=args.debug,
+                    checksums=args.checksums,
+                    filelist=filelist,
+                )
+            else:
+                scan(
+                    matcher,
+                    args.dir,
+                    args.spreadsheet,
+                    include_unmatched=args.unmatched,
+                    strict_scan_ids=args.strict,
+                    debug=args.debug,
+                    checksums=args.checksums,
+                    filelist=filelist,
+                )
+            if filelist_fh is not None:
+                filelist_fh.close()
+            if trace_fh is not None:
+                trace_fh.close()
+                logger.info(f"Match trace written to {args.logdir / MATCH_TRACE_FILE}")
+        elif args.operation == "merge":
+            merge(
+                matcher,
+                shardsdir,
+                args.spreadsheet,
+                strict_scan_ids=args.strict,
+                checksums=args.checksums,
+            )
+        elif args.operation == "queue":
+            enqueue(
+                matcher,
+                args.spreadsheet,
+                strict_scan_ids=args.strict,
+                dedup=args.dedup,
+            )
+        elif args.operation == "collect":
+            collect(matcher, args.spreadsheet)
+        else:
+            server = opt_or_config(args, config["xnat"], "Server")
+            project = opt_or_config(args, config["xnat"], "Project")
+            anon_rules = opt_or_config(args, config["xnat"], "AllowFields")
+            # not using opt_or_config for AllowFields as it's config only
+            anon_rules = {}
+            if "AllowFields" in config["xnat"]:
+                anon_rules = parse_allow_fields(config["xnat"]["AllowFields"])
+            logger.debug(f"Server = {server}")
+            logger.debug(f"Project = {project}")
+            import xnatutils.base
+
+            xnat_session = xnatutils.base.connect(server)
+            logger.debug(f"main anon rules {anon_rules}")
+            retry = RetryScheduler(attempts=args.retries)
+            concurrency = AIMDController(args.minworkers, args.workers)
+            throttle = None
+            bandwidth = args.bandwidth or config["xnat"].get("Bandwidth")
+            if bandwidth is not None:
+                schedule = Schedule.parse(bandwidth)
+                logger.info(f"Bandwidth schedule: {schedule}")
+                throttle = Throttle(schedule)
+            if args.operation == "watch":
+                watch(
+                    xnat_session,
+                    matcher,
+                    project,
+                    args.dir,
+                    args.spreadsheet,
+                    strict_scan_ids=args.strict,
+                    anonymize_files=args.anonymize,
+                    anon_rules=anon_rules,
+                    overwrite=args.overwrite,
+                    no_pipeline=args.nopipeline,
+                    quiet=args.quietperiod,
+                    poll=args.pollinterval,
+                    inotify=not args.noinotify,
+                    retry=retry,
+                    concurrency=concurrency,
+                    throttle=throttle,
+                    trigger_workers=args.triggerworkers,
+                )
+            elif args.operation == "work":
+                work(
+                    xnat_session,
+                    matcher,
+                    project,
+                    args.spreadsheet,
+                    strict_scan_ids=args.strict,
+                    anonymize_files=args.anonymize,
+                    anon_rules=anon_rules,
+                    overwrite=args.overwrite,
+                    no_pipeline=args.nopipeline,
+                    retry=retry,
+                    concurrency=concurrency,
+                    throttle=throttle,
+                    trigger_workers=args.triggerworkers,
+                    lease_time=args.leasetime,
+                )
+            else:
+                upload(
+                    xnat_session,
+                    matcher,
+                    project,
+                    args.spreadsheet,
+                    strict_scan_ids=args.strict,
+                    anonymize_files=args.anonymize,
+                    anon_rules=anon_rules,
+                    test=args.test,
+                    overwrite=args.overwrite,
+                    no_pipeline=args.nopipeline,
+                    extsort=args.extsort,
+                    plan=args.plan,
+                    retry=retry,
+                    concurrency=concurrency,
+                    throttle=throttle,
+                    trigger_workers=args.triggerworkers,
+                    dedup=args.dedup,
+                )
+    finally:
+        if stop_tracing() is not None:
+            logger.info(f"Trace written to {args.logdir / CHROME_TRACE_FILE}")
+        digest_cache = set_digest_cache(None)
+        if digest_cache is not None:
+            digest_cache.close()
+        stop_metrics()
+        profiler = stop_profiling()
+        if profiler is not None:
+            profiler.write(args.logdir)
 
 
 if __name__ == "__main__":
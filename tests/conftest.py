@@ -1,7 +1,13 @@
 import xnat4tests
 import pytest
 from pathlib import Path
+from openpyxl import load_workbook
 from xnatuploader.matcher import Matcher
+from xnatuploader.dicoms import dicom_extractor, XNATFileMatch, SPREADSHEET_FIELDS
+from xnatuploader.workbook import load_config, new_workbook
+from xnatuploader.retry import RetryScheduler
+from xnatuploader.xnatuploader import scan, upload
+from tests.mock_xnat import MockXNAT
 
 
 @pytest.fixture
@@ -112,6 +118,84 @@ def sanitised_dict():
     }
 
 
+@pytest.fixture
+def make_matcher():
+    """
+    Returns a function which builds the Matcher for a fileset's config
+    spreadsheet
+    """
+
+    def make(fileset):
+        config = load_config(fileset["config_excel"])
+        return Matcher(
+            config["paths"],
+            config["mappings"],
+            SPREADSHEET_FIELDS,
+            dicom_extractor,
+            XNATFileMatch,
+        )
+
+    return make
+
+
+@pytest.fixture
+def scan_fileset(tmp_path, make_matcher):
+    """
+    Returns a function which scans a fileset's directory, or root, to a new
+    spreadsheet in tmp_path, passing any other keyword arguments to scan,
+    and returns the Matcher and the spreadsheet
+    """
+
+    def scan_to(fileset, root=None, name="log.xlsx", **kwargs):
+        matcher = make_matcher(fileset)
+        spreadsheet = tmp_path / name
+        new_workbook(spreadsheet)
+        scan(matcher, Path(root or fileset["dir"]), spreadsheet, **kwargs)
+        return matcher, spreadsheet
+
+    return scan_to
+
+
+@pytest.fixture
+def read_files():
+    """
+    Returns a function which reads a spreadsheet's Files worksheet back as
+    a list of FileMatch
+    """
+
+    def read(matcher, spreadsheet):
+        ws = load_workbook(spreadsheet)["Files"]
+        return [matcher.from_spreadsheet(row) for row in list(ws.values)[1:]]
+
+    return read
+
+
+@pytest.fixture
+def scan_and_upload(scan_fileset, read_files):
+    """
+    Returns a function which scans a fileset and uploads it to a server,
+    passing any other keyword arguments to upload, and returns the rows
+    which were selected for upload
+    """
+
+    def scan_upload(fileset, server, name="log.xlsx", retry=None, **kwargs):
+        matcher, log = scan_fileset(fileset, name=name)
+        xnat_session = server.connect()
+        upload(
+            xnat_session,
+            matcher,
+            "Project",
+            log,
+            overwrite=True,
+            retry=retry or RetryScheduler(backoff=0.01),
+            **kwargs,
+        )
+        xnat_session.disconnect()
+        return [row for row in read_files(matcher, log) if row.selected]
+
+    return scan_upload
+
+
 @pytest.fixture(scope="session")
 def xnat_connection():
     xnat4tests.start_xnat()
@@ -120,6 +204,13 @@ def xnat_connection():
     xnat4tests.stop_xnat()
 
 
+@pytest.fixture
+def mock_xnat():
+    with MockXNAT() as server:
+        server.add_project("Project")
+        yield server
+
+
 @pytest.fixture(
     scope="module",
     params=[
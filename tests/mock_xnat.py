@@ -0,0 +1,569 @@
+"""
+An in-process stand-in for an XNAT server, so that the upload code can be
+tested and benchmarked without Docker.
+
+MockXNAT implements the parts of the REST API which xnatpy and
+xnatuploader.put use: logging in, the data model schema, looking up and
+creating projects, subjects, experiments, scans and resources, uploading
+and deleting files, listing files with their digests and the pipeline
+triggers. Files aren't kept, just their sizes and MD5 digests.
+
+It can add latency to every request, limit the bandwidth of request bodies
+(shared between all connections, like a real network link) and inject
+errors, either at random or on the next n requests of a kind:
+
+    with MockXNAT(latency=0.01, bandwidth=10 * 2**20) as server:
+        server.add_project("Project")
+        server.fail_next("file", 2, status=503)
+        xnat_session = server.connect()
+        ...
+        print(server.requests["PUT file"], server.bytes_received)
+
+Requests are counted by method and kind, where kind is one of the keys of
+KINDS, or "other".
+"""
+
+import hashlib
+import json
+import random
+import threading
+import time
+from collections import Counter, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, unquote, urlsplit
+
+import xnat
+
+SCHEMA = Path(__file__).parent / "fixtures" / "mock_xnat.xsd"
+
+XNAT_VERSION = "1.8.5"
+
+USER = "admin"
+PASSWORD = "admin"
+JSESSION = "0123456789ABCDEF0123456789ABCDEF"
+
+TRIGGERS = ["pullDataFromHeaders", "fixScanTypes", "triggerPipelines"]
+
+# the collection names in the REST paths, by request kind
+KINDS = {
+    "projects": "project",
+    "subjects": "subject",
+    "experiments": "experiment",
+    "scans": "scan",
+    "resources": "resource",
+    "files": "file",
+}
+
+CHUNK_SIZE = 2**16
+
+
+class MockXNAT:
+    def __init__(
+        self,
+        latency=0.0,
+        bandwidth=None,
+        error_rate=0.0,
+        error_kinds=("file",),
+        error_status=500,
+        seed=0,
+    ):
+        """
+        latency: float - seconds added to every request
+        bandwidth: int or None - bytes per second for request bodies
+        error_rate: float - chance that a request of error_kinds fails
+        error_kinds: list of str - request kinds which can fail at random
+        error_status: int - the status code for random errors
+        seed: int - for the random errors
+        """
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.error_kinds = set(error_kinds)
+        self.error_status = error_status
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.link = threading.Lock()
+        self.failures = {}
+        self.projects = {}
+        self.subjects = {}
+        self.experiments = {}
+        self.resource_count = 0
+        self.reset_counts()
+        self.httpd = None
+        self.thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def start(self):
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), MockXNATHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.mock = self
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.thread.join()
+
+    @property
+    def uri(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def connect(self, **kwargs):
+        """
+        Returns an xnatpy session logged in to this server
+        """
+        return xnat.connect(self.uri, user=USER, password=PASSWORD, **kwargs)
+
+    def reset_counts(self):
+        """
+        Zero the request and byte counters, and forget the triggers
+        """
+        self.requests = Counter()
+        self.bytes_received = 0
+        self.triggers = []
+
+    def fail_next(self, kind, n=1, status=503):
+        """
+        Make the next n requests of a kind fail with status
+        """
+        with self.lock:
+            self.failures.setdefault(kind, deque()).extend([status] * n)
+
+    def add_project(self, project_id):
+        with self.lock:
+            return self.get_or_create_project(project_id)
+
+    def files(self):
+        """
+        Returns a dict of every uploaded file by
+        ( project, subject label, session label, scan id, resource, name )
+        """
+        files = {}
+        with self.lock:
+            for experiment in self.experiments.values():
+                subject = self.subjects[experiment["subject_ID"]]
+                for scan in experiment["scans"].values():
+                    for resource in scan["resources"].values():
+                        for name, file in resource["files"].items():
+                            key = (
+                                experiment["project"],
+                                subject["label"],
+                                experiment["label"],
+                                scan["ID"],
+                                resource["label"],
+                                name,
+                            )
+                            files[key] = dict(file)
+        return files
+
+    # the rest of the methods are called from the request handler threads
+
+    def injected_error(self, kind):
+        """
+        Returns a status code if this request should fail, or None
+        """
+        with self.lock:
+            scheduled = self.failures.get(kind)
+            if scheduled:
+                return scheduled.popleft()
+            if kind in self.error_kinds and self.error_rate > 0:
+                if self.rng.random() < self.error_rate:
+                    return self.error_status
+        return None
+
+    def throttle(self, nbytes):
+        """
+        Wait for nbytes to cross the shared link
+        """
+        if self.bandwidth:
+            with self.link:
+                time.sleep(nbytes / self.bandwidth)
+
+    def get_or_create_project(self, project_id):
+        if project_id not in self.projects:
+            self.projects[project_id] = {"ID": project_id, "name": project_id}
+        return self.projects[project_id]
+
+    def find_subject(self, project_id, key):
+        for subject in self.subjects.values():
+            if subject["project"] == project_id:
+                if key == subject["ID"] or key == subject["label"]:
+                    return subject
+        return None
+
+    def find_experiment(self, project_id, key):
+        for experiment in self.experiments.values():
+            if project_id is None or experiment["project"] == project_id:
+                if key == experiment["ID"] or key == experiment["label"]:
+                    return experiment
+        return None
+
+    def handle(self, method, parts, query, body):
+        """
+        Dispatches a request to the REST API and returns ( status, payload )
+        where payload is a str, or a dict or list to be sent as JSON. body is
+        the size and digest of the request body.
+        """
+        if not parts:
+            return 200, f"<p>XNAT mock {XNAT_VERSION}</p>"
+        if parts[0] == "xapi":
+            return self.handle_xapi(parts[1:])
+        if parts[0] != "data":
+            return 404, "Not found"
+        parts = parts[1:]
+        if parts[:1] == ["archive"]:
+            parts = parts[1:]
+        if parts == ["JSESSION"] or parts == ["services", "auth"]:
+            return 200, JSESSION
+        if parts == ["auth"]:
+            return 200, f"User '{USER}' is logged in"
+        with self.lock:
+            return self.handle_data(method, parts, query, body)
+
+    def handle_xapi(self, parts):
+        if parts == ["siteConfig", "buildInfo"]:
+            return 200, {"version": XNAT_VERSION}
+        if parts == ["schemas"]:
+            return 200, ["xnat"]
+        if parts == ["schemas", "xnat"]:
+            return 200, SCHEMA.read_text()
+        return 404, "Not found"
+
+    def handle_data(self, method, parts, query, body):
+        if parts == ["projects"]:
+            return 200, listing([project_row(p) for p in self.projects.values()])
+        if parts == ["experiments"]:
+            rows = [experiment_row(e) for e in self.experiments.values()]
+            return 200, listing(rows)
+        if parts[0] == "experiments":
+            experiment = self.find_experiment(None, parts[1])
+            if experiment is None:
+                return 404, "Experiment not found"
+            return self.handle_experiment(method, experiment, parts[2:], query, body)
+        if parts[0] != "projects":
+            return 404, "Not found"
+        project_id = parts[1]
+        if method == "PUT" and len(parts) == 2:
+            return 200, self.get_or_create_project(project_id)["ID"]
+        project = self.projects.get(project_id)
+        if project is None:
+            return 404, "Project not found"
+        if len(parts) == 2:
+            return 200, item("xnat:projectData", project)
+        if parts[2] == "experiments":
+            if len(parts) == 3:
+                rows = [
+                    experiment_row(e)
+                    for e in self.experiments.values()
+                    if e["project"] == project_id
+                ]
+                return 200, listing(rows)
+            experiment = self.find_experiment(project_id, parts[3])
+            if experiment is None:
+                return 404, "Experiment not found"
+            return self.handle_experiment(method, experiment, parts[4:], query, body)
+        if parts[2] != "subjects":
+            return 404, "Not found"
+        if len(parts) == 3:
+            rows = [
+                subject_row(s)
+                for s in self.subjects.values()
+                if s["project"] == project_id
+            ]
+            return 200, listing(rows)
+        subject = self.find_subject(project_id, parts[3])
+        if subject is None:
+            if method != "PUT" or len(parts) > 4:
+                return 404, "Subject not found"
+            subject_id = f"XNAT_S{len(self.subjects) + 1:05d}"
+            subject = {"ID": subject_id, "label": parts[3], "project": project_id}
+            self.subjects[subject_id] = subject
+            return 200, subject_id
+        if len(parts) == 4:
+            if method == "PUT":
+                return 200, subject["ID"]
+            return 200, item("xnat:subjectData", subject)
+        if parts[4] != "experiments":
+            return 404, "Not found"
+        if len(parts) == 5:
+            rows = [
+                experiment_row(e)
+                for e in self.experiments.values()
+                if e["subject_ID"] == subject["ID"]
+            ]
+            return 200, listing(rows)
+        experiment = self.find_experiment(project_id, parts[5])
+        if experiment is None:
+            if method != "PUT" or len(parts) > 6:
+                return 404, "Experiment not found"
+            xsi_type = query.get("xsiType", "xnat:mrSessionData")
+            experiment_id = f"XNAT_E{len(self.experiments) + 1:05d}"
+            experiment = {
+                "ID": experiment_id,
+                "label": parts[5],
+                "project": project_id,
+                "subject_ID": subject["ID"],
+                "xsiType": xsi_type,
+                "modality": xsi_type[5:-11].upper(),
+                "date": "",
+                "scans": {},
+            }
+            self.experiments[experiment_id] = experiment
+            return 200, experiment_id
+        return self.handle_experiment(method, experiment, parts[6:], query, body)
+
+    def handle_experiment(self, method, experiment, parts, query, body):
+        if not parts:
+            if method == "PUT":
+                triggers = [t for t in TRIGGERS if query.get(t) == "true"]
+                for trigger in triggers:
+                    self.triggers.append((experiment["label"], trigger))
+                return 200, experiment["ID"]
+            return 200, item(experiment["xsiType"], experiment_fields(experiment))
+        if parts[0] != "scans":
+            return 404, "Not found"
+        scans = experiment["scans"]
+        if len(parts) == 1:
+            return 200, listing([scan_row(s) for s in scans.values()])
+        scan = scans.get(parts[1])
+        if scan is None:
+            if method != "PUT" or len(parts) > 2:
+                return 404, "Scan not found"
+            xsi_type = query.get("xsiType", "xnat:mrScanData")
+            scan = {
+                "ID": parts[1],
+                "type": query.get(f"{xsi_type}/type", parts[1]),
+                "xsiType": xsi_type,
+                "resources": {},
+            }
+            scans[parts[1]] = scan
+            return 200, ""
+        if len(parts) == 2:
+            if method == "PUT":
+                return 200, ""
+            return 200, item(scan["xsiType"], scan_fields(scan))
+        if parts[2] != "resources":
+            return 404, "Not found"
+        resources = scan["resources"]
+        if len(parts) == 3:
+            return 200, listing([resource_row(r) for r in resources.values()])
+        resource = resources.get(parts[3])
+        if resource is None:
+            resource = next(
+                (r for r in resources.values() if str(r["id"]) == parts[3]), None
+            )
+        if resource is None:
+            if method != "PUT" or len(parts) > 4:
+                return 404, "Resource not found"
+            self.resource_count += 1
+            resource = {
+                "id": self.resource_count,
+                "label": parts[3],
+                "format": query.get("format", ""),
+                "files": {},
+            }
+            resources[parts[3]] = resource
+            return 200, ""
+        if len(parts) == 4:
+            if method == "PUT":
+                return 200, ""
+            return 200, item("xnat:resourceCatalog", resource_row(resource))
+        if parts[4] != "files":
+            return 404, "Not found"
+        files = resource["files"]
+        if len(parts) == 5:
+            uri = f"/data/experiments/{experiment['ID']}/scans/{scan['ID']}"
+            uri += f"/resources/{resource['id']}/files"
+            rows = [file_row(uri, name, f) for name, f in files.items()]
+            return 200, listing(rows)
+        name = "/".join(parts[5:])
+        if method == "DELETE":
+            if files.pop(name, None) is None:
+                return 404, "File not found"
+            return 200, ""
+        if method in ("PUT", "POST"):
+            if name in files and query.get("overwrite") != "true":
+                return 409, f"File {name} already exists"
+            files[name] = {"Size": body["size"], "digest": body["digest"]}
+            return 200, ""
+        if name not in files:
+            return 404, "File not found"
+        return 200, files[name]
+
+
+class MockXNATHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # headers and bodies are written separately, which stalls keep-alive
+    # connections on delayed ACKs if Nagle's algorithm is on
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.respond("GET")
+
+    def do_PUT(self):
+        self.respond("PUT")
+
+    def do_POST(self):
+        self.respond("POST")
+
+    def do_DELETE(self):
+        self.respond("DELETE")
+
+    def respond(self, method):
+        mock = self.server.mock
+        url = urlsplit(self.path)
+        query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        parts = [unquote(p) for p in url.path.split("/") if p]
+        kind = request_kind(parts, query)
+        body = self.read_body(mock)
+        if mock.latency:
+            time.sleep(mock.latency)
+        with mock.lock:
+            mock.requests[f"{method} {kind}"] += 1
+            mock.bytes_received += body["size"]
+        status = mock.injected_error(kind)
+        if status is not None:
+            payload = f"Injected error {status}"
+        else:
+            status, payload = mock.handle(method, parts, query, body)
+        self.send(status, payload)
+
+    def read_body(self, mock):
+        """
+        Reads the request body, including chunked bodies, and returns its
+        size and MD5 digest
+        """
+        md5 = hashlib.md5()
+        size = 0
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            while True:
+                chunk_size = int(self.rfile.readline().split(b";")[0], 16)
+                if chunk_size == 0:
+                    self.rfile.readline()
+                    break
+                chunk = self.rfile.read(chunk_size)
+                self.rfile.readline()
+                mock.throttle(len(chunk))
+                md5.update(chunk)
+                size += len(chunk)
+        else:
+            remaining = int(self.headers.get("Content-Length", 0))
+            while remaining > 0:
+                chunk = self.rfile.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                mock.throttle(len(chunk))
+                md5.update(chunk)
+                size += len(chunk)
+                remaining -= len(chunk)
+        return {"size": size, "digest": md5.hexdigest()}
+
+    def send(self, status, payload):
+        if isinstance(payload, str):
+            data = payload.encode("utf-8")
+            content_type = "text/plain"
+        else:
+            data = json.dumps(payload).encode("utf-8")
+            content_type = "application/json"
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        if self.path.endswith("/services/auth"):
+            self.send_header("Set-Cookie", f"JSESSIONID={JSESSION}; Path=/")
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def request_kind(parts, query):
+    """
+    Classifies a request by the last collection in its path
+    """
+    if parts[:1] == ["xapi"]:
+        return "schema"
+    if any(p in parts for p in ["auth", "JSESSION"]):
+        return "auth"
+    if any(query.get(t) == "true" for t in TRIGGERS):
+        return "trigger"
+    for i in range(len(parts) - 1, -1, -1):
+        if parts[i] in KINDS:
+            if parts[i] == "files" and i == len(parts) - 1:
+                return "files"
+            return KINDS[parts[i]]
+    return "other"
+
+
+def listing(rows):
+    return {"ResultSet": {"Result": rows, "totalRecords": str(len(rows))}}
+
+
+def item(xsi_type, fields):
+    return {
+        "items": [
+            {
+                "meta": {"xsi:type": xsi_type, "isHistory": False},
+                "data_fields": fields,
+                "children": [],
+            }
+        ]
+    }
+
+
+def project_row(project):
+    return {"ID": project["ID"], "name": project["name"], "URI": ""}
+
+
+def subject_row(subject):
+    return dict(subject, URI="")
+
+
+def experiment_fields(experiment):
+    return {k: v for k, v in experiment.items() if k not in ("scans", "xsiType")}
+
+
+def experiment_row(experiment):
+    return dict(experiment_fields(experiment), xsiType=experiment["xsiType"], URI="")
+
+
+def scan_fields(scan):
+    return {"ID": scan["ID"], "type": scan["type"]}
+
+
+def scan_row(scan):
+    return dict(scan_fields(scan), xsiType=scan["xsiType"], URI="")
+
+
+def resource_row(resource):
+    files = resource["files"].values()
+    return {
+        "xnat_abstractresource_id": str(resource["id"]),
+        "label": resource["label"],
+        "element_name": "xnat:resourceCatalog",
+        "format": resource["format"],
+        "file_count": str(len(files)),
+        "file_size": str(sum(f["Size"] for f in files)),
+    }
+
+
+def file_row(uri, name, file):
+    return {
+        "Name": name,
+        "URI": f"{uri}/{name}",
+        "Size": str(file["Size"]),
+        "digest": file["digest"],
+        "collection": "DICOM",
+        "file_content": "",
+        "file_format": "",
+        "file_tags": "",
+    }
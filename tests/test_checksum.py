@@ -0,0 +1,127 @@
+import hashlib
+import os
+
+import pytest
+from openpyxl import load_workbook
+from openpyxl.utils import get_column_letter
+
+from xnatuploader.checksum import (
+    file_digest,
+    ChecksumEngine,
+    add_scan_checksums,
+    scan_digest,
+    HASH_CHUNK_SIZE,
+    CHECKSUM_FIELD,
+)
+from xnatuploader.matcher import FileMatch
+from xnatuploader.workbook import load_hidden_fields
+from xnatuploader.metrics import start_metrics, stop_metrics
+from xnatuploader.upload import upload
+from xnatuploader.put import calculate_checksum, calculate_checksums
+from xnatutils.exceptions import XnatUtilsDigestCheckFailedError
+
+from tests.test_mock_upload import md5
+
+SIZES = [0, 1, HASH_CHUNK_SIZE, HASH_CHUNK_SIZE * 2 + 17]
+
+
+def write_files(tmp_path, sizes):
+    files = {}
+    for i, size in enumerate(sizes):
+        path = tmp_path / f"file{i}.dcm"
+        data = os.urandom(size)
+        path.write_bytes(data)
+        files[str(path)] = hashlib.md5(data).hexdigest()
+    return files
+
+
+@pytest.mark.parametrize("mmap_threshold", [1, 2**40])
+def test_file_digest(tmp_path, mmap_threshold):
+    for path, expect in write_files(tmp_path, SIZES).items():
+        assert file_digest(path, mmap_threshold=mmap_threshold) == expect
+
+
+def test_file_digest_algorithm(tmp_path):
+    path = tmp_path / "sheet.xlsx"
+    path.write_bytes(b"spreadsheet")
+    expect = hashlib.sha256(b"spreadsheet").hexdigest()
+    assert file_digest(path, "sha256") == expect
+
+
+def test_checksum_engine(tmp_path):
+    files = write_files(tmp_path, SIZES * 3)
+    with ChecksumEngine(workers=3) as engine:
+        assert engine.digests(list(files)) == files
+        engine.prefetch(list(files))
+        assert len(engine.pending) == len(files)
+        assert engine.digests(list(files)) == files
+        assert engine.pending == {}
+
+
+def test_checksum_engine_changed_file(tmp_path):
+    path = tmp_path / "file.dcm"
+    path.write_bytes(b"before")
+    with ChecksumEngine(workers=1) as engine:
+        engine.prefetch([str(path)])
+        engine.pending[engine.key(str(path), os.stat(path))].result()
+        path.write_bytes(b"after, and longer")
+        expect = hashlib.md5(b"after, and longer").hexdigest()
+        assert engine.digest(str(path)) == expect
+
+
+def test_calculate_checksums(tmp_path):
+    files = write_files(tmp_path, SIZES)
+    assert calculate_checksums(list(files)) == files
+    missing = str(tmp_path / "missing.dcm")
+    with pytest.raises(XnatUtilsDigestCheckFailedError):
+        calculate_checksum(missing)
+    with pytest.raises(XnatUtilsDigestCheckFailedError):
+        calculate_checksums(list(files) + [missing])
+
+
+def test_scan_checksums(tmp_path, test_files, mock_xnat, scan_fileset, make_matcher):
+    fileset = test_files["basic"]
+    _, spreadsheet = scan_fileset(fileset, checksums=True)
+    ws = load_workbook(spreadsheet)["Files"]
+    header = list(ws.values)[0]
+    assert header[-1] == CHECKSUM_FIELD
+    column = get_column_letter(len(header))
+    assert ws.column_dimensions[column].hidden
+    matcher = make_matcher(fileset)
+    load_hidden_fields(spreadsheet, matcher, [CHECKSUM_FIELD])
+    assert matcher.hidden_fields == [CHECKSUM_FIELD]
+    rows = [matcher.from_spreadsheet(row) for row in list(ws.values)[1:]]
+    selected = [row for row in rows if row.selected]
+    for row in rows:
+        if row.selected:
+            assert scan_digest(row) == md5(row.file)
+        else:
+            assert row.get(CHECKSUM_FIELD) is None
+    xnat_session = mock_xnat.connect()
+    start_metrics("upload", tmp_path, interval=0)
+    try:
+        upload(xnat_session, matcher, "Project", spreadsheet)
+    finally:
+        metrics = stop_metrics()
+        xnat_session.disconnect()
+    assert metrics.total("scan_checksums_used") == len(selected)
+    ws = load_workbook(spreadsheet)["Files"]
+    assert list(ws.values)[0][-1] == CHECKSUM_FIELD
+    rows = [matcher.from_spreadsheet(row) for row in list(ws.values)[1:]]
+    for row in rows:
+        if row.selected:
+            assert row.status == "success"
+            assert scan_digest(row) == md5(row.file)
+
+
+def test_scan_digest_stale(tmp_path):
+    path = tmp_path / "image.dcm"
+    path.write_bytes(b"image")
+    file = FileMatch(None, path)
+    add_scan_checksums([file])
+    assert scan_digest(file) == hashlib.md5(b"image").hexdigest()
+    st = os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    assert scan_digest(file) is None
+    file[CHECKSUM_FIELD] = "garbage"
+    assert scan_digest(file) is None
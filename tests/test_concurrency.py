@@ -0,0 +1,44 @@
+from xnatuploader.concurrency import AIMDController
+
+
+def run_round(controller, latency, ok=True):
+    epoch = controller.epoch
+    for _ in range(controller.limit):
+        controller.record(epoch, latency, ok)
+
+
+def test_additive_increase():
+    controller = AIMDController(min_workers=1, max_workers=4)
+    for limit in [2, 3, 4, 4]:
+        run_round(controller, 0.1)
+        assert controller.limit == limit
+
+
+def test_decrease_on_errors():
+    controller = AIMDController(min_workers=1, max_workers=16)
+    controller.limit = 8
+    run_round(controller, 0.1, ok=False)
+    assert controller.limit == 4
+
+
+def test_decrease_on_latency():
+    controller = AIMDController(min_workers=2, max_workers=16)
+    for _ in range(4):
+        run_round(controller, 0.1)
+    assert controller.limit == 6
+    run_round(controller, 0.5)
+    assert controller.limit == 3
+    run_round(controller, 0.5)
+    assert controller.limit == 2
+
+
+def test_stale_epoch_ignored():
+    controller = AIMDController(min_workers=1, max_workers=16)
+    controller.limit = 8
+    epoch = controller.epoch
+    run_round(controller, 0.1, ok=False)
+    assert controller.limit == 4
+    # uploads started before the cut don't count towards the next round
+    for _ in range(8):
+        controller.record(epoch, 0.1, False)
+    assert controller.limit == 4
@@ -0,0 +1,65 @@
+import shutil
+from pathlib import Path
+
+from xnatuploader.dedup import find_duplicates, DUPLICATE_STATUS
+from xnatuploader.matcher import FileMatch
+from xnatuploader.metrics import start_metrics, stop_metrics
+from xnatuploader.upload import upload
+
+
+def test_find_duplicates():
+    files = [FileMatch(None, Path(f"{name}.dcm")) for name in "abcde"]
+    digests = {"a.dcm": "1", "b.dcm": "1", "c.dcm": "1", "d.dcm": "2", "e.dcm": "1"}
+    uids = {"a.dcm": "uid1", "b.dcm": "uid1", "c.dcm": "uid2", "d.dcm": "uid1"}
+    duplicates = find_duplicates(files, digests, uids.get)
+    assert {f: original.file for f, original in duplicates.items()} == {
+        "b.dcm": "a.dcm"
+    }
+
+
+def test_dedup_upload(tmp_path, test_files, mock_xnat, scan_fileset, read_files):
+    fileset = test_files["basic"]
+    source = tmp_path / "source"
+    shutil.copytree(fileset["dir"], source)
+    scan_dir = source / "DOE^JOHN-002304" / "20200312HeadCT"
+    # a re-export of a series and a copy of one file in the same series
+    shutil.copytree(scan_dir / "Head CT", scan_dir / "Head CT prev")
+    shutil.copy(
+        scan_dir / "Neck CT" / "image-00000.dcm",
+        scan_dir / "Neck CT" / "image-00009.dcm",
+    )
+    matcher, log = scan_fileset(fileset, root=source)
+    xnat_session = mock_xnat.connect()
+    start_metrics("upload", tmp_path, interval=0)
+    try:
+        upload(xnat_session, matcher, "Project", log, dedup=True)
+    finally:
+        metrics = stop_metrics()
+        xnat_session.disconnect()
+    rows = read_files(matcher, log)
+    selected = {Path(row.file).relative_to(source): row for row in rows if row.selected}
+    duplicates = {
+        file: row.status[len(DUPLICATE_STATUS) :]
+        for file, row in selected.items()
+        if row.status.startswith(DUPLICATE_STATUS)
+    }
+    head = Path("DOE^JOHN-002304/20200312HeadCT/Head CT")
+    prev = Path("DOE^JOHN-002304/20200312HeadCT/Head CT prev")
+    neck = Path("DOE^JOHN-002304/20200312HeadCT/Neck CT")
+    # the fixture's image-00001.dcm and image-00002.extra.periods.dcm are
+    # already the same file
+    expect = {
+        head / "image-00002.extra.periods.dcm": head / "image-00001.dcm",
+        prev / "image-00000.dcm": head / "image-00000.dcm",
+        prev / "image-00001.dcm": head / "image-00001.dcm",
+        prev / "image-00002.extra.periods.dcm": head / "image-00001.dcm",
+        neck / "image-00009.dcm": neck / "image-00000.dcm",
+    }
+    assert {f: Path(o).relative_to(source) for f, o in duplicates.items()} == expect
+    for file, row in selected.items():
+        if file not in duplicates:
+            assert row.status == "success"
+    assert mock_xnat.requests["PUT file"] == len(selected) - len(duplicates)
+    saved = sum((source / f).stat().st_size for f in duplicates)
+    assert metrics.total("duplicates_skipped") == len(duplicates)
+    assert metrics.total("duplicate_bytes") == saved
@@ -0,0 +1,129 @@
+import os
+import shutil
+import warnings
+from pathlib import Path
+
+from openpyxl import load_workbook
+from pydicom import dcmread
+from pydicom.fileset import FileSet
+from pydicom.uid import generate_uid
+
+from xnatuploader.dicomdir import DicomdirExtractor, index_required, DICOMDIR
+from xnatuploader.dicoms import dicom_extractor, XNATFileMatch, SPREADSHEET_FIELDS
+from xnatuploader.matcher import Matcher
+from xnatuploader.metrics import start_metrics, stop_metrics
+from xnatuploader.workbook import new_workbook
+from xnatuploader.scan import scan
+
+RECIPES = {"Disc": ["{ID}", "*", "*", "{Directory}", "{filename}"]}
+
+MAPPINGS = {
+    "Subject": ["ID"],
+    "Session": ["DICOM:StudyDate"],
+    "Dataset": ["Directory"],
+}
+
+SERIES = 2
+SLICES = 3
+
+
+def write_disc(fixture, disc):
+    """
+    Write a DICOMDIR file set with SERIES series of SLICES images, made
+    from a fixture DICOM, to disc
+    """
+    fileset = FileSet()
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        for series in range(SERIES):
+            series_uid = generate_uid()
+            for slice in range(SLICES):
+                ds = dcmread(fixture)
+                ds.StudyID = "1"
+                ds.StudyTime = "120000"
+                ds.SeriesNumber = series + 1
+                ds.SeriesInstanceUID = series_uid
+                ds.InstanceNumber = slice + 1
+                ds.SOPInstanceUID = generate_uid()
+                ds.file_meta.MediaStorageSOPInstanceUID = ds.SOPInstanceUID
+                fileset.add(ds)
+        disc.mkdir(parents=True)
+        fileset.write(disc)
+
+
+def counting_extractor():
+    opened = []
+
+    def extractor(filepath):
+        opened.append(Path(filepath))
+        return dicom_extractor(filepath)
+
+    return extractor, opened
+
+
+def scan_rows(tmp_path, root, extractor, name):
+    matcher = Matcher(RECIPES, MAPPINGS, SPREADSHEET_FIELDS, extractor, XNATFileMatch)
+    spreadsheet = tmp_path / f"{name}.xlsx"
+    new_workbook(spreadsheet)
+    scan(matcher, root, spreadsheet, include_unmatched=False)
+    rows = list(load_workbook(spreadsheet)["Files"].values)
+    header = rows[0]
+    return [dict(zip(header, row)) for row in rows[1:]]
+
+
+def test_index_required():
+    assert index_required(MAPPINGS) == ["Modality", "SeriesNumber", "StudyDate"]
+    mappings = {"Session": ["DICOM:StudyDescription"]}
+    assert "StudyDescription" in index_required(mappings)
+
+
+def test_dicomdir_scan(tmp_path, test_files):
+    fixture = next(Path(test_files["basic"]["dir"]).glob("**/*.dcm"))
+    root = tmp_path / "discs"
+    write_disc(fixture, root / "SUBJ01")
+    files = sorted(
+        f for f in (root / "SUBJ01").glob("**/*") if f.is_file() and f.name != DICOMDIR
+    )
+    assert len(files) == SERIES * SLICES
+    extractor, opened = counting_extractor()
+    start_metrics("scan", tmp_path, interval=0)
+    try:
+        indexed = scan_rows(tmp_path, root, DicomdirExtractor(extractor), "indexed")
+    finally:
+        metrics = stop_metrics()
+    assert opened == []
+    assert metrics.total("dicomdir") == len(files)
+    expect = scan_rows(tmp_path, root, dicom_extractor, "opened")
+    assert len(indexed) == len(expect) == len(files)
+    for got, row in zip(indexed, expect):
+        for field in ["File", "Subject", "Session", "Dataset", "SessionLabel"]:
+            assert got[field] == row[field]
+        for param in ["Modality", "SeriesNumber", "StudyDate", "StudyDescription"]:
+            assert got[f"DICOM:{param}"] == row[f"DICOM:{param}"]
+
+
+def test_dicomdir_stale_and_unlisted(tmp_path, test_files):
+    fixture = next(Path(test_files["basic"]["dir"]).glob("**/*.dcm"))
+    root = tmp_path / "discs"
+    write_disc(fixture, root / "SUBJ01")
+    series = next((root / "SUBJ01").glob("*/*/*"))
+    images = sorted(series.iterdir())
+    st = os.stat(root / "SUBJ01" / DICOMDIR)
+    os.utime(images[0], ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    unlisted = series / "EXTRA"
+    shutil.copy(images[1], unlisted)
+    extractor, opened = counting_extractor()
+    rows = scan_rows(tmp_path, root, DicomdirExtractor(extractor), "indexed")
+    assert len(rows) == SERIES * SLICES + 1
+    assert sorted(opened) == sorted([images[0], unlisted])
+
+
+def test_dicomdir_above_root(tmp_path, test_files):
+    fixture = next(Path(test_files["basic"]["dir"]).glob("**/*.dcm"))
+    root = tmp_path / "discs"
+    write_disc(fixture, root / "SUBJ01")
+    series = next((root / "SUBJ01").glob("*/*/*"))
+    image = next(series.iterdir())
+    assert DicomdirExtractor(root=root).lookup(image) is not None
+    # a DICOMDIR above the directory being scanned isn't used
+    assert DicomdirExtractor(root=series.parent).lookup(image) is None
@@ -0,0 +1,82 @@
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+from xnatuploader.dicoms import (
+    dicom_extractor,
+    sniff_dicom,
+    set_legacy_dicom,
+    DICOM_HEADER_SIZE,
+)
+from xnatuploader.matcher import ExtractException
+
+REJECTED = """
+import sys
+from xnatuploader.dicoms import dicom_extractor
+from xnatuploader.matcher import ExtractException
+try:
+    dicom_extractor(sys.argv[1])
+except ExtractException as e:
+    print(e)
+print("pydicom" in sys.modules)
+"""
+
+
+@pytest.mark.parametrize(
+    "header,reason",
+    [
+        (b"", "File is empty"),
+        (b"%PDF-1.4\n" + b"0" * 200, "File is a PDF document, not a DICOM"),
+        (b"\xff\xd8\xff\xe0\x00\x10JFIF\x00" + b"\0" * 200, "File is a JPEG image"),
+        (b"PK\x03\x04" + b"\0" * 200, "File is a zip archive"),
+        (b"Radiology report\n" * 20, "File is not a DICOM"),
+        (b"short", "File is not a DICOM"),
+        (b"\x08\x00\x05\x00CS\x0a\x00" + b"\0" * 200, "File is not a DICOM"),
+    ],
+)
+def test_sniff_dicom_rejects(header, reason):
+    with pytest.raises(ExtractException) as e:
+        sniff_dicom(header)
+    assert str(e.value).startswith(reason)
+    assert e.value.reason in ("empty", "not_dicom")
+
+
+def test_sniff_dicom():
+    # a TIFF signature in the preamble of a dual-format file is ignored
+    header = b"II*\x00" + b"\0" * 124 + b"DICM"
+    assert sniff_dicom(header) is True
+    legacy = b"\x08\x00\x05\x00CS\x0a\x00" + b"\0" * 200
+    assert sniff_dicom(legacy, legacy=True) is False
+    with pytest.raises(ExtractException):
+        sniff_dicom(b"Radiology report\n" * 20, legacy=True)
+
+
+def test_prefilter_skips_pydicom(tmp_path):
+    report = tmp_path / "report.dcm"
+    report.write_bytes(b"%PDF-1.4\n" + b"0" * 2000)
+    result = subprocess.run(
+        [sys.executable, "-c", REJECTED, str(report)],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    assert result.stdout.split("\n")[:2] == [
+        "File is a PDF document, not a DICOM",
+        "False",
+    ]
+
+
+def test_legacy_dicom(tmp_path, test_files):
+    fixture = next(Path(test_files["basic"]["dir"]).glob("**/*.dcm"))
+    legacy = tmp_path / "legacy.dcm"
+    legacy.write_bytes(fixture.read_bytes()[DICOM_HEADER_SIZE:])
+    expect = dicom_extractor(fixture)
+    with pytest.raises(ExtractException):
+        dicom_extractor(legacy)
+    previous = set_legacy_dicom(True)
+    try:
+        assert dicom_extractor(legacy) == expect
+    finally:
+        set_legacy_dicom(previous)
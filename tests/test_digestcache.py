@@ -0,0 +1,103 @@
+import hashlib
+import os
+
+import pytest
+
+from xnatuploader import checksum
+from xnatuploader.checksum import ChecksumEngine, set_digest_cache
+from xnatuploader.digestcache import DigestCache, DigestCacheError
+from xnatuploader.metrics import start_metrics, stop_metrics
+
+from tests.test_mock_upload import md5
+
+
+def counting_digest(monkeypatch):
+    """Count the files which the ChecksumEngine actually reads"""
+    reads = []
+    file_digest = checksum.file_digest
+
+    def fn(filename, *args, **kwargs):
+        reads.append(filename)
+        return file_digest(filename, *args, **kwargs)
+
+    monkeypatch.setattr(checksum, "file_digest", fn)
+    return reads
+
+
+def test_digest_cache(tmp_path):
+    path = tmp_path / "file.dcm"
+    path.write_bytes(b"image")
+    cache = DigestCache(tmp_path / "cache" / "digests.db")
+    st = os.stat(path)
+    assert cache.lookup(path, st) is None
+    cache.store([(str(path), st, "digest")])
+    assert cache.lookup(path, st) == "digest"
+    assert cache.lookup(path, st, "sha256") is None
+    cache.close()
+    # it persists, and is only used while the file is unchanged
+    cache = DigestCache(tmp_path / "cache" / "digests.db")
+    assert cache.lookup(path, st) == "digest"
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    assert cache.lookup(path, os.stat(path)) is None
+    cache.close()
+
+
+def test_digest_cache_not_a_cache(tmp_path):
+    path = tmp_path / "digests.db"
+    path.write_text("not a database")
+    with pytest.raises(DigestCacheError):
+        DigestCache(path)
+
+
+def test_digest_cache_engine(tmp_path, monkeypatch):
+    reads = counting_digest(monkeypatch)
+    files = {}
+    for i in range(5):
+        path = tmp_path / f"file{i}.dcm"
+        path.write_bytes(os.urandom(1000))
+        files[str(path)] = hashlib.md5(path.read_bytes()).hexdigest()
+    cache = DigestCache(tmp_path / "digests.db")
+    start_metrics("upload", tmp_path, interval=0)
+    try:
+        with ChecksumEngine(workers=2, cache=cache) as engine:
+            assert engine.digests(list(files)) == files
+            assert len(reads) == len(files)
+            engine.prefetch(list(files))
+            assert engine.pending == {}
+            assert engine.digests(list(files)) == files
+            assert len(reads) == len(files)
+            # temporary files skip the cache
+            engine.digests(list(files), use_cache=False)
+            assert len(reads) == 2 * len(files)
+    finally:
+        metrics = stop_metrics()
+    cache.close()
+    # prefetching doesn't count as a lookup
+    assert metrics.total("digest_cache", "miss") == len(files)
+    assert metrics.total("digest_cache", "hit") == len(files)
+
+
+def test_digest_cache_upload(tmp_path, test_files, mock_xnat, scan_and_upload):
+    cache = DigestCache(tmp_path / "digests.db")
+    set_digest_cache(cache)
+    try:
+        selected = scan_and_upload(test_files["basic"], mock_xnat)
+    finally:
+        set_digest_cache(None)
+    assert all(row.status == "success" for row in selected)
+    for row in selected:
+        assert cache.lookup(row.file, os.stat(row.file)) == md5(row.file)
+    cache.close()
+
+
+def test_digest_cache_anonymized(tmp_path, test_files, mock_xnat, scan_and_upload):
+    cache = DigestCache(tmp_path / "digests.db")
+    set_digest_cache(cache)
+    try:
+        selected = scan_and_upload(test_files["basic"], mock_xnat, anonymize_files=True)
+    finally:
+        set_digest_cache(None)
+    assert all(row.status == "success" for row in selected)
+    # the anonymized copies are different every time, so aren't cached
+    assert cache.db.execute("SELECT COUNT(*) FROM files").fetchone() == (0,)
+    cache.close()
@@ -0,0 +1,129 @@
+import io
+from pathlib import Path
+
+import pytest
+from openpyxl import load_workbook
+
+from xnatuploader import filelist
+from xnatuploader.filelist import (
+    FileListEntry,
+    parse_entry,
+    read_records,
+    read_file_list,
+)
+from xnatuploader.shard import shard_filepaths
+from xnatuploader.workbook import new_workbook
+from xnatuploader.shard import scan_shard, merge
+
+from tests.test_scan import assert_worksheets_equal
+
+
+def test_parse_entry():
+    assert parse_entry(b"a/b.dcm") == FileListEntry("a/b.dcm", None)
+    assert parse_entry(b"a/b.dcm\t1024") == FileListEntry("a/b.dcm", 1024)
+    # a modification time after the size is skipped
+    assert parse_entry(b"a/b.dcm\t1024\t1700000000.5") == FileListEntry("a/b.dcm", 1024)
+    assert parse_entry(b"a/tab\tname.dcm\t0\t1") == FileListEntry("a/tab\tname.dcm", 0)
+    assert parse_entry(b"a/tab\tname.dcm") == FileListEntry("a/tab\tname.dcm", None)
+
+
+@pytest.mark.parametrize("separator", [b"\n", b"\0"])
+def test_read_records(monkeypatch, separator):
+    monkeypatch.setattr(filelist, "READ_SIZE", 7)
+    records = [f"dir{i}/file with spaces {i}.dcm".encode() for i in range(20)]
+    data = separator.join(records) + separator + separator
+    if separator == b"\n":
+        data = data.replace(b"\n", b"\r\n", 3)
+    assert list(read_records(io.BytesIO(data), separator)) == records
+
+
+def test_read_file_list(tmp_path):
+    root = tmp_path / "root"
+    entries = [
+        "a/1.dcm",
+        "./b/2.dcm\t100\t1700000000",
+        f"{root}/c/3.dcm\t100",
+        "a/../d/4.dcm",
+        "a/empty.dcm\t0\t1700000000",
+        "a/.DS_Store",
+        "../outside.dcm",
+        f"{tmp_path}/elsewhere/5.dcm",
+    ]
+    data = "\0".join(entries).encode()
+    paths = read_file_list(io.BytesIO(data), root, null=True, ignore=[".DS_Store"])
+    expect = ["a/1.dcm", "b/2.dcm", "c/3.dcm", "d/4.dcm"]
+    assert list(paths) == [root / f for f in expect]
+
+
+def test_read_file_list_relative_root(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    root = Path("root")
+    root.mkdir()
+    data = f"{tmp_path}/root/a/1.dcm\n{tmp_path}/elsewhere/2.dcm\nb/3.dcm\n".encode()
+    paths = read_file_list(io.BytesIO(data), root)
+    assert list(paths) == [Path("root/a/1.dcm"), Path("root/b/3.dcm")]
+    monkeypatch.chdir(root)
+    paths = read_file_list(io.BytesIO(data), Path("./"))
+    assert list(paths) == [Path("a/1.dcm"), Path("b/3.dcm")]
+
+
+@pytest.mark.parametrize("shards", [2, 3])
+def test_read_file_list_shards(test_files, shards):
+    root = Path(test_files["basic"]["dir"])
+    walked = shard_filepaths(root, 1, 1)
+    data = "\n".join(str(f.relative_to(root)) for f in walked).encode()
+    for shard in range(1, shards + 1):
+        listed = read_file_list(io.BytesIO(data), root, shard=shard, shards=shards)
+        assert list(listed) == shard_filepaths(root, shard, shards)
+
+
+def test_scan_filelist(test_files, scan_fileset):
+    fileset = test_files["basic"]
+    root = Path(fileset["dir"])
+    lines = []
+    for f in shard_filepaths(root, 1, 1, [".DS_Store"]):
+        st = f.stat()
+        lines.append(f"{f.relative_to(root)}\t{st.st_size}\t{st.st_mtime}")
+    data = "\n".join(lines).encode()
+    paths = read_file_list(io.BytesIO(data), root)
+    _, scanned = scan_fileset(fileset, include_unmatched=True, filelist=paths)
+    expect_wb = load_workbook(fileset["scanned_excel"])
+    got_wb = load_workbook(scanned)
+    assert_worksheets_equal(expect_wb["Files"], got_wb["Files"])
+
+
+@pytest.mark.parametrize("shards", [2, 3])
+def test_scan_filelist_shards(tmp_path, test_files, shards, scan_fileset, make_matcher):
+    fileset = test_files["basic"]
+    root = Path(fileset["dir"])
+    listed = reversed(shard_filepaths(root, 1, 1, [".DS_Store"]))
+    data = "\n".join(str(f.relative_to(root)) for f in listed).encode()
+    paths = read_file_list(io.BytesIO(data), root)
+    _, single = scan_fileset(fileset, include_unmatched=True, filelist=paths)
+    shardsdir = tmp_path / "shards"
+    for shard in range(1, shards + 1):
+        paths = read_file_list(
+            io.BytesIO(data), root, shard=shard, shards=shards, positions=True
+        )
+        scan_shard(
+            make_matcher(fileset), root, shardsdir, shard, shards, filelist=paths
+        )
+    merged = tmp_path / "merged.xlsx"
+    new_workbook(merged)
+    merge(make_matcher(fileset), shardsdir, merged)
+    expect_wb = load_workbook(single)
+    got_wb = load_workbook(merged)
+    assert_worksheets_equal(expect_wb["Files"], got_wb["Files"])
+
+
+def test_scan_filelist_missing(test_files, scan_fileset):
+    fileset = test_files["basic"]
+    root = Path(fileset["dir"])
+    missing = "DOE^JOHN-002304/20200312HeadCT/Head CT/image-00099.dcm"
+    paths = read_file_list(io.BytesIO(missing.encode()), root)
+    _, scanned = scan_fileset(fileset, include_unmatched=True, filelist=paths)
+    rows = list(load_workbook(scanned)["Files"].values)[1:]
+    assert len(rows) == 1
+    assert rows[0][1] == str(root / missing)
+    assert rows[0][3] == "N"
+    assert rows[0][4].startswith("Can't read file")
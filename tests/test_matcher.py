@@ -4,6 +4,8 @@ import string
 from datetime import datetime, timedelta
 import logging
 
+from xnatuploader.matcher import Matcher, MatchTrace
+
 logger = logging.getLogger(__name__)
 
 # Note: this test is a little clunky because Matcher.match now does DICOM
@@ -34,6 +36,56 @@ def test_random(matcher_case):
         assert results == expect
 
 
+def test_compiled_matches_recursive(matcher_case):
+    matcher, case = matcher_case
+    paths = [p["path"] for p in case["paths"]] + case.get("bad_paths", [])
+    paths += [make_random_path(case["patterns"])[0] for i in range(100)]
+    paths += [make_random_path(["**", "{Filename}"])[0] for i in range(20)]
+    for path in paths:
+        assert matcher.match_path(Path(path)) == matcher.match_path_r(Path(path))
+
+
+def test_compiled_label_order():
+    MAPPINGS = {"Subject": ["ID"]}
+    matcher = Matcher(
+        {
+            "deep": ["{ID}", "**", "{Filename}"],
+            "shallow": ["{ID}", "{Filename}"],
+        },
+        MAPPINGS,
+        [],
+    )
+    for path, label, values in [
+        ("1234/x/y/a.dcm", "deep", {"ID": "1234", "Filename": "a.dcm"}),
+        ("1234/a.dcm", "shallow", {"ID": "1234", "Filename": "a.dcm"}),
+    ]:
+        assert matcher.match_path(Path(path)) == (label, values)
+        assert matcher.match_path_r(Path(path)) == (label, values)
+    matcher = Matcher({"repeated": ["{ID}", "{ID}-{Filename}"]}, MAPPINGS, [])
+    expect = ("repeated", {"ID": "2", "Filename": "a.dcm"})
+    assert matcher.match_path(Path("1/2-a.dcm")) == expect
+    assert matcher.match_path_r(Path("1/2-a.dcm")) == expect
+
+
+def test_match_trace():
+    matcher = Matcher(
+        {"test": ["{SubjectName}-{ID}", "{DDDDDDDD}", "**", "{Filename}"]},
+        {"Subject": ["ID"]},
+        [],
+    )
+    assert matcher.trace is None
+    matcher.trace = MatchTrace()
+    matcher.match_path(Path("JoeBlow-1234/20120301/a/test.dcm"))
+    matcher.match_path(Path("JoeBlow-1234/201203/a/test.dcm"))
+    matcher.match_path(Path("JoeBlow-1234/20120301/test.dcm"))
+    matched, bad_date, too_short = matcher.trace.records
+    assert matched["label"] == "test"
+    assert matched["values"]["ID"] == "1234"
+    assert bad_date["label"] is None
+    assert bad_date["reasons"]["test"] == "'201203' doesn't match '{DDDDDDDD}'"
+    assert too_short["reasons"]["test"] == "path ends before '{Filename}'"
+
+
 def random_word():
     n = random.randint(4, 20)
     return "".join([random.choice(string.ascii_letters) for i in range(n)])
@@ -0,0 +1,96 @@
+import json
+import re
+from pathlib import Path
+
+import pytest
+
+from xnatuploader.metrics import (
+    count,
+    start_metrics,
+    stop_metrics,
+    Histogram,
+    RunMetrics,
+    METRICS,
+)
+
+SOURCE_DIR = Path(__file__).parent.parent / "src" / "xnatuploader"
+
+
+def test_count_without_metrics():
+    assert stop_metrics() is None
+    count("files_scanned", "matched")
+
+
+def test_metrics_declared():
+    used = set()
+    for source in SOURCE_DIR.glob("*.py"):
+        used |= set(
+            re.findall(r'\b(?:count|observe|gauge)\(\s*"(\w+)"', source.read_text())
+        )
+    assert used
+    assert used - set(METRICS) == set()
+
+
+def test_histogram_percentiles():
+    histogram = Histogram()
+    for i in range(100):
+        histogram.observe(0.015)
+    histogram.observe(3.0)
+    summary = histogram.summary()
+    assert summary["count"] == 101
+    assert summary["max"] == 3.0
+    assert 0.01 < summary["p50"] <= 0.02
+    assert 0.01 < summary["p99"] <= 0.02
+    assert histogram.percentile(100) == 3.0
+
+
+def test_prometheus_format(tmp_path):
+    metrics = RunMetrics("upload", tmp_path)
+    metrics.count("files_uploaded", "success", 3)
+    metrics.count("extract_failures", 'bad "quote"')
+    metrics.observe("upload_seconds", 0.5)
+    metrics.gauge("upload_concurrency", 4)
+    text = metrics.prometheus()
+    lines = text.splitlines()
+    assert (
+        'xnatuploader_files_uploaded_total{operation="upload",outcome="success"} 3'
+        in lines
+    )
+    assert 'xnatuploader_digest_mismatches_total{operation="upload"} 0' in lines
+    assert (
+        'xnatuploader_extract_failures_total{operation="upload",'
+        'reason="bad \\"quote\\""} 1'
+    ) in lines
+    assert 'xnatuploader_upload_seconds_bucket{operation="upload",le="0.2"} 0' in lines
+    assert 'xnatuploader_upload_seconds_bucket{operation="upload",le="0.5"} 1' in lines
+    assert 'xnatuploader_upload_seconds_count{operation="upload"} 1' in lines
+    assert "# TYPE xnatuploader_upload_concurrency gauge" in lines
+    assert 'xnatuploader_upload_concurrency{operation="upload"} 4' in lines
+    assert metrics.summary()["gauges"] == {"upload_concurrency": 4}
+
+
+@pytest.mark.parametrize("operation", ["upload", "work", "watch"])
+def test_error_rate(tmp_path, operation):
+    metrics = RunMetrics(operation, tmp_path)
+    metrics.count("files_uploaded", "success", 1)
+    metrics.count("files_uploaded", "failed", 3)
+    assert metrics.summary()["error_rate"] == 0.75
+
+
+def test_scan_metrics(tmp_path, test_files, scan_fileset):
+    fileset = test_files["basic"]
+    start_metrics("scan", tmp_path, interval=0)
+    try:
+        scan_fileset(fileset)
+    finally:
+        metrics = stop_metrics()
+    files = [f for f in Path(fileset["dir"]).glob("**/*") if f.is_file()]
+    summary = json.loads(metrics.json_file.read_text())
+    assert summary["finished"]
+    scanned = summary["counters"]["files_scanned"]
+    assert scanned["matched"] > 0
+    assert sum(scanned.values()) == len(files)
+    failures = summary["counters"].get("extract_failures", {})
+    assert sum(failures.values()) == scanned.get("unmatched_extract", 0)
+    assert all(" " not in reason for reason in failures)
+    assert metrics.prom_file.is_file()
@@ -0,0 +1,245 @@
+import hashlib
+import json
+import time
+from collections import Counter
+from types import SimpleNamespace
+from pathlib import Path
+
+import pytest
+
+from openpyxl import load_workbook
+
+from xnatuploader.checksum import ChecksumEngine
+from xnatuploader.workbook import load_config, new_workbook, HELP_COLUMN_WIDTH
+from xnatuploader.upload import Upload, SessionProgress, trigger_pipelines
+from xnatuploader.metrics import start_metrics, stop_metrics
+from xnatuploader.concurrency import AIMDController
+from xnatuploader.throttle import Throttle, Schedule
+from xnatuploader.tracing import (
+    start_tracing,
+    stop_tracing,
+    TRACE_FILE,
+    CHROME_TRACE_FILE,
+)
+
+
+def md5(filename):
+    return hashlib.md5(Path(filename).read_bytes()).hexdigest()
+
+
+def test_mock_upload(test_files, mock_xnat, scan_and_upload):
+    selected = scan_and_upload(test_files["basic"], mock_xnat)
+    assert len(selected) > 0
+    uploaded = {
+        (session, scan, name): file["digest"]
+        for (_, _, session, scan, _, name), file in mock_xnat.files().items()
+    }
+    sessions = set()
+    for row in selected:
+        assert row.status == "success"
+        key = (row.session_label, row.series_number, Path(row.file).name)
+        assert uploaded[key] == md5(row.file)
+        sessions.add(row.session_label)
+    assert len(uploaded) == len(selected)
+    assert len(mock_xnat.triggers) == 3 * len(sessions)
+    assert mock_xnat.requests["PUT file"] == len(selected)
+
+
+def test_mock_upload_errors(test_files, mock_xnat, scan_and_upload):
+    mock_xnat.fail_next("file", 1, status=403)
+    selected = scan_and_upload(test_files["basic"], mock_xnat)
+    failed = [row for row in selected if row.status != "success"]
+    assert len(failed) == 1
+    assert len(mock_xnat.files()) == len(selected) - 1
+    assert mock_xnat.requests["PUT file"] == len(selected)
+
+
+def test_mock_upload_retries(test_files, mock_xnat, scan_and_upload):
+    mock_xnat.fail_next("file", 2, status=503)
+    selected = scan_and_upload(test_files["basic"], mock_xnat)
+    assert all(row.status == "success" for row in selected)
+    assert len(mock_xnat.files()) == len(selected)
+    assert mock_xnat.requests["PUT file"] == len(selected) + 2
+
+
+def test_mock_upload_metrics(tmp_path, test_files, mock_xnat, scan_and_upload):
+    mock_xnat.fail_next("file", 1, status=403)
+    start_metrics("upload", tmp_path, interval=0)
+    try:
+        selected = scan_and_upload(test_files["basic"], mock_xnat)
+    finally:
+        metrics = stop_metrics()
+    uploaded = metrics.counters["files_uploaded"]
+    assert uploaded["success"] == len(selected) - 1
+    assert uploaded["failed"] == 1
+    assert metrics.total("upload_bytes") == sum(
+        Path(row.file).stat().st_size for row in selected if row.status == "success"
+    )
+    assert metrics.histograms["upload_seconds"][None].count == len(selected) - 1
+
+
+def test_mock_upload_trace(tmp_path, test_files, mock_xnat, scan_and_upload):
+    tracefile = tmp_path / TRACE_FILE
+    start_tracing(tracefile)
+    try:
+        selected = scan_and_upload(test_files["basic"], mock_xnat)
+    finally:
+        stop_tracing()
+    events = [json.loads(line) for line in tracefile.read_text().splitlines()]
+    assert json.loads((tmp_path / CHROME_TRACE_FILE).read_text()) == events
+    spans = [e for e in events if e["ph"] == "X"]
+    names = Counter(e["name"] for e in spans)
+    assert names["file"] == len(selected)
+    assert names["send"] == len(selected)
+    assert names["verify"] == len(selected)
+    assert names["read"] == len(selected)
+    assert names["session"] == len({(r.session_label, r.dataset) for r in selected})
+    assert names["trigger"] == 3 * len({r.session_label for r in selected})
+    for e in spans:
+        assert e["dur"] >= 0
+        if e["name"] != "trigger":
+            assert e["args"]["session"] and e["args"]["scan"]
+
+    def key(e):
+        return e["args"]["session"], e["args"]["scan"], e["args"]["file"]
+
+    files = {key(e): e for e in spans if e["name"] == "file"}
+    for send in (e for e in spans if e["name"] == "send"):
+        parent = files[key(send)]
+        assert parent["ts"] <= send["ts"]
+        assert send["ts"] + send["dur"] <= parent["ts"] + parent["dur"] + 1
+
+
+def test_mock_upload_extsort(tmp_path, test_files, mock_xnat, scan_and_upload):
+    fileset = test_files["basic"]
+    selected = scan_and_upload(fileset, mock_xnat, name="extsort.xlsx", extsort=True)
+    assert len(selected) > 0
+    assert all(row.status == "success" for row in selected)
+    assert len(mock_xnat.files()) == len(selected)
+    # the spreadsheet was rewritten with the configuration and its layout
+    spreadsheet = tmp_path / "extsort.xlsx"
+    new_workbook(tmp_path / "new.xlsx")
+    assert load_config(spreadsheet) == load_config(tmp_path / "new.xlsx")
+    wb = load_workbook(spreadsheet)
+    assert wb.sheetnames == ["Configuration", "Files"]
+    ws = wb["Configuration"]
+    assert ws.column_dimensions["A"].width == HELP_COLUMN_WIDTH
+    assert "A2:F2" in ws.merged_cells
+    assert ws["A2"].alignment.wrapText
+    assert list(tmp_path.glob("tmp*.xlsx")) == []
+
+
+def test_mock_upload_concurrent(test_files, mock_xnat, scan_and_upload):
+    mock_xnat.latency = 0.01
+    controller = AIMDController(min_workers=2, max_workers=4)
+    selected = scan_and_upload(test_files["basic"], mock_xnat, concurrency=controller)
+    assert all(row.status == "success" for row in selected)
+    assert len(mock_xnat.files()) == len(selected)
+    assert mock_xnat.requests["PUT file"] == len(selected)
+    assert 2 <= controller.limit <= 4
+    expect = scan_and_upload(test_files["basic"], mock_xnat, name="serial.xlsx")
+    assert [row.file for row in selected] == [row.file for row in expect]
+
+
+@pytest.mark.parametrize("workers", [1, 4])
+def test_mock_upload_prefetch(
+    test_files, mock_xnat, scan_and_upload, monkeypatch, workers
+):
+    """Each scan's digests are prefetched before any of its files are sent"""
+    prefetched = []
+    prefetch = ChecksumEngine.prefetch
+
+    def record(engine, filenames):
+        sent = {(session, scan) for (_, _, session, scan, _, _) in mock_xnat.files()}
+        prefetched.append((sorted(filenames), sent))
+        return prefetch(engine, filenames)
+
+    monkeypatch.setattr(ChecksumEngine, "prefetch", record)
+    controller = AIMDController(min_workers=workers, max_workers=workers)
+    selected = scan_and_upload(test_files["basic"], mock_xnat, concurrency=controller)
+    assert all(row.status == "success" for row in selected)
+    scans = {}
+    for row in selected:
+        scans.setdefault((row.session_label, row.series_number), []).append(row.file)
+    assert len(prefetched) == len(scans)
+    for scan, files in scans.items():
+        calls = [sent for filenames, sent in prefetched if filenames == sorted(files)]
+        assert len(calls) == 1
+        assert scan not in calls[0]
+
+
+def test_mock_upload_concurrent_errors(test_files, mock_xnat, scan_and_upload):
+    mock_xnat.fail_next("scan", 1, status=403)
+    mock_xnat.fail_next("file", 1, status=403)
+    controller = AIMDController(min_workers=4, max_workers=4)
+    selected = scan_and_upload(test_files["basic"], mock_xnat, concurrency=controller)
+    failed = [row for row in selected if row.status != "success"]
+    sessions = Counter((row.session_label, row.series_number) for row in failed)
+    # one whole dataset and one other file
+    assert len(sessions) == 2
+    assert len(mock_xnat.files()) == len(selected) - len(failed)
+
+
+def test_mock_upload_throttle(test_files, mock_xnat, scan_and_upload):
+    throttle = Throttle(Schedule.parse("4MB/s"))
+    start = time.monotonic()
+    selected = scan_and_upload(test_files["basic"], mock_xnat, throttle=throttle)
+    elapsed = time.monotonic() - start
+    assert all(row.status == "success" for row in selected)
+    sent = sum(Path(row.file).stat().st_size for row in selected)
+    assert mock_xnat.bytes_received >= sent
+    assert elapsed > 0.8 * sent / 4e6
+
+
+def test_mock_upload_triggers_skip_failed(test_files, mock_xnat, scan_and_upload):
+    mock_xnat.fail_next("file", 1000, status=403)
+    selected = scan_and_upload(test_files["basic"], mock_xnat)
+    assert all(row.status != "success" for row in selected)
+    assert mock_xnat.triggers == []
+
+
+def test_trigger_pipelines(test_files, mock_xnat, scan_and_upload):
+    selected = scan_and_upload(test_files["basic"], mock_xnat)
+    mock_xnat.reset_counts()
+    uploads = {
+        row.session_label: SimpleNamespace(
+            session_label=row.session_label, subject=row["Subject"]
+        )
+        for row in selected
+    }
+    xnat_session = mock_xnat.connect()
+    trigger_pipelines(xnat_session, "Project", uploads)
+    xnat_session.disconnect()
+    assert len(mock_xnat.triggers) == 3 * len(uploads)
+
+
+def test_session_progress():
+    class Stage:
+        def __init__(self):
+            self.sessions = []
+
+        def submit(self, session, subject):
+            self.sessions.append(session)
+
+    def upload(label, statuses):
+        u = Upload(label, "S", "", "", "", label, False, "", "")
+        u.files = [SimpleNamespace(status=status) for status in statuses]
+        return u
+
+    uploads = {
+        "a": upload("A", ["success", "failed"]),
+        "b": upload("B", ["failed"]),
+        "c": upload("C", ["success", "success"]),
+    }
+    stage = Stage()
+    progress = SessionProgress(uploads, stage)
+    a, b, c = uploads.values()
+    progress.done(a, a.files[0])
+    # not triggered until all of its files are done
+    assert stage.sessions == []
+    progress.done(a, a.files[1])
+    assert stage.sessions == ["A"]
+    progress.done(b, b.files[0])
+    for file in c.files:
+        progress.done(c, file)
+    assert stage.sessions == ["A", "C"]
@@ -0,0 +1,70 @@
+from openpyxl import load_workbook
+
+from xnatuploader.collate import collate_uploads, check_safe_dicom
+from xnatuploader.plan import (
+    VerdictCache,
+    load_plan,
+    save_plan,
+    manifest_hash,
+    config_hash,
+)
+
+
+def upload_files(uploads):
+    return {k: [f.file for f in u.files] for k, u in uploads.items()}
+
+
+def test_plan_roundtrip(tmp_path, test_files, scan_fileset, read_files):
+    fileset = test_files["basic"]
+    matcher, log = scan_fileset(fileset)
+    files = read_files(matcher, log)
+    planfile = tmp_path / "log.plan.json"
+    checked = []
+
+    def counting_check(file):
+        checked.append(file.file)
+        return check_safe_dicom(file)
+
+    verdicts = VerdictCache(counting_check)
+    skip, uploads = collate_uploads(files, False, verdicts)
+    n_checked = len(checked)
+    assert n_checked > 0
+    manifest = manifest_hash(log)
+    config = config_hash(matcher, False)
+    save_plan(planfile, manifest, config, skip, uploads, verdicts)
+
+    collated, reloaded = load_plan(planfile, manifest, config, matcher, counting_check)
+    assert collated is not None
+    plan_skip, plan_uploads = collated
+    assert upload_files(plan_uploads) == upload_files(uploads)
+    assert [f.file for f in plan_skip] == [f.file for f in skip]
+    for session_scan, upload in plan_uploads.items():
+        assert upload.session_label == uploads[session_scan].session_label
+        assert upload.series_number == uploads[session_scan].series_number
+    assert len(checked) == n_checked
+
+    # a changed config invalidates the plan but the verdicts are still used
+    collated, reloaded = load_plan(
+        planfile, manifest, config_hash(matcher, True), matcher, counting_check
+    )
+    assert collated is None
+    collate_uploads(files, True, reloaded)
+    assert len(checked) == n_checked
+
+
+def test_plan_manifest_changed(tmp_path, test_files, scan_fileset, read_files):
+    fileset = test_files["basic"]
+    matcher, log = scan_fileset(fileset)
+    files = read_files(matcher, log)
+    planfile = tmp_path / "log.plan.json"
+    verdicts = VerdictCache(check_safe_dicom)
+    skip, uploads = collate_uploads(files, False, verdicts)
+    config = config_hash(matcher, False)
+    save_plan(planfile, manifest_hash(log), config, skip, uploads, verdicts)
+    wb = load_workbook(log)
+    wb["Files"].cell(2, 4).value = "N"
+    wb.save(log)
+    collated, _ = load_plan(
+        planfile, manifest_hash(log), config, matcher, check_safe_dicom
+    )
+    assert collated is None
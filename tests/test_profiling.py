@@ -0,0 +1,55 @@
+from xnatuploader.profiling import (
+    phase,
+    profiling_enabled,
+    start_profiling,
+    stop_profiling,
+    PhaseProfiler,
+    Phase,
+    NULL_PHASE,
+    PSTATS_FILE,
+    SUMMARY_FILE,
+)
+
+
+def test_phase_without_profiler():
+    assert stop_profiling() is None
+    assert phase("scan") is NULL_PHASE
+    assert not profiling_enabled()
+    start_profiling()
+    assert profiling_enabled()
+    stop_profiling()
+    assert not profiling_enabled()
+
+
+def test_nested_phases():
+    profiler = PhaseProfiler(sample=3)
+    for _ in range(6):
+        with Phase(profiler, "outer"):
+            with Phase(profiler, "inner"):
+                sum(range(1000))
+    outer = profiler.phases["outer"]
+    inner = profiler.phases["inner"]
+    assert outer.calls == 6
+    assert inner.calls == 6
+    assert outer.self_time < outer.total
+    assert abs(outer.total - outer.self_time - inner.total) < 1e-6
+    # inner calls are never sampled while an outer call is being profiled
+    assert outer.sampled == 2
+    assert inner.sampled == 0
+    assert profiler.sampled == 2
+
+
+def test_profile_scan(tmp_path, test_files, scan_fileset):
+    fileset = test_files["basic"]
+    start_profiling(sample=2)
+    try:
+        scan_fileset(fileset)
+    finally:
+        profiler = stop_profiling()
+    profiler.write(tmp_path)
+    for name in ["walk", "match", "extract", "collate", "sheet write"]:
+        assert profiler.phases[name].calls > 0
+    assert profiler.phases["walk"].sampled == 1
+    summary = (tmp_path / SUMMARY_FILE).read_text()
+    assert "sheet write" in summary
+    assert (tmp_path / PSTATS_FILE).is_file()
@@ -0,0 +1,101 @@
+import pytest
+import requests
+
+from xnatuploader.retry import (
+    retryable,
+    RetryableError,
+    RetryScheduler,
+    CircuitBreaker,
+)
+
+
+@pytest.mark.parametrize(
+    "error, expect",
+    [
+        (RetryableError("digest mismatch"), True),
+        (requests.exceptions.ConnectionError("reset"), True),
+        (requests.exceptions.ReadTimeout("slow"), True),
+        (ValueError("Invalid response from XNATSession (status 503)"), True),
+        (ValueError("Invalid response from XNATSession (status 429)"), True),
+        (ValueError("Invalid response from XNATSession (status 403)"), False),
+        (ValueError("Cannot create session (status 503)"), False),
+        (FileNotFoundError("missing.dcm"), False),
+    ],
+)
+def test_retryable(error, expect):
+    assert retryable(error) is expect
+
+
+def flaky(failures, error=RetryableError("busy")):
+    """Returns a function which raises error the first failures times"""
+    calls = []
+
+    def fn(attempt):
+        calls.append(attempt)
+        if len(calls) <= failures:
+            raise error
+        return "ok"
+
+    return fn, calls
+
+
+def test_retry_succeeds():
+    scheduler = RetryScheduler(attempts=3, backoff=0.001)
+    fn, calls = flaky(2)
+    assert scheduler.call(fn, "test") == "ok"
+    assert calls == [1, 2, 3]
+
+
+def test_retry_gives_up():
+    scheduler = RetryScheduler(attempts=3, backoff=0.001)
+    fn, calls = flaky(5)
+    with pytest.raises(RetryableError):
+        scheduler.call(fn, "test")
+    assert calls == [1, 2, 3]
+
+
+def test_retry_permanent_error():
+    scheduler = RetryScheduler(attempts=3, backoff=0.001)
+    fn, calls = flaky(1, FileNotFoundError("missing.dcm"))
+    with pytest.raises(FileNotFoundError):
+        scheduler.call(fn, "test")
+    assert calls == [1]
+
+
+def test_retry_session_budget():
+    scheduler = RetryScheduler(attempts=5, session_retries=3, backoff=0.001)
+    fn, calls = flaky(2)
+    scheduler.call(fn, "first", session="A")
+    fn, calls = flaky(2)
+    with pytest.raises(RetryableError):
+        scheduler.call(fn, "second", session="A")
+    assert calls == [1, 2]
+    # other sessions have their own budget
+    fn, calls = flaky(2)
+    assert scheduler.call(fn, "third", session="B") == "ok"
+
+
+def test_retry_backoff():
+    scheduler = RetryScheduler(backoff=1.0, max_backoff=5.0)
+    for _ in range(100):
+        assert 0 <= scheduler.delay(1) <= 1.0
+        assert 0 <= scheduler.delay(10) <= 5.0
+
+
+def test_circuit_breaker():
+    breaker = CircuitBreaker(window=4, threshold=0.5, pause=0.01)
+    for ok in [True, False, True]:
+        breaker.record(ok)
+    assert breaker.open_until is None
+    breaker.record(False)
+    assert breaker.open_until is not None
+    breaker.wait()
+    assert breaker.open_until is None
+    assert breaker.half_open
+    # a failure while half-open opens it again straight away
+    breaker.record(False)
+    assert breaker.open_until is not None
+    breaker.wait()
+    breaker.record(True)
+    assert not breaker.half_open
+    assert breaker.open_until is None
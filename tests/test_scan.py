@@ -1,12 +1,16 @@
 import logging
 import json
+import os
+import pickle
 from openpyxl import load_workbook
 from pathlib import Path
 import pytest
 
-from xnatuploader.matcher import Matcher
+from xnatuploader.matcher import Matcher, MatchTrace
 from xnatuploader.dicoms import dicom_extractor, XNATFileMatch, SPREADSHEET_FIELDS
 from xnatuploader.xnatuploader import scan, collate_uploads
+from xnatuploader.collate import collate_uploads_external
+from xnatuploader.shard import parse_shard, shard_of, ShardError, scan_shard, merge
 from xnatuploader.workbook import load_config, new_workbook
 
 logger = logging.getLogger(__name__)
@@ -39,6 +43,110 @@ def test_scan(tmp_path, test_files):
     assert_worksheets_equal(expect_wb["Files"], got_wb["Files"])
 
 
+@pytest.mark.parametrize("shards", [1, 2, 3, 5])
+def test_scan_shards(tmp_path, test_files, shards, make_matcher):
+    fileset = test_files["basic"]
+    matcher = make_matcher(fileset)
+    shardsdir = tmp_path / "shards"
+    root = Path(fileset["dir"])
+    for shard in range(1, shards + 1):
+        scan_shard(matcher, root, shardsdir, shard, shards, include_unmatched=True)
+    scanned = tmp_path / "scanned.xlsx"
+    new_workbook(scanned)
+    merge(matcher, shardsdir, scanned)
+    expect_wb = load_workbook(fileset["scanned_excel"])
+    got_wb = load_workbook(scanned)
+    assert_worksheets_equal(expect_wb["Files"], got_wb["Files"])
+
+
+def test_scan_shards_checksums(tmp_path, test_files, make_matcher, scan_fileset):
+    fileset = test_files["basic"]
+    root = Path(fileset["dir"])
+    _, scanned = scan_fileset(fileset, include_unmatched=True, checksums=True)
+    shardsdir = tmp_path / "shards"
+    for shard in range(1, 3):
+        scan_shard(
+            make_matcher(fileset),
+            root,
+            shardsdir,
+            shard,
+            2,
+            include_unmatched=True,
+            checksums=True,
+        )
+    merged = tmp_path / "merged.xlsx"
+    new_workbook(merged)
+    merge(make_matcher(fileset), shardsdir, merged, checksums=True)
+    assert_worksheets_equal(
+        load_workbook(scanned)["Files"], load_workbook(merged)["Files"]
+    )
+    # merging without checksums is a different configuration
+    with pytest.raises(ShardError):
+        merge(make_matcher(fileset), shardsdir, merged)
+
+
+def test_merge_missing_shard(tmp_path, test_files, make_matcher):
+    fileset = test_files["basic"]
+    matcher = make_matcher(fileset)
+    shardsdir = tmp_path / "shards"
+    scan_shard(matcher, Path(fileset["dir"]), shardsdir, 1, 2)
+    scanned = tmp_path / "scanned.xlsx"
+    new_workbook(scanned)
+    with pytest.raises(ShardError, match=r"Missing shards .*\[2\]"):
+        merge(matcher, shardsdir, scanned)
+    with pytest.raises(ShardError, match="different configuration"):
+        merge(matcher, shardsdir, scanned, strict_scan_ids=True)
+
+
+def test_parse_shard():
+    assert parse_shard("2/8") == (2, 8)
+    for bad in ["0/8", "9/8", "2", "a/b"]:
+        with pytest.raises(ShardError):
+            parse_shard(bad)
+    assert {shard_of(f"subject{i}", 4) for i in range(100)} == {1, 2, 3, 4}
+
+
+def scandir_files(path):
+    for entry in os.scandir(path):
+        if entry.is_dir():
+            yield from scandir_files(entry.path)
+        else:
+            yield entry
+
+
+def test_match_many(test_files, make_matcher):
+    fileset = test_files["basic"]
+    matcher = make_matcher(fileset)
+    root = Path(fileset["dir"])
+    filepaths = sorted([f for f in root.glob("**/*") if f.is_file()])
+    expect = [matcher.match(root, f) for f in filepaths]
+    got = list(matcher.match_many(root, filepaths))
+    assert [f.columns for f in got] == [f.columns for f in expect]
+    entries = sorted(scandir_files(root), key=lambda e: Path(e.path))
+    unpickled = pickle.loads(pickle.dumps(matcher))
+    got = list(unpickled.match_many(root, entries))
+    assert [f.columns for f in got] == [f.columns for f in expect]
+    # the root is normalised, so it needn't be written the same way as the
+    # paths of the files
+    unnormalised = os.path.join(root, "..", root.name) + "/"
+    got = list(matcher.match_many(unnormalised, filepaths))
+    assert [f.columns for f in got] == [f.columns for f in expect]
+    absolute = [f.absolute() for f in filepaths]
+    expect = [matcher.match(root.absolute(), f) for f in absolute]
+    got = list(matcher.match_many(root, absolute))
+    assert [f.columns for f in got] == [f.columns for f in expect]
+
+
+def test_pickle_matcher_with_trace(tmp_path, test_files, make_matcher):
+    fileset = test_files["basic"]
+    matcher = make_matcher(fileset)
+    with open(tmp_path / "trace.jsonl", "w") as stream:
+        matcher.trace = MatchTrace(stream)
+        unpickled = pickle.loads(pickle.dumps(matcher))
+    assert matcher.trace is not None
+    assert unpickled.trace is None
+
+
 @pytest.mark.parametrize("source_dir", ["basic", "basic_strict"])
 def test_collation(source_dir, tmp_path, test_files):
     fileset = test_files[source_dir]
@@ -71,6 +179,26 @@ def test_collation(source_dir, tmp_path, test_files):
     assert len(skipped) == uploads_dict["skipped"]
 
 
+@pytest.mark.parametrize("source_dir", ["basic", "basic_strict"])
+def test_collation_external(source_dir, tmp_path, test_files, scan_fileset, read_files):
+    fileset = test_files[source_dir]
+    uploads_dict = fileset["uploads_dict"]
+    matcher, log = scan_fileset(fileset, strict_scan_ids=fileset["strict_scan_ids"])
+    files = read_files(matcher, log)
+    # a small run size makes sure that there's more than one run to merge
+    skipped = []
+    uploads = {}
+    for skip, batch in collate_uploads_external(
+        files, fileset["strict_scan_ids"], matcher, tmp_path, run_size=2
+    ):
+        skipped += skip
+        for session_scan, upload in batch.items():
+            assert session_scan not in uploads
+            uploads[session_scan] = [f.file for f in upload.files]
+    assert uploads == uploads_dict["uploads"]
+    assert len(skipped) == uploads_dict["skipped"]
+
+
 def test_sanitisation_collisions(tmp_path, test_files, sanitised_dict):
     fileset = test_files["sanitisation"]
     config_file = fileset["config"]
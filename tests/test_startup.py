@@ -0,0 +1,57 @@
+import subprocess
+import sys
+
+import pytest
+
+HEAVY = ["pydicom", "openpyxl", "xnat", "xnatutils", "tqdm", "click", "dicomanonymizer"]
+
+LOADED = """
+import sys
+import {module}
+print(" ".join(sorted(m for m in sys.modules if "." not in m)))
+"""
+
+
+@pytest.mark.parametrize(
+    "module",
+    [
+        "xnatuploader.xnatuploader",
+        "xnatuploader.scan",
+        "xnatuploader.collate",
+        "xnatuploader.upload",
+        "xnatuploader.dicoms",
+        "xnatuploader.workbook",
+        "xnatuploader.plan",
+        "xnatuploader.shard",
+        "xnatuploader.watch",
+        "xnatuploader.workqueue",
+    ],
+)
+def test_lazy_imports(module):
+    result = subprocess.run(
+        [sys.executable, "-c", LOADED.format(module=module)],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    loaded = set(result.stdout.split())
+    assert loaded.isdisjoint(HEAVY)
+
+
+def test_version():
+    result = subprocess.run(
+        [sys.executable, "-m", "xnatuploader.xnatuploader", "--version"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    from xnatuploader import __version__
+
+    assert result.stdout.split()[-1] == __version__
+
+
+def test_anonrules():
+    from dicomanonymizer import keep
+    from xnatuploader.upload import ANONRULES
+
+    assert ANONRULES == {(0x0008, 0x0020): keep}
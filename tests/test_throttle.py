@@ -0,0 +1,68 @@
+import time
+from datetime import datetime
+
+import pytest
+
+from xnatuploader import throttle as throttle_module
+from xnatuploader.throttle import (
+    parse_rate,
+    Schedule,
+    ScheduleError,
+    Throttle,
+    UNLIMITED,
+    PAUSED,
+)
+
+
+@pytest.mark.parametrize(
+    "text, rate",
+    [
+        ("20 MB/s", 20e6),
+        ("500KiB/s", 500 * 1024),
+        ("100 Mbit/s", 12.5e6),
+        ("unlimited", UNLIMITED),
+        ("paused", PAUSED),
+    ],
+)
+def test_parse_rate(text, rate):
+    assert parse_rate(text) == rate
+
+
+def test_parse_rate_error():
+    with pytest.raises(ScheduleError):
+        parse_rate("fast")
+
+
+def test_schedule():
+    schedule = Schedule.parse("20:00-06:00 unlimited, 12:00-13:00 paused, 20MB/s")
+    assert schedule.rate_at(datetime(2024, 1, 1, 23, 30)) is UNLIMITED
+    assert schedule.rate_at(datetime(2024, 1, 1, 5, 59)) is UNLIMITED
+    assert schedule.rate_at(datetime(2024, 1, 1, 6, 0)) == 20e6
+    assert schedule.rate_at(datetime(2024, 1, 1, 12, 30)) == PAUSED
+    assert schedule.next_change(datetime(2024, 1, 1, 12, 30)) == datetime(
+        2024, 1, 1, 13, 0
+    )
+    assert Schedule.parse(5).default == 5e6
+
+
+def test_token_bucket():
+    throttle = Throttle(Schedule.parse("1MB/s"))
+    start = time.monotonic()
+    for _ in range(20):
+        throttle.take(16000)
+    elapsed = time.monotonic() - start
+    # the bucket starts empty, so 320kB takes about 0.32s
+    assert 0.25 < elapsed < 0.6
+    assert 0.25 < throttle.waited() <= elapsed
+
+
+def test_pause(monkeypatch):
+    monkeypatch.setattr(throttle_module, "PAUSE_SLEEP", 0.01)
+    times = iter([datetime(2024, 1, 1, 12, 30)] * 3)
+    throttle = Throttle(
+        Schedule.parse("12:00-13:00 paused, unlimited"),
+        now=lambda: next(times, datetime(2024, 1, 1, 13, 0)),
+    )
+    assert throttle.paused
+    throttle.wait_for_window()
+    assert not throttle.paused
@@ -0,0 +1,72 @@
+import shutil
+import threading
+import time
+
+from xnatuploader.watch import WatchState, watch, get_watch_state_filename
+
+from tests.mock_xnat import MockXNAT
+
+
+def start_watch(matcher, root, spreadsheet, server):
+    stop = threading.Event()
+    xnat_session = server.connect()
+    thread = threading.Thread(
+        target=watch,
+        args=(xnat_session, matcher, "Project", root, spreadsheet),
+        kwargs={
+            "overwrite": True,
+            "quiet": 0.2,
+            "poll": 0.05,
+            "inotify": False,
+            "stop": stop,
+        },
+    )
+    thread.start()
+    return stop, thread
+
+
+def wait_for(condition, timeout=10):
+    end = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < end, "timed out"
+        time.sleep(0.05)
+
+
+def uploaded(server):
+    return {(session, scan, name) for (_, _, session, scan, _, name) in server.files()}
+
+
+def test_watch(tmp_path, test_files, mock_xnat, scan_and_upload, make_matcher):
+    fileset = test_files["basic"]
+    with MockXNAT() as batch_server:
+        batch_server.add_project("Project")
+        scan_and_upload(fileset, batch_server, name="batch.xlsx")
+        expected = uploaded(batch_server)
+    root = tmp_path / "incoming"
+    shutil.copytree(fileset["dir"], root)
+    spreadsheet = tmp_path / "watch.xlsx"
+    shutil.copy(fileset["config_excel"], spreadsheet)
+
+    stop, thread = start_watch(make_matcher(fileset), root, spreadsheet, mock_xnat)
+    try:
+        wait_for(lambda: uploaded(mock_xnat) == expected)
+        series = root / "ROE^JANE-397829" / "20210414" / "SomeCT"
+        shutil.copy(series / "image-00000.dcm", series / "image-00001.dcm")
+        wait_for(lambda: len(uploaded(mock_xnat)) == len(expected) + 1)
+        time.sleep(0.5)
+    finally:
+        stop.set()
+        thread.join()
+    assert mock_xnat.requests["PUT file"] == len(expected) + 1
+
+    state = WatchState(get_watch_state_filename(spreadsheet))
+    assert state.visits["397829"] == {"20190115": 1, "20200623": 2, "20210414": 3}
+    assert "image-00001.dcm" in state.dirs["ROE^JANE-397829/20210414/SomeCT"]["files"]
+
+    # a restart only looks at directories which have changed
+    mock_xnat.reset_counts()
+    stop, thread = start_watch(make_matcher(fileset), root, spreadsheet, mock_xnat)
+    time.sleep(0.5)
+    stop.set()
+    thread.join()
+    assert mock_xnat.requests["PUT file"] == 0
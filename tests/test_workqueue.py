@@ -0,0 +1,124 @@
+import threading
+import time
+
+import pytest
+
+from xnatuploader.workqueue import (
+    WorkQueue,
+    QueueError,
+    LeaseKeeper,
+    enqueue,
+    work,
+    collect,
+    get_queue_filename,
+)
+from xnatuploader.retry import RetryScheduler
+
+
+@pytest.fixture
+def enqueued(test_files, scan_fileset):
+    matcher, spreadsheet = scan_fileset(test_files["basic"])
+    enqueue(matcher, spreadsheet)
+    return matcher, spreadsheet
+
+
+def run_worker(server, matcher, spreadsheet, name, **kwargs):
+    xnat_session = server.connect()
+    work(
+        xnat_session,
+        matcher,
+        "Project",
+        spreadsheet,
+        retry=RetryScheduler(backoff=0.01),
+        name=name,
+        **kwargs,
+    )
+    xnat_session.disconnect()
+
+
+def test_workqueue_workers(mock_xnat, read_files, enqueued):
+    matcher, spreadsheet = enqueued
+    before = [row.file for row in read_files(matcher, spreadsheet)]
+    workers = [
+        threading.Thread(
+            target=run_worker, args=(mock_xnat, matcher, spreadsheet, f"worker{i}")
+        )
+        for i in range(2)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    collect(matcher, spreadsheet)
+    assert not get_queue_filename(spreadsheet).exists()
+    rows = read_files(matcher, spreadsheet)
+    assert [row.file for row in rows] == before
+    selected = [row for row in rows if row.selected]
+    assert len(selected) > 0
+    assert all(row.status == "success" for row in selected)
+    assert len(mock_xnat.files()) == len(selected)
+    assert mock_xnat.requests["PUT file"] == len(selected)
+    sessions = set(row.session_label for row in selected)
+    assert len(mock_xnat.triggers) == 3 * len(sessions)
+
+
+def test_workqueue_expired_lease(mock_xnat, read_files, enqueued):
+    matcher, spreadsheet = enqueued
+    queue = WorkQueue(get_queue_filename(spreadsheet))
+    # a worker which takes a session and dies without reporting
+    label, attempts = queue.lease("dead", lease_time=0)
+    assert attempts == 1
+    run_worker(mock_xnat, matcher, spreadsheet, "alive", poll=0.1)
+    assert queue.states() == {
+        "done": len(set(queue.db.execute("SELECT session FROM uploads")))
+    }
+    assert queue.db.execute(
+        "SELECT owner, attempts FROM sessions WHERE label = ?", (label,)
+    ).fetchone() == ("alive", 2)
+    queue.close()
+    collect(matcher, spreadsheet)
+    selected = [row for row in read_files(matcher, spreadsheet) if row.selected]
+    assert all(row.status == "success" for row in selected)
+
+
+def test_workqueue_lost_lease(enqueued):
+    matcher, spreadsheet = enqueued
+    queue = WorkQueue(get_queue_filename(spreadsheet))
+    label, _ = queue.lease("slow", lease_time=0)
+    assert queue.lease("fast")[0] == label
+    upload = next(iter(queue.load(label, matcher).values()))
+    file = upload.files[0]
+    file.status = "success"
+    row = file.columns
+    assert not queue.report(label, "slow", row)
+    assert not queue.renew(label, "slow")
+    assert not queue.finish(label, "slow")
+    assert queue.report(label, "fast", row)
+    assert queue.finish(label, "fast")
+    queue.close()
+
+
+def test_workqueue_lease_keeper(enqueued):
+    matcher, spreadsheet = enqueued
+    queue = WorkQueue(get_queue_filename(spreadsheet))
+    label, _ = queue.lease("slow", lease_time=0.4)
+    with LeaseKeeper(queue, label, "slow", lease_time=0.4) as keeper:
+        time.sleep(1)
+        leased = queue.lease("other", lease_time=0.4)
+        assert leased is None or leased[0] != label
+    assert not keeper.lost
+    assert queue.finish(label, "slow")
+    expired, _ = queue.lease("expired", lease_time=0)
+    assert not queue.finish(expired, "expired")
+    queue.close()
+
+
+def test_workqueue_unfinished(read_files, enqueued):
+    matcher, spreadsheet = enqueued
+    with pytest.raises(QueueError):
+        enqueue(matcher, spreadsheet)
+    before = [(row.file, row.status) for row in read_files(matcher, spreadsheet)]
+    collect(matcher, spreadsheet)
+    assert get_queue_filename(spreadsheet).exists()
+    after = [(row.file, row.status) for row in read_files(matcher, spreadsheet)]
+    assert after == before